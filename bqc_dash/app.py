@@ -111,19 +111,3 @@ def initialize_session_tab_id(init, current_tab_id, toast_data):
     )(toast_data)
 
     return {"tab-id": tab_id}, notification
-
-
-# # Init auto-save path
-# @app.callback(
-#     Output("auto-save-path", "data"),
-#     [Input("auto-save-path", "modified_timestamp")],
-#     [State("auto-save-path", "data")],
-# )
-# def initialize_auto_save_path(ts, current_path):
-#     """Initialize auto-save path"""
-#     if current_path is None:
-#         auto_save_path = f"{session['id']}_auto_save.json"
-#         logger.info(f"Initializing new auto-save path: {auto_save_path}")
-#         return auto_save_path
-#     logger.info(f"Using existing auto-save path: {current_path}")
-#     return current_path
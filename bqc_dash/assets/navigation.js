@@ -0,0 +1,266 @@
+// Clientside navigation: index math, labels and image sources are computed
+// in the browser from the navigation manifest sent once by the server.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    bqc: Object.assign({}, (window.dash_clientside || {}).bqc, {
+        // Id of the session of the last manifest, to tell a new dataset from
+        // an extended one (first subject published, then the full scan)
+        manifestSession: null,
+
+        triggeredIds: function () {
+            return window.dash_clientside.callback_context.triggered.map(
+                (trigger) => trigger.prop_id.split(".")[0]
+            );
+        },
+
+        navigate: function (prevClicks, nextClicks, prevKeys, nextKeys, manifest, currentIndex) {
+            const noUpdate = window.dash_clientside.no_update;
+            const size = manifest ? manifest.size : 0;
+            if (!size) {
+                return noUpdate;
+            }
+
+            const triggered = this.triggeredIds();
+            const hasIndex = currentIndex !== null && currentIndex !== undefined && currentIndex < size;
+
+            if (triggered.includes("navigation-manifest-store")) {
+                if (manifest.session !== this.manifestSession) {
+                    // New dataset, start from its saved index or the first image
+                    this.manifestSession = manifest.session;
+                    const index = manifest.current_index;
+                    return index === null || index === undefined || index >= size ? 0 : index;
+                }
+                return hasIndex ? noUpdate : 0;
+            }
+
+            if (!hasIndex) {
+                return 0;
+            }
+            if (triggered.includes("next-img-btn") || triggered.includes("next-btn-key")) {
+                return (currentIndex + 1) % size;
+            }
+            if (triggered.includes("prev-img-btn") || triggered.includes("prev-btn-key")) {
+                return (currentIndex - 1 + size) % size;
+            }
+            return noUpdate;
+        },
+
+        // Width of the image viewer in device pixels, rounded up to the width
+        // of a rendition, or null to request full resolution images
+        renditionWidth: function (manifest) {
+            const renditions = manifest.renditions;
+            const viewer = document.getElementById("image-display-viewer");
+            if (!renditions || !viewer || !viewer.parentElement) {
+                return null;
+            }
+            // The zoom sets the viewer width as a percentage of the row, read
+            // it rather than the rendered width, which lags behind during the
+            // width transition
+            const percent = parseFloat(viewer.style.width) || 100;
+            const width = (viewer.parentElement.clientWidth * percent / 100) * (window.devicePixelRatio || 1);
+            if (!width) {
+                return null;
+            }
+            const widths = renditions.widths;
+            return widths.find((w) => w >= width) || widths[widths.length - 1];
+        },
+
+        imageSrc: function (manifest, index, width) {
+            const version = this.label(manifest.image_version, index);
+            const src = `${manifest.image_prefix}/${index}?v=${version}`;
+            return width ? `${src}&w=${width}&q=${manifest.renditions.quality}` : src;
+        },
+
+        // Images requested ahead of time, kept referenced so that the
+        // browser does not drop the requests
+        prefetched: [],
+
+        prefetch: function (manifest, index, width) {
+            const size = manifest.size;
+            const window_ = manifest.prefetch || {ahead: 0, behind: 0};
+            const urls = [];
+            for (let k = 1; k <= Math.min(window_.ahead, size - 1); k++) {
+                urls.push(this.imageSrc(manifest, (index + k) % size, width));
+            }
+            for (let k = 1; k <= Math.min(window_.behind, size - 1); k++) {
+                urls.push(this.imageSrc(manifest, (index - k + size) % size, width));
+            }
+
+            // GIF of the next subject, images of a subject are contiguous
+            const codes = manifest.subject.codes;
+            let next = index;
+            while (next < size && codes[next] === codes[index]) {
+                next++;
+            }
+            if (next < size && manifest.gifs[codes[next]]) {
+                urls.push(manifest.gifs[codes[next]]);
+            }
+
+            // The requests go through the server routes, so the files are
+            // also read from disk before the reviewer reaches them
+            this.prefetched = urls.map((url) => {
+                const image = new Image();
+                image.fetchPriority = "low";
+                image.src = url;
+                return image;
+            });
+        },
+
+        // Time from a navigation key press to the new image and GIF painted,
+        // split in phases and sent to the server in batches
+        latency: {
+            keys: ["ArrowRight", "ArrowLeft"],
+            batchSize: 20,
+            flushDelay: 10000,
+            timeout: 30000,
+            keyTime: null,
+            pending: null,
+            samples: [],
+            flushTimer: null,
+
+            pressed: function (event) {
+                if (this.keys.includes(event.key)) {
+                    this.keyTime = event.timeStamp || performance.now();
+                }
+            },
+
+            // Called by render, once the key press went through the callbacks
+            rendered: function (imageSrc, gifSrc) {
+                if (this.keyTime === null) {
+                    return;
+                }
+                const now = performance.now();
+                const absolute = (src) => (src ? new URL(src, document.baseURI).href : "");
+                const current = (id) => {
+                    const element = document.getElementById(id);
+                    return element ? element.src : "";
+                };
+                this.pending = {
+                    keyTime: this.keyTime,
+                    renderTime: now,
+                    image: absolute(imageSrc),
+                    gif: absolute(gifSrc),
+                    sample: {callback_chain: now - this.keyTime},
+                };
+                this.keyTime = null;
+                // An unchanged source is not loaded again, its phases are null
+                if (this.pending.image === current("image-display")) {
+                    this.pending.sample.image_load = null;
+                    this.pending.sample.image_decode = null;
+                }
+                if (!this.pending.gif || this.pending.gif === current("gif-display")) {
+                    this.pending.sample.gif_load = null;
+                }
+                this.finish();
+            },
+
+            loaded: function (event) {
+                const pending = this.pending;
+                const target = event.target;
+                if (!pending || !target || !target.id) {
+                    return;
+                }
+                const loadTime = performance.now();
+                if (target.id === "image-display" && target.src === pending.image) {
+                    pending.sample.image_load = loadTime - pending.renderTime;
+                    // Decoded and painted on the next frame
+                    const painted = () =>
+                        requestAnimationFrame(() => {
+                            pending.sample.image_decode = performance.now() - loadTime;
+                            this.finish();
+                        });
+                    (target.decode ? target.decode() : Promise.resolve()).then(painted, painted);
+                } else if (target.id === "gif-display" && target.src === pending.gif) {
+                    pending.sample.gif_load = loadTime - pending.renderTime;
+                    this.finish();
+                }
+            },
+
+            finish: function () {
+                const pending = this.pending;
+                if (!pending) {
+                    return;
+                }
+                const sample = pending.sample;
+                if (performance.now() - pending.keyTime > this.timeout) {
+                    this.pending = null;
+                    return;
+                }
+                if (sample.image_decode === undefined || sample.gif_load === undefined) {
+                    return;
+                }
+                sample.keypress_to_paint = performance.now() - pending.keyTime;
+                this.pending = null;
+                this.samples.push(sample);
+                if (this.samples.length >= this.batchSize) {
+                    this.flush();
+                } else if (this.flushTimer === null) {
+                    this.flushTimer = setTimeout(() => this.flush(), this.flushDelay);
+                }
+            },
+
+            flush: function () {
+                clearTimeout(this.flushTimer);
+                this.flushTimer = null;
+                if (!this.samples.length) {
+                    return;
+                }
+                const body = JSON.stringify({samples: this.samples});
+                this.samples = [];
+                const blob = new Blob([body], {type: "application/json"});
+                if (!(navigator.sendBeacon && navigator.sendBeacon("/client-metrics", blob))) {
+                    fetch("/client-metrics", {method: "POST", body: blob, keepalive: true}).catch(() => {});
+                }
+            },
+        },
+
+        label: function (labels, index) {
+            return labels.categories[labels.codes[index]];
+        },
+
+        render: function (index, rejectedView, viewerStyle, manifest, reviewedQueue) {
+            const noUpdate = window.dash_clientside.no_update;
+            if (!manifest || index === null || index === undefined || index >= manifest.size) {
+                return Array(10).fill(noUpdate);
+            }
+
+            const width = this.renditionWidth(manifest);
+            const imageSrc = this.imageSrc(manifest, index, width);
+            const gifSrc = manifest.gifs[manifest.subject.codes[index]];
+            const rejected = Boolean(rejectedView && rejectedView[String(index)]);
+
+            // Images shown are reported as reviewed with the next rejection
+            // toggle or checkpoint save
+            const queue = reviewedQueue || [];
+            const reviewed = queue.includes(index) ? noUpdate : queue.concat([index]);
+
+            // Let the current image be requested first
+            setTimeout(() => this.prefetch(manifest, index, width), 0);
+            this.latency.rendered(imageSrc, gifSrc);
+
+            return [
+                imageSrc,
+                gifSrc,
+                this.label(manifest.subject, index),
+                this.label(manifest.image_name, index),
+                this.label(manifest.repetition, index),
+                `${index + 1}/${manifest.size}`,
+                rejected ? "REJECTED" : "ACCEPTED",
+                rejected ? "danger" : "success",
+                rejected ? "Mark as Accepted" : "Mark as Rejected",
+                reviewed,
+            ];
+        },
+    }),
+});
+
+// Load events do not bubble, they are caught on the way down to the images
+(function (latency) {
+    document.addEventListener("keydown", (event) => latency.pressed(event), true);
+    document.addEventListener("load", (event) => latency.loaded(event), true);
+    document.addEventListener("visibilitychange", () => {
+        if (document.visibilityState === "hidden") {
+            latency.flush();
+        }
+    });
+})(window.dash_clientside.bqc.latency);
@@ -0,0 +1,7 @@
+from bqc_dash.session import sessions
+
+from .server import AutoSaver
+
+autosaver = AutoSaver()
+# Sessions expired or replaced are no longer saved
+sessions.on_drop(autosaver.drop)
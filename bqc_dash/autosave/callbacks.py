@@ -0,0 +1,65 @@
+from dash import Input, Output, State, no_update
+from dash.exceptions import PreventUpdate
+
+from bqc_dash.app import app
+from bqc_dash.autosave import autosaver
+from bqc_dash.autosave.server import get_autosave_path
+from bqc_dash.logger import logger
+from bqc_dash.session import sessions
+from bqc_dash.session.server import get_session_key
+
+
+@app.callback(
+    Output("auto-save-path", "data"),
+    [Input("tab-id-store", "data")],
+    [State("session-id-store", "data"), State("auto-save-path", "data")],
+    prevent_initial_call=True,
+)
+def initialize_auto_save_path(tab_id, session_id, current_path):
+    """Initialize auto-save path"""
+    if not tab_id or not session_id:
+        raise PreventUpdate
+    if current_path is not None:
+        logger.info(f"Using existing auto-save path: {current_path}")
+        return no_update
+
+    auto_save_path = get_autosave_path(
+        session_id.get("session-id"), tab_id.get("tab-id")
+    )
+    logger.info(f"Initializing new auto-save path: {auto_save_path}")
+    return auto_save_path
+
+
+@app.callback(
+    [
+        Output("reviewed-queue-store", "data", allow_duplicate=True),
+        Output("auto-save-status", "data"),
+    ],
+    [Input("auto-save-interval", "n_intervals")],
+    [
+        State("current-index-store", "data"),
+        State("reviewed-queue-store", "data"),
+        State("auto-save-path", "data"),
+        State("session-id-store", "data"),
+        State("tab-id-store", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def sync_auto_save(
+    n_intervals, current_index, reviewed_queue, auto_save_path, session_id, tab_id
+):
+    """Send the navigation state to the server and schedule the autosave"""
+    session = sessions.get(session_id, tab_id)
+    if session is None or not auto_save_path:
+        raise PreventUpdate
+
+    # Only memory is updated here, the checkpoint is written in background
+    if current_index is not None:
+        session.set_current_index(current_index)
+    session.mark_reviewed(reviewed_queue or [])
+
+    key = get_session_key(session_id, tab_id)
+    autosaver.schedule(key, session, auto_save_path)
+
+    queue = [] if reviewed_queue else no_update
+    return queue, autosaver.last_saved(key) or no_update
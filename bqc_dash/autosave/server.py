@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from bqc_dash.checkpoint.server import save_checkpoint
+from bqc_dash.logger import logger
+from bqc_dash.utils import get_cache_dir
+
+# Seconds without change before a modified session is saved, so that a burst
+# of rejections is written once
+autosave_delay = float(os.getenv("BQC_AUTOSAVE_DELAY", "5"))
+autosave_enabled = os.getenv("BQC_AUTOSAVE", "true").lower() == "true"
+
+
+def set_autosave(enabled=None, delay=None):
+    """Enable or disable the autosave and set its delay, in seconds"""
+    global autosave_enabled, autosave_delay
+    if enabled is not None:
+        autosave_enabled = enabled
+    if delay is not None:
+        autosave_delay = max(0.0, delay)
+
+
+def get_autosave_path(session_id, tab_id):
+    """Get the autosave checkpoint of a browser tab"""
+    autosave_dir = os.getenv("BQC_AUTOSAVE_DIR") or get_cache_dir("autosave")
+    return os.path.join(autosave_dir, f"{session_id}_{tab_id}_auto_save.json")
+
+
+class AutoSaver:
+    """
+    Saves modified sessions to their autosave checkpoint in the background.
+
+    Callbacks only register sessions, the checkpoints are written by a
+    single thread, once a session has not changed for autosave_delay
+    seconds. Checkpoints are written atomically, in the checkpoint mode.
+    """
+
+    def __init__(self):
+        # Session key -> [session, path, saved version, last save timestamp]
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def schedule(self, key, session, path):
+        """Save the session of key to path once it stops changing"""
+        if not autosave_enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not session or entry[1] != path:
+                # A new session is saved once it changes, not right away
+                self._entries[key] = [session, path, session.version, None]
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="autosave", daemon=True
+                )
+                self._thread.start()
+        self._wakeup.set()
+
+    def drop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def last_saved(self, key):
+        """Get the timestamp of the last autosave of key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[3] if entry else None
+
+    def _due(self):
+        """Get the entries modified and idle for autosave_delay seconds"""
+        now = time.monotonic()
+        due = []
+        wait = None
+        with self._lock:
+            for entry in self._entries.values():
+                session, _, saved_version, _ = entry
+                if session.version == saved_version or not session.images_path:
+                    continue
+                idle = now - (session.modified_at or now)
+                if idle >= autosave_delay:
+                    due.append(entry)
+                else:
+                    remaining = autosave_delay - idle
+                    wait = remaining if wait is None else min(wait, remaining)
+        return due, wait
+
+    def _save(self, entry):
+        session, path, _, _ = entry
+        with session.lock:
+            version = session.version
+            database = session.database
+            if database is not None:
+                # Bring in the changes made by the other workers
+                current = database.get_session(session.database_key, session)
+                if current is not session:
+                    logger.debug(f"Not autosaving {path}, its session was replaced")
+                    entry[2] = version
+                    return
+            save_checkpoint(
+                path,
+                session.images_path,
+                session.rejected_images,
+                session.current_index,
+                session.input_dir,
+                reviewed_images=session.reviewed_images,
+                dataset_id=session.dataset_id,
+            )
+        entry[2] = version
+        entry[3] = datetime.now().isoformat()
+        logger.debug(f"Autosaved session to {path}")
+
+    def _run(self):
+        while True:
+            due, wait = self._due()
+            for entry in due:
+                try:
+                    self._save(entry)
+                except Exception:
+                    logger.error(f"Error autosaving to {entry[1]}")
+                    logger.error("\n" + traceback.format_exc())
+                    # Not retried before the next change of the session
+                    entry[2] = entry[0].version
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
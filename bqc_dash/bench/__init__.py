@@ -0,0 +1,3 @@
+from .dataset import generate_dataset
+from .suite import BENCHMARKS, compare_reports, run_benchmarks
+from .load import Scenario, run_load_test
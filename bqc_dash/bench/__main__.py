@@ -0,0 +1,372 @@
+# python -m bqc_dash.bench
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+
+from bqc_dash.bench.dataset import generate_dataset
+
+
+def parse_size(value):
+    width, _, height = value.partition("x")
+    return int(width), int(height or width)
+
+
+def generate(args):
+    count = generate_dataset(
+        args.input_dir,
+        args.subjects,
+        repetitions=args.repetitions,
+        image_size=args.image_size,
+        gif_size=args.gif_kb * 1024,
+        missing_gif_every=args.missing_gif_every,
+        link=args.link,
+    )
+    print(f"Generated {count} images in {args.input_dir}", file=sys.stderr)
+
+
+def run(args):
+    # The scan index and metrics are written in a scratch cache, not the user one
+    os.environ.setdefault("BQC_CACHE_DIR", tempfile.mkdtemp(prefix="bqc_bench_cache_"))
+    from bqc_dash.bench.suite import BENCHMARKS, run_benchmarks
+    from bqc_dash.logger import set_logger_level
+
+    set_logger_level(args.log_level)
+    unknown = set(args.only or ()) - set(BENCHMARKS)
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    input_dir = args.input_dir
+    if input_dir is None:
+        input_dir = tempfile.mkdtemp(prefix="bqc_bench_data_")
+        generate_dataset(
+            input_dir, args.subjects, repetitions=args.repetitions, link=True
+        )
+    report = run_benchmarks(
+        input_dir, names=args.only, repeat=args.repeat, requests=args.requests
+    )
+    report["meta"]["subjects"] = args.subjects if args.input_dir is None else None
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(",")]
+
+
+def load(args):
+    from bqc_dash.bench.load import Scenario, run_load_test
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bqc_load_")
+    os.makedirs(work_dir, exist_ok=True)
+    input_dir = args.input_dir
+    if input_dir is None:
+        input_dir = os.path.join(work_dir, "data")
+        generate_dataset(
+            input_dir, args.subjects, repetitions=args.repetitions, link=True
+        )
+    scenario = Scenario(
+        think_time=args.think_ms / 1000,
+        back_rate=args.back_rate,
+        reject_rate=args.reject_rate,
+        checkpoint_every=args.checkpoint_every,
+    )
+
+    # One server per worker or thread count, the test server keeps its own
+    # cache, scan index and autosaves in the work directory
+    env_cache_dir = os.environ.get("BQC_CACHE_DIR")
+    os.environ["BQC_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    configurations = [(None, None)]
+    if args.url is None and args.server == "gunicorn":
+        configurations = [(workers, None) for workers in args.workers or [None]]
+    elif args.url is None and args.server == "waitress":
+        configurations = [(None, threads) for threads in args.threads or [None]]
+    runs = []
+    try:
+        for workers, threads in configurations:
+            runs.append(
+                run_load_test(
+                    input_dir,
+                    work_dir,
+                    args.concurrency,
+                    duration=args.duration,
+                    scenario=scenario,
+                    url=args.url,
+                    server=args.server,
+                    workers=workers,
+                    threads=threads,
+                    server_args=args.server_arg or (),
+                )
+            )
+    finally:
+        if env_cache_dir is None:
+            del os.environ["BQC_CACHE_DIR"]
+        else:
+            os.environ["BQC_CACHE_DIR"] = env_cache_dir
+
+    print(
+        f"{'workers':>7} {'threads':>7} {'reviewers':>9} {'req/s':>8} "
+        f"{'steps/s':>8} {'p50':>9} {'p99':>9} {'errors':>6}",
+        file=sys.stderr,
+    )
+    for run in runs:
+        for level in run["levels"]:
+            latency = level["latency"]
+            p50, p99 = (
+                (f"{latency[q] * 1e3:7.1f}ms" for q in ("p50", "p99"))
+                if latency["count"]
+                else ("-", "-")
+            )
+            print(
+                f"{run['workers'] or '-':>7} {run['threads'] or '-':>7} "
+                f"{level['reviewers']:>9} {level['throughput']:8.1f} "
+                f"{level['steps_per_second']:8.1f} {p50:>9} {p99:>9} "
+                f"{level['errors']:>6}",
+                file=sys.stderr,
+            )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "input_dir": os.path.abspath(input_dir),
+            "duration": args.duration,
+        },
+        "runs": runs,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args):
+    from bqc_dash.bench.suite import compare_reports
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.report) as f:
+        report = json.load(f)
+
+    regressions = []
+    print(f"{'benchmark':32} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name, (before, after, ratio) in compare_reports(baseline, report).items():
+        flag = ""
+        if args.fail_above and ratio > args.fail_above:
+            regressions.append(name)
+            flag = " !"
+        print(
+            f"{name:32} {before * 1e3:10.2f}ms {after * 1e3:10.2f}ms {ratio:7.2f}x{flag}"
+        )
+    if regressions:
+        sys.exit(
+            f"Slower than {args.fail_above}x the baseline: {', '.join(regressions)}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m bqc_dash.bench", description="BQC Dash benchmarks"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_generate = commands.add_parser(
+        "generate", help="Generate a synthetic input directory"
+    )
+    parser_generate.add_argument("input_dir", help="Directory to generate")
+    parser_generate.add_argument(
+        "--subjects", type=int, default=1000, help="Number of subjects (default: 1000)"
+    )
+    parser_generate.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of images per subject (default: 3)",
+    )
+    parser_generate.add_argument(
+        "--image-size",
+        type=parse_size,
+        default=(256, 256),
+        metavar="WxH",
+        help="Size of the images in pixels (default: 256x256)",
+    )
+    parser_generate.add_argument(
+        "--gif-kb", type=int, default=64, help="Size of the GIFs in KB (default: 64)"
+    )
+    parser_generate.add_argument(
+        "--missing-gif-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Leave out the GIF of every N-th subject (default: none)",
+    )
+    parser_generate.add_argument(
+        "--link",
+        action="store_true",
+        help="Hard link the images to a single file to save disk space",
+    )
+    parser_generate.set_defaults(function=generate)
+
+    parser_run = commands.add_parser("run", help="Run the benchmarks")
+    parser_run.add_argument(
+        "--input-dir",
+        help="Input directory to benchmark, generated in a temporary directory "
+        "with --subjects subjects if not set",
+    )
+    parser_run.add_argument(
+        "--subjects",
+        type=int,
+        default=1000,
+        help="Number of subjects of the generated dataset (default: 1000)",
+    )
+    parser_run.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of images per subject of the generated dataset (default: 3)",
+    )
+    parser_run.add_argument(
+        "--only", action="append", metavar="NAME", help="Run only this benchmark"
+    )
+    parser_run.add_argument(
+        "--repeat", type=int, default=5, help="Runs of each benchmark (default: 5)"
+    )
+    parser_run.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="Requests per run of the HTTP benchmarks (default: 200)",
+    )
+    parser_run.add_argument("--output", help="JSON report file (default: stdout)")
+    parser_run.add_argument(
+        "--log-level", default="WARNING", help="Logger level (default: WARNING)"
+    )
+    parser_run.set_defaults(function=run)
+
+    parser_load = commands.add_parser(
+        "load", help="Load test a server with concurrent simulated reviewers"
+    )
+    parser_load.add_argument(
+        "--server",
+        choices=["dev", "gunicorn", "waitress"],
+        default="waitress",
+        help="Server launched for the test (default: waitress)",
+    )
+    parser_load.add_argument(
+        "--workers",
+        type=parse_counts,
+        metavar="N[,N...]",
+        help="Gunicorn worker counts to test, one server each",
+    )
+    parser_load.add_argument(
+        "--threads",
+        type=parse_counts,
+        metavar="N[,N...]",
+        help="Waitress thread counts to test, one server each",
+    )
+    parser_load.add_argument(
+        "--server-arg",
+        action="append",
+        metavar="ARG",
+        help="Argument passed to the launched server, may be repeated, "
+        "for example --server-arg=--checkpoint-mode=journal",
+    )
+    parser_load.add_argument(
+        "--url",
+        help="Test the server running at this URL instead of launching one, "
+        "it must run on this machine to read the input directory",
+    )
+    parser_load.add_argument(
+        "--concurrency",
+        type=parse_counts,
+        default=[1, 2, 4, 8, 16],
+        metavar="N[,N...]",
+        help="Numbers of concurrent reviewers (default: 1,2,4,8,16)",
+    )
+    parser_load.add_argument(
+        "--duration",
+        type=float,
+        default=30,
+        help="Seconds of each level of concurrency (default: 30)",
+    )
+    parser_load.add_argument(
+        "--input-dir",
+        help="Input directory to review, generated in the work directory "
+        "with --subjects subjects if not set",
+    )
+    parser_load.add_argument(
+        "--subjects",
+        type=int,
+        default=1000,
+        help="Number of subjects of the generated dataset (default: 1000)",
+    )
+    parser_load.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of images per subject of the generated dataset (default: 3)",
+    )
+    parser_load.add_argument(
+        "--think-ms",
+        type=float,
+        default=250,
+        help="Milliseconds between two key presses of a reviewer (default: 250)",
+    )
+    parser_load.add_argument(
+        "--back-rate",
+        type=float,
+        default=0.1,
+        help="Share of the key presses going to the previous image (default: 0.1)",
+    )
+    parser_load.add_argument(
+        "--reject-rate",
+        type=float,
+        default=0.05,
+        help="Share of the images rejected (default: 0.05)",
+    )
+    parser_load.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=100,
+        help="Images reviewed between two checkpoint saves, 0 to never save "
+        "(default: 100)",
+    )
+    parser_load.add_argument(
+        "--work-dir",
+        help="Directory of the dataset, checkpoints, cache and server logs "
+        "(default: a temporary directory)",
+    )
+    parser_load.add_argument("--output", help="JSON report file (default: stdout)")
+    parser_load.set_defaults(function=load)
+
+    parser_compare = commands.add_parser(
+        "compare", help="Compare a report to a baseline report"
+    )
+    parser_compare.add_argument("baseline", help="Baseline JSON report")
+    parser_compare.add_argument("report", help="JSON report to compare")
+    parser_compare.add_argument(
+        "--fail-above",
+        type=float,
+        metavar="RATIO",
+        help="Exit with an error if a median is more than RATIO times the baseline",
+    )
+    parser_compare.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import random
+import struct
+import zlib
+
+# Smallest valid GIF, a single transparent pixel, padded with comments
+GIF_HEADER = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff"
+    b"!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00"
+)
+GIF_TRAILER = b";"
+
+
+def make_png(width, height, seed=0):
+    """
+    Make an RGB PNG of random pixels, which compress as poorly as the
+    photographic slices of real QC images, so that files have a realistic size.
+    """
+    rng = random.Random(seed)
+    row_size = width * 3
+    raw = b"".join(
+        b"\x00" + rng.getrandbits(8 * row_size).to_bytes(row_size, "little")
+        for _ in range(height)
+    )
+
+    def chunk(chunk_type, data):
+        crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", header),
+            chunk(b"IDAT", zlib.compress(raw, 1)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def make_gif(size):
+    """Make a GIF of about size bytes, padded with comment extension blocks"""
+    padding = max(0, size - len(GIF_HEADER) - len(GIF_TRAILER) - 3)
+    blocks = []
+    while padding > 0:
+        length = min(255, padding)
+        blocks.append(bytes([length]) + b"\x00" * length)
+        padding -= length + 1
+    comment = b"!\xfe" + b"".join(blocks) + b"\x00" if blocks else b""
+    return GIF_HEADER + comment + GIF_TRAILER
+
+
+def generate_dataset(
+    input_dir,
+    subjects,
+    repetitions=3,
+    image_size=(256, 256),
+    gif_size=64 * 1024,
+    missing_gif_every=0,
+    link=False,
+):
+    """
+    Generate an input directory of subjects * repetitions images.
+
+    The layout is the one bqc-generator writes, png/<subject>/<subject>_<rep>.png
+    and <subject>.gif. Every image has the same content, written once and
+    hard linked if link is set, which keeps large datasets small on disk.
+    Every missing_gif_every-th subject has no GIF. Returns the number of
+    images written.
+    """
+    png = make_png(*image_size)
+    gif = make_gif(gif_size)
+    os.makedirs(os.path.join(input_dir, "png"), exist_ok=True)
+    template = os.path.join(input_dir, ".template.png")
+    if link:
+        with open(template, "wb") as f:
+            f.write(png)
+
+    width = len(str(subjects - 1))
+    for number in range(subjects):
+        subject = f"sub-{number:0{width}d}"
+        subject_dir = os.path.join(input_dir, "png", subject)
+        os.makedirs(subject_dir, exist_ok=True)
+        for repetition in range(1, repetitions + 1):
+            path = os.path.join(subject_dir, f"{subject}_{repetition}.png")
+            if os.path.exists(path):
+                continue
+            if link:
+                os.link(template, path)
+            else:
+                with open(path, "wb") as f:
+                    f.write(png)
+        if not (missing_gif_every and number % missing_gif_every == 0):
+            with open(os.path.join(input_dir, f"{subject}.gif"), "wb") as f:
+                f.write(gif)
+    return subjects * repetitions
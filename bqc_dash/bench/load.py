@@ -0,0 +1,429 @@
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from bqc_dash.bench.suite import get_callback_payload
+
+TOAST = {"toasts": []}
+
+# Seconds between two polls of the scan progress and two autosave syncs,
+# the intervals of the layout
+SCAN_POLL_INTERVAL = 0.5
+AUTOSAVE_INTERVAL = 10.0
+
+
+class Scenario:
+    """Behaviour of a simulated reviewer"""
+
+    def __init__(
+        self,
+        think_time=0.25,
+        back_rate=0.1,
+        reject_rate=0.05,
+        checkpoint_every=100,
+        rendition_width=1024,
+    ):
+        # Seconds between two key presses
+        self.think_time = think_time
+        # Probability that a key press goes to the previous image
+        self.back_rate = back_rate
+        # Probability that the shown image is rejected
+        self.reject_rate = reject_rate
+        # Images reviewed between two checkpoint saves, 0 to never save
+        self.checkpoint_every = checkpoint_every
+        # Width of the image viewer in device pixels, if renditions are served
+        self.rendition_width = rendition_width
+
+
+class Reviewer:
+    """
+    Reviewer replaying what the browser sends to the server: the session
+    initialization, a scan, the navigation manifest, then the image and GIF
+    fetches, toggles, autosave syncs and checkpoint saves of a review.
+    """
+
+    def __init__(self, number, url, input_dir, work_dir, scenario, deadline):
+        self.number = number
+        self.address = urlsplit(url)
+        self.input_dir = input_dir
+        self.checkpoint_file = os.path.join(work_dir, f"checkpoint_{number}.json")
+        self.scenario = scenario
+        self.deadline = deadline
+        self.random = random.Random(number)
+        self.connection = None
+        # Latencies by operation, and failed requests
+        self.latencies = {}
+        self.errors = 0
+        self.steps = 0
+        self.session_id = None
+        self.tab_id = None
+        self.auto_save_path = None
+        self.manifest = None
+        # URLs in the cache of the browser, which are never requested again
+        self.fetched = set()
+
+    def _connect(self):
+        self.connection = http.client.HTTPConnection(
+            self.address.hostname, self.address.port, timeout=120
+        )
+
+    def request(self, operation, method, path, body=None):
+        """Send a request on the connection of the reviewer and time it"""
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            if self.connection is None:
+                self._connect()
+            start = time.perf_counter()
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                # The server closed the kept-alive connection, retry on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    self.errors += 1
+                    return None, None
+                continue
+            self.latencies.setdefault(operation, []).append(time.perf_counter() - start)
+            if response.status >= 400:
+                self.errors += 1
+            return response.status, data
+
+    def call(self, name, inputs, state=()):
+        """Call a Dash callback and get its response, None if not updated"""
+        body = json.dumps(get_callback_payload(name, inputs, state))
+        status, data = self.request(name, "POST", "/_dash-update-component", body)
+        if status != 200:
+            return None
+        return json.loads(data)["response"]
+
+    def fetch(self, url):
+        """Fetch a URL, unless the browser has cached it"""
+        if not url or url in self.fetched:
+            return
+        self.fetched.add(url)
+        operation = "gif" if url.startswith("/gifs/") else "image"
+        self.request(operation, "GET", url)
+
+    def start_session(self):
+        response = self.call("initialize_session_id", [None], [None, TOAST])
+        self.session_id = response["session-id-store"]["data"]
+        response = self.call(
+            "initialize_session_tab_id", [self.session_id], [None, TOAST]
+        )
+        self.tab_id = response["tab-id-store"]["data"]
+        response = self.call(
+            "initialize_auto_save_path", [self.tab_id], [self.session_id, None]
+        )
+        self.auto_save_path = response["auto-save-path"]["data"]
+
+    def scan(self):
+        """Scan the input directory and get the navigation manifest"""
+        ids = [self.session_id, self.tab_id]
+        start = time.perf_counter()
+        self.call("update_input_dir", [1], [self.input_dir, self.tab_id])
+        self.call("set_scan_ready", [self.input_dir])
+        self.call("scan_directory_data", [True], [self.input_dir, False, *ids, TOAST])
+        dataset = None
+        for n_intervals in range(1, int(600 / SCAN_POLL_INTERVAL)):
+            time.sleep(SCAN_POLL_INTERVAL)
+            response = self.call("poll_scan_progress", [n_intervals], [*ids, TOAST])
+            if response is None:
+                continue
+            if response["scan-progress-interval"]["disabled"]:
+                # A finished scan sends its dataset with the last poll, a
+                # failed or lost one only a toast
+                dataset = response.get("dataset-store", {}).get("data")
+                break
+        if dataset is None:
+            self.errors += 1
+            return False
+        self.latencies.setdefault("scan", []).append(time.perf_counter() - start)
+
+        response = self.call("update_navigation_manifest", [dataset], [*ids, TOAST])
+        self.manifest = response["navigation-manifest-store"]["data"]
+        return True
+
+    def image_url(self, index):
+        manifest = self.manifest
+        version = manifest["image_version"]
+        version = version["categories"][version["codes"][index]]
+        url = f"{manifest['image_prefix']}/{index}?v={version}"
+        renditions = manifest["renditions"]
+        if renditions and self.scenario.rendition_width:
+            widths = renditions["widths"]
+            width = next(
+                (w for w in widths if w >= self.scenario.rendition_width), widths[-1]
+            )
+            url += f"&w={width}&q={renditions['quality']}"
+        return url
+
+    def show(self, index):
+        """Fetch what the browser requests to show an image"""
+        manifest = self.manifest
+        size = manifest["size"]
+        subject = manifest["subject"]["codes"][index]
+        self.fetch(self.image_url(index))
+        self.fetch(manifest["gifs"][subject])
+        # Then the images ahead and behind, in the background
+        prefetch = manifest["prefetch"]
+        for offset in range(1, prefetch["ahead"] + 1):
+            self.fetch(self.image_url((index + offset) % size))
+        for offset in range(1, prefetch["behind"] + 1):
+            self.fetch(self.image_url((index - offset) % size))
+
+    def review(self):
+        ids = [self.session_id, self.tab_id]
+        scenario = self.scenario
+        size = self.manifest["size"]
+        index = self.manifest["current_index"] or 0
+        queue = []
+        toggles = syncs = saves = 0
+        last_sync = time.monotonic()
+        self.show(index)
+        while time.monotonic() < self.deadline:
+            time.sleep(scenario.think_time)
+            queue.append(index)
+            if self.random.random() < scenario.reject_rate:
+                toggles += 1
+                self.call(
+                    "toggle_rejection_status", [toggles, None], [index, queue, *ids]
+                )
+                queue = []
+            if scenario.back_rate and self.random.random() < scenario.back_rate:
+                index = (index - 1) % size
+            else:
+                index = (index + 1) % size
+            self.steps += 1
+            self.show(index)
+
+            if time.monotonic() - last_sync >= AUTOSAVE_INTERVAL:
+                syncs += 1
+                last_sync = time.monotonic()
+                self.call(
+                    "sync_auto_save",
+                    [syncs],
+                    [index, queue, self.auto_save_path, *ids],
+                )
+                queue = []
+            if (
+                scenario.checkpoint_every
+                and self.steps % scenario.checkpoint_every == 0
+            ):
+                saves += 1
+                self.call(
+                    "handle_checkpoint_save_operations",
+                    [saves],
+                    [index, queue, self.checkpoint_file, *ids, TOAST],
+                )
+                queue = []
+
+    def run(self):
+        try:
+            self.start_session()
+            while time.monotonic() < self.deadline:
+                # A failed scan is an error, not retried, as in the browser
+                if not self.scan():
+                    break
+                self.review()
+        except Exception as e:
+            print(f"Reviewer {self.number} failed: {e!r}", file=sys.stderr)
+            self.errors += 1
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+
+
+def percentile(values, q):
+    """Get the q-th percentile of sorted values, by the nearest rank"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else None,
+    }
+
+
+def run_level(url, input_dir, work_dir, reviewers, duration, scenario):
+    """
+    Run reviewers concurrent reviewers for duration seconds and get their
+    throughput and latency percentiles, in total and by operation.
+    """
+    start = time.monotonic()
+    deadline = start + duration
+    group = [
+        Reviewer(number, url, input_dir, work_dir, scenario, deadline)
+        for number in range(reviewers)
+    ]
+    threads = [
+        threading.Thread(target=reviewer.run, name=f"reviewer-{reviewer.number}")
+        for reviewer in group
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    operations = {}
+    for reviewer in group:
+        for operation, latencies in reviewer.latencies.items():
+            operations.setdefault(operation, []).extend(latencies)
+    requests = [
+        latency
+        for operation, latencies in operations.items()
+        if operation != "scan"
+        for latency in latencies
+    ]
+    steps = sum(reviewer.steps for reviewer in group)
+    return {
+        "reviewers": reviewers,
+        "duration": elapsed,
+        "requests": len(requests),
+        "errors": sum(reviewer.errors for reviewer in group),
+        "throughput": len(requests) / elapsed,
+        "steps_per_second": steps / elapsed,
+        "latency": summarize(requests),
+        "operations": {
+            operation: summarize(latencies)
+            for operation, latencies in sorted(operations.items())
+        },
+    }
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, process, timeout=60):
+    """Wait until the server answers, or raise if it exits or times out"""
+    address = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection(
+                address.hostname, address.port, timeout=5
+            )
+            connection.request("GET", "/_dash-layout")
+            if connection.getresponse().status == 200:
+                connection.close()
+                return
+            connection.close()
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server not answering at {url} after {timeout} s")
+
+
+def get_server_workers(server, workers=None):
+    """Get the number of workers of a server, the Gunicorn default if None"""
+    if server == "gunicorn" and workers is None:
+        # Imported here, the load test client does not need the application
+        from bqc_dash.main import get_gunicorn_workers
+
+        return get_gunicorn_workers()
+    return workers
+
+
+def launch_server(server, work_dir, workers=None, threads=None, server_args=()):
+    """
+    Launch bqc-dash on a free local port, logging into work_dir, and return
+    the process and its URL. Several gunicorn workers share their sessions
+    through a SQLite session store in work_dir.
+    """
+    workers = get_server_workers(server, workers)
+    port = get_free_port()
+    args = [sys.executable, "-m", "bqc_dash.main", "--server", server]
+    args += ["--host", "127.0.0.1", "--port", str(port)]
+    if workers is not None:
+        args += ["--workers", str(workers)]
+    has_store = any(arg.startswith("--session-store") for arg in server_args)
+    if server == "gunicorn" and workers > 1 and not has_store:
+        args += ["--session-store", "sqlite"]
+        args += ["--session-db", os.path.join(work_dir, "sessions.sqlite3")]
+    if threads is not None:
+        args += ["--threads", str(threads)]
+    args += list(server_args)
+
+    log = open(os.path.join(work_dir, f"server_{port}.log"), "wb")
+    process = subprocess.Popen(args, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for_server(url, process)
+    except Exception:
+        stop_server(process)
+        raise
+    return process, url
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_load_test(
+    input_dir,
+    work_dir,
+    concurrency,
+    duration=30,
+    scenario=None,
+    url=None,
+    server="waitress",
+    workers=None,
+    threads=None,
+    server_args=(),
+):
+    """
+    Run the reviewer scenario at each level of concurrency against the
+    server at url, or against a bqc-dash server launched for the test.
+    """
+    scenario = scenario or Scenario()
+    process = None
+    if url is None:
+        workers = get_server_workers(server, workers)
+        process, url = launch_server(server, work_dir, workers, threads, server_args)
+    else:
+        wait_for_server(url, None)
+    try:
+        levels = []
+        for reviewers in concurrency:
+            print(f"Running {reviewers} reviewers for {duration} s...", file=sys.stderr)
+            levels.append(
+                run_level(url, input_dir, work_dir, reviewers, duration, scenario)
+            )
+    finally:
+        if process is not None:
+            stop_server(process)
+    return {
+        "server": None if process is None else server,
+        "workers": workers,
+        "threads": threads,
+        "url": url,
+        "scenario": vars(scenario),
+        "levels": levels,
+    }
@@ -0,0 +1,377 @@
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Benchmarks by name, in the order they run
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark, a function of the context returning a timer"""
+
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return register
+
+
+def measure(run, repeat, setup=None):
+    """Time run, after setup, repeat times, and summarize the durations"""
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return {
+        "min": min(durations),
+        "median": statistics.median(durations),
+        "mean": (
+            statistics.fmean(durations)
+            if hasattr(statistics, "fmean")
+            else statistics.mean(durations)
+        ),
+        "max": max(durations),
+        "runs": durations,
+    }
+
+
+def get_callback_payload(name, inputs, state=()):
+    """
+    Build the request the browser posts to /_dash-update-component to call
+    the Dash callback named name, with the values of its inputs and states.
+    """
+    import bqc_dash.main  # noqa: F401, registers the callbacks
+    from bqc_dash.app import app
+
+    for output, callback in app.callback_map.items():
+        function = callback.get("callback")
+        function = getattr(function, "__wrapped__", function)
+        if getattr(function, "__name__", None) == name:
+            break
+    else:
+        raise KeyError(f"No callback {name}")
+    outputs = []
+    for spec in output.strip(".").split("..."):
+        component_id, prop = spec.rsplit(".", 1)
+        outputs.append({"id": component_id.split("@")[0], "property": prop})
+    inputs = [dict(i, value=v) for i, v in zip(callback["inputs"], inputs)]
+    state = [dict(s, value=v) for s, v in zip(callback["state"], state)]
+    return {
+        "output": output,
+        "outputs": outputs if output.startswith("..") else outputs[0],
+        "inputs": inputs,
+        "state": state,
+        "changedPropIds": [f"{inputs[0]['id']}.{inputs[0]['property']}"],
+    }
+
+
+class Context:
+    """Dataset, session and Flask client shared by the benchmarks"""
+
+    def __init__(self, input_dir, work_dir, repeat, requests):
+        self.input_dir = input_dir
+        self.work_dir = work_dir
+        self.repeat = repeat
+        # Requests timed by the route and callback benchmarks
+        self.requests = requests
+        self._images_path = None
+        self._client = None
+        self._manifest = None
+
+    @property
+    def images_path(self):
+        if self._images_path is None:
+            from bqc_dash.scan.server import scan_directory
+
+            self._images_path, _ = scan_directory(self.input_dir)
+        return self._images_path
+
+    @property
+    def client(self):
+        if self._client is None:
+            import bqc_dash.main  # noqa: F401, registers the callbacks
+            from bqc_dash.app import server
+
+            self._client = server.test_client()
+        return self._client
+
+    def call(self, name, inputs, state=()):
+        """Call a Dash callback by its function name through its HTTP route"""
+        payload = get_callback_payload(name, inputs, state)
+        response = self.client.post("/_dash-update-component", json=payload)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f"{name} failed with {response.status_code}")
+        return response.get_json() if response.status_code == 200 else None
+
+    @property
+    def manifest(self):
+        """Navigation manifest of a session of the dataset, in the store"""
+        if self._manifest is None:
+            from bqc_dash.checkpoint.server import Session
+            from bqc_dash.session import sessions
+
+            session = Session(self.input_dir, self.images_path, 0, {})
+            sessions.put(SESSION_ID, TAB_ID, session)
+            response = self.call(
+                "update_navigation_manifest",
+                [session.as_handle()],
+                [SESSION_ID, TAB_ID, {"toasts": []}],
+            )
+            self._manifest = response["response"]["navigation-manifest-store"]["data"]
+        return self._manifest
+
+
+SESSION_ID = {"session-id": "bench"}
+TAB_ID = {"tab-id": "bench"}
+
+
+@benchmark("scan_cold")
+def bench_scan_cold(context):
+    from bqc_dash.scan.server import ScanIndex, scan_directory
+
+    def setup():
+        index_path = ScanIndex.get_index_path(context.input_dir)
+        if os.path.exists(index_path):
+            os.unlink(index_path)
+
+    return measure(lambda: scan_directory(context.input_dir), context.repeat, setup)
+
+
+@benchmark("scan_warm")
+def bench_scan_warm(context):
+    from bqc_dash.scan.server import scan_directory
+
+    scan_directory(context.input_dir)
+    return measure(lambda: scan_directory(context.input_dir), context.repeat)
+
+
+@benchmark("path_table")
+def bench_path_table(context):
+    from bqc_dash.scan.server import PathTable
+
+    images_path = context.images_path
+    return measure(lambda: PathTable.parse(images_path), context.repeat)
+
+
+def bench_checkpoint(context, mode):
+    from bqc_dash.checkpoint.server import (
+        Session,
+        checkpoint_load,
+        save_checkpoint,
+        set_checkpoint_mode,
+    )
+
+    images_path = context.images_path
+    session = Session(context.input_dir, images_path, 0, {})
+    filename = os.path.join(context.work_dir, f"checkpoint_{mode}.json")
+    set_checkpoint_mode(mode)
+    state = {"index": 0}
+
+    def save():
+        # One more rejection per save, as a reviewer makes
+        session.toggle_rejected(state["index"] % len(images_path))
+        state["index"] += 1
+        save_checkpoint(
+            filename,
+            images_path,
+            session.rejected_images,
+            state["index"],
+            context.input_dir,
+            reviewed_images=session.reviewed_images,
+            dataset_id=session.dataset_id,
+        )
+
+    try:
+        save()
+        saves = measure(save, context.repeat)
+        loads = measure(lambda: checkpoint_load(filename), context.repeat)
+    finally:
+        set_checkpoint_mode("full")
+    return {"save": saves, "load": loads}
+
+
+for checkpoint_mode in ("full", "binary", "journal"):
+    benchmark(f"checkpoint_{checkpoint_mode}")(
+        lambda context, mode=checkpoint_mode: bench_checkpoint(context, mode)
+    )
+
+
+def bench_results(context, extension):
+    from bqc_dash.checkpoint.server import save_results
+    from bqc_dash.rejection.server import Bitset
+
+    images_path = context.images_path
+    rejected = Bitset.from_indices(len(images_path), range(0, len(images_path), 7))
+    results = {
+        "input_dir": context.input_dir,
+        "images_path": images_path,
+        "rejected_images": rejected,
+    }
+    filename = os.path.join(context.work_dir, f"results{extension}")
+
+    def setup():
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    return measure(lambda: save_results(filename, results), context.repeat, setup)
+
+
+benchmark("results_json")(lambda context: bench_results(context, ".json"))
+benchmark("results_csv")(lambda context: bench_results(context, ".csv"))
+
+
+@benchmark("results_parquet")
+def bench_results_parquet(context):
+    from bqc_dash.checkpoint.server import pq
+
+    if pq is None:
+        return None
+    return bench_results(context, ".parquet")
+
+
+def bench_serve(context, urls, cold):
+    from bqc_dash.image_display.server import image_cache
+
+    client = context.client
+
+    def fetch():
+        for url in urls:
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} failed with {response.status_code}")
+
+    setup = image_cache.clear if cold else fetch
+    result = measure(fetch, context.repeat, setup)
+    result["requests"] = len(urls)
+    return result
+
+
+@benchmark("serve_image_cold")
+def bench_serve_image_cold(context):
+    manifest = context.manifest
+    count = min(context.requests, manifest["size"])
+    urls = [f"{manifest['image_prefix']}/{index}" for index in range(count)]
+    return bench_serve(context, urls, cold=True)
+
+
+@benchmark("serve_image_warm")
+def bench_serve_image_warm(context):
+    manifest = context.manifest
+    count = min(context.requests, manifest["size"])
+    urls = [f"{manifest['image_prefix']}/{index}" for index in range(count)]
+    return bench_serve(context, urls, cold=False)
+
+
+@benchmark("serve_gif")
+def bench_serve_gif(context):
+    urls = [url for url in context.manifest["gifs"] if url][: context.requests]
+    return bench_serve(context, urls, cold=True)
+
+
+@benchmark("navigation_chain")
+def bench_navigation_chain(context):
+    """
+    Server side of reviewing images: each step rejects the image, as the
+    toggle key does, then syncs the navigation state, as the autosave
+    interval does. Moving between images runs in the browser only.
+    """
+    manifest = context.manifest
+    steps = min(context.requests, manifest["size"])
+    autosave_path = os.path.join(context.work_dir, "autosave.json")
+
+    def review():
+        for index in range(steps):
+            context.call(
+                "toggle_rejection_status",
+                [index + 1, None],
+                [index, [], SESSION_ID, TAB_ID],
+            )
+            context.call(
+                "sync_auto_save",
+                [index + 1],
+                [index, [index], autosave_path, SESSION_ID, TAB_ID],
+            )
+
+    result = measure(review, context.repeat)
+    result["requests"] = 2 * steps
+    return result
+
+
+def get_version():
+    try:
+        from importlib.metadata import version
+
+        return version("bqc_dash")
+    except Exception:
+        return None
+
+
+def run_benchmarks(input_dir, names=None, repeat=5, requests=200, work_dir=None):
+    """
+    Run the benchmarks on a generated input directory.
+
+    Returns a JSON-serializable report, with the median, mean, min and max
+    duration in seconds of each benchmark, and per request for the ones
+    timing HTTP requests.
+    """
+    from bqc_dash.autosave.server import set_autosave
+
+    # Autosaves would write in the background of the timed callbacks
+    set_autosave(enabled=False)
+    work_dir = work_dir or tempfile.mkdtemp(prefix="bqc_bench_")
+    context = Context(input_dir, work_dir, repeat, requests)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "version": get_version(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "input_dir": os.path.abspath(input_dir),
+            "images": len(context.images_path),
+            "repeat": repeat,
+            "requests": requests,
+        },
+        "benchmarks": {},
+    }
+    for name, function in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        result = function(context)
+        if result is None:
+            print(f"Skipped {name}", file=sys.stderr)
+            continue
+        for timing in result.values() if "median" not in result else [result]:
+            if "requests" in result:
+                timing["median_per_request"] = timing["median"] / result["requests"]
+        report["benchmarks"][name] = result
+    return report
+
+
+def iter_timings(report):
+    """Iterate over the timings of a report as (name, median) pairs"""
+    for name, result in report["benchmarks"].items():
+        if "median" in result:
+            yield name, result["median"]
+        else:
+            for part, timing in result.items():
+                yield f"{name}.{part}", timing["median"]
+
+
+def compare_reports(baseline, report):
+    """Get the ratio of the median of each timing to the baseline one"""
+    baseline_timings = dict(iter_timings(baseline))
+    return {
+        name: (baseline_timings[name], median, median / baseline_timings[name])
+        for name, median in iter_timings(report)
+        if baseline_timings.get(name)
+    }
@@ -12,44 +12,42 @@ from bqc_dash.checkpoint.server import (
     save_results,
 )
 from bqc_dash.exceptions.callbacks import exception_callback
+from bqc_dash.session import sessions
+from bqc_dash.session.callbacks import get_current_session
 from bqc_dash.toaster.callbacks import send_notification, ToastException
 
 
 @app.callback(
-    Output("toast-store", "data", allow_duplicate=True),
+    [
+        Output("toast-store", "data", allow_duplicate=True),
+        Output("reviewed-queue-store", "data", allow_duplicate=True),
+    ],
     [
         Input("save-checkpoint-btn", "n_clicks"),
-        # Input("auto-save-interval", "n_intervals"),
     ],
     [
-        State("images-path-store", "data"),
-        State("rejected-images-store", "data"),
         State("current-index-store", "data"),
-        State("input-dir-store", "data"),
+        State("reviewed-queue-store", "data"),
         State("checkpoint-file-input", "value"),
+        State("session-id-store", "data"),
+        State("tab-id-store", "data"),
         State("toast-store", "data"),
-        # State("auto-save-path", "data"),
     ],
     prevent_initial_call=True,
     on_error=exception_callback,
 )
 def handle_checkpoint_save_operations(
     save_clicks,
-    images_path,
-    rejected_indices,
     current_index,
-    input_dir,
+    reviewed_queue,
     checkpoint_file,
+    session_id,
+    tab_id,
     toast_data,
-    # auto_save_path,
 ):
     """Handle save checkpoint and save results operations"""
     logger.debug("Checkpoint save operation triggered")
 
-    # if ctx.triggered_id == "auto-save-interval":
-    #     logger.debug("Auto-save triggered")
-    #     checkpoint_file = auto_save_path
-
     if not save_clicks:
         logger.debug("No save clicks detected")
         raise PreventUpdate
@@ -61,25 +59,31 @@ def handle_checkpoint_save_operations(
             "warning",
             duration=5,
         )(toast_data)
-        return notification
+        return notification, no_update
+
+    session = get_current_session(session_id, tab_id, toast_data)
+    session.set_current_index(current_index)
+    session.mark_reviewed(reviewed_queue or [])
 
     # Handle invalid inputs
-    if not images_path or len(images_path) == 0:
+    if not session.images_path or len(session.images_path) == 0:
         logger.warning("No images to save")
         notification = send_notification(
             "No images to save",
             "warning",
             duration=5,
         )(toast_data)
-        return notification
+        return notification, no_update
 
     try:
         save_checkpoint(
             checkpoint_file,
-            images_path,
-            rejected_indices,
+            session.images_path,
+            session.rejected_images,
             current_index,
-            input_dir,
+            session.input_dir,
+            reviewed_images=session.reviewed_images,
+            dataset_id=session.dataset_id,
         )
     except Exception as e:
         logger.critical("Error saving checkpoint")
@@ -96,26 +100,21 @@ def handle_checkpoint_save_operations(
         "success",
         duration=5,
     )(toast_data)
-    return notification
+    return notification, []
 
 
 @app.callback(
     [
         Output("input-dir-store", "data", allow_duplicate=True),
-        Output("images-path-store", "data", allow_duplicate=True),
-        Output("current-index-store", "data", allow_duplicate=True),
-        Output("rejected-images-store", "data", allow_duplicate=True),
+        Output("dataset-store", "data", allow_duplicate=True),
         Output("toast-store", "data", allow_duplicate=True),
     ],
     [
         Input("load-checkpoint-btn", "n_clicks"),
     ],
     [
-        State("images-path-store", "data"),
-        State("rejected-images-store", "data"),
-        State("current-index-store", "data"),
-        State("input-dir-store", "data"),
         State("checkpoint-file-input", "value"),
+        State("session-id-store", "data"),
         State("tab-id-store", "data"),
         State("toast-store", "data"),
     ],
@@ -131,11 +130,8 @@ def handle_checkpoint_save_operations(
 )
 def handle_checkpoint_load_operations(
     save_clicks,
-    images_path,
-    rejected_indices,
-    current_index,
-    input_dir,
     checkpoint_file,
+    session_id,
     tab_id,
     toast_data,
 ):
@@ -173,15 +169,11 @@ def handle_checkpoint_load_operations(
         duration=5,
     )(toast_data)
 
-    # Update the session with the loaded content
-    content = (
-        content.input_dir,
-        content.images_path,
-        content.current_index,
-        content.rejected_images,
-    )
+    # Replace the session with the loaded content
+    sessions.put(session_id, tab_id, content)
 
-    return content + (notification,)
+    # The navigation manifest of the new dataset restores the current index
+    return content.input_dir, content.as_handle(), notification
 
 
 @app.callback(
@@ -190,11 +182,9 @@ def handle_checkpoint_load_operations(
         Input("save-results-btn", "n_clicks"),
     ],
     [
-        State("images-path-store", "data"),
-        State("rejected-images-store", "data"),
-        State("current-index-store", "data"),
-        State("input-dir-store", "data"),
         State("checkpoint-file-input", "value"),
+        State("session-id-store", "data"),
+        State("tab-id-store", "data"),
         State("toast-store", "data"),
     ],
     prevent_initial_call=True,
@@ -207,11 +197,9 @@ def handle_checkpoint_load_operations(
 )
 def handle_save_results_operations(
     save_clicks,
-    images_path,
-    rejected_indices,
-    current_index,
-    input_dir,
     checkpoint_file,
+    session_id,
+    tab_id,
     toast_data,
 ):
     """Handle save checkpoint and save results operations"""
@@ -222,14 +210,20 @@ def handle_save_results_operations(
         logger.debug("No save clicks detected")
         raise PreventUpdate
 
-    if not images_path or len(images_path) == 0:
+    session = sessions.get(session_id, tab_id)
+    if session is None or not session.images_path:
         logger.warning("No images to save")
-        return "No images to save", True, "warning"
+        notification = send_notification(
+            "No images to save",
+            "warning",
+            duration=5,
+        )(toast_data)
+        return notification
 
     results = {
-        "input_dir": input_dir,
-        "images_path": images_path,
-        "rejected_images": rejected_indices,
+        "input_dir": session.input_dir,
+        "images_path": session.images_path,
+        "rejected_images": session.rejected_images,
     }
 
     try:
@@ -1,10 +1,53 @@
 import json
+import mmap
+import struct
+import sys
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
 import os
+import threading
+import time
+import uuid
+import zlib
+import hashlib
+import numpy as np
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 from bqc_dash.logger import logger
-from bqc_dash.utils import get_information_from_path
+from bqc_dash.rejection.server import Bitset
+from bqc_dash.scan.server import get_path_table
+from bqc_dash.utils import write_atomic
+
+# JSON checkpoints store the flags as base64 bitsets since version 2, the
+# checkpoints without a version store a dict of rejected images
+JSON_VERSION = 2
+
+# Binary checkpoints start with the magic, the format version and the length
+# of a JSON header giving the length of each section that follows
+BINARY_MAGIC = b"BQCK"
+BINARY_VERSION = 1
+BINARY_PREFIX = struct.Struct("<4sHI")
+
+# Results are written in the format given by the extension of their file, in
+# chunks of rows so that memory stays bounded on large datasets
+RESULTS_EXTENSIONS = {
+    "json": (".json", ".jsonl"),
+    "csv": (".csv",),
+    "parquet": (".parquet",),
+}
+RESULTS_CHUNK_ROWS = 65536
 
 
 class Session:
@@ -15,32 +58,233 @@ class Session:
         current_index,
         rejected_images,
         timestamp=None,
+        reviewed_images=None,
     ):
         self.input_dir = input_dir
         self.images_path = images_path
-        self.rejected_images = rejected_images
+        self.rejected_images = self._as_bitset(rejected_images)
+        self.reviewed_images = self._as_bitset(reviewed_images)
         self.current_index = current_index
         self.timestamp = timestamp or datetime.now().isoformat()
+        # Identifies this session in memory, a reloaded checkpoint gets a new one
+        self.id = uuid.uuid4().hex
+        # Number of changes and time of the last one, for the autosave
+        self.version = 0
+        self.modified_at = None
+        # Held while the image paths are replaced or the session is saved
+        self.lock = threading.RLock()
+        # Session database the changes are written to, if any, with the key,
+        # snapshot generation and decision revision of the session in it.
+        # Without a database, the generation counts the image path changes
+        self.database = None
+        self.database_key = None
+        self.generation = None
+        self.revision = 0
+
+    def _as_bitset(self, images):
+        """Convert the legacy rejection dict to a bitset"""
+        if isinstance(images, Bitset):
+            return images
+        return Bitset.from_dict(len(self.images_path), images)
+
+    def touch(self):
+        """Record a change of the session"""
+        self.version += 1
+        self.modified_at = time.monotonic()
+
+    @contextmanager
+    def synced(self, snapshot=False):
+        """
+        Change the session, through its session database if it has one.
+
+        The session is first brought up to date from the database, then the
+        indices added to the yielded set, or the whole session if snapshot,
+        are written back in the same transaction, so that concurrent workers
+        never lose a change.
+        """
+        with self.lock:
+            if self.database is None:
+                yield set()
+            else:
+                with self.database.sync(self, snapshot) as changed:
+                    yield changed
+
+    @property
+    def dataset_id(self):
+        """Identity of the image paths, the same in every worker"""
+        return f"{self.id}:{self.generation}"
+
+    def set_images_path(self, images_path):
+        """Replace the image paths, keeping the flags of the common prefix"""
+        with self.synced(snapshot=True):
+            self.images_path = images_path
+            self.rejected_images.resize(len(images_path))
+            self.reviewed_images.resize(len(images_path))
+            if self.database is None:
+                self.generation = (self.generation or 0) + 1
+        self.touch()
+
+    def set_current_index(self, index):
+        if index != self.current_index:
+            with self.synced():
+                self.current_index = index
+            self.touch()
+
+    def toggle_rejected(self, index):
+        """Flip the rejection of an image and return its new value"""
+        with self.synced() as changed:
+            rejected = self.rejected_images.toggle(index)
+            changed.add(index)
+        self.touch()
+        return rejected
+
+    def mark_reviewed(self, indices):
+        """Mark the images shown to the reviewer"""
+        indices = [
+            index
+            for index in indices
+            if 0 <= index < len(self.reviewed_images)
+            and not self.reviewed_images.get(index)
+        ]
+        if not indices:
+            return
+        with self.synced() as changed:
+            for index in indices:
+                self.reviewed_images.set(index)
+            changed.update(indices)
+        self.touch()
 
     def as_dict(self):
         return {
+            "version": JSON_VERSION,
             "timestamp": self.timestamp,
             "input_dir": self.input_dir,
             "current_index": self.current_index,
-            "rejected_images": self.rejected_images,
+            "rejected_bits": self.rejected_images.to_base64(),
+            "reviewed_bits": self.reviewed_images.to_base64(),
             "images_path": self.images_path,
         }
 
     @classmethod
     def from_dict(cls, data):
+        if isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+            return cls.from_bytes(data)
+        version = data.get("version", 1)
+        if version > JSON_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {version}")
+        size = len(data["images_path"])
+        if "rejected_bits" in data:
+            rejected_images = Bitset.from_base64(size, data["rejected_bits"])
+            reviewed_images = Bitset.from_base64(size, data["reviewed_bits"])
+        else:
+            # Checkpoints written before the bitsets store a dict of flags
+            rejected_images = data["rejected_images"]
+            reviewed_images = None
         return cls(
             timestamp=data.get("timestamp"),
             input_dir=data["input_dir"],
             images_path=data["images_path"],
             current_index=data["current_index"],
-            rejected_images=data["rejected_images"],
+            rejected_images=rejected_images,
+            reviewed_images=reviewed_images,
         )
 
+    def as_bytes(self):
+        """
+        Encode the session as a binary checkpoint.
+
+        Image paths are stored as a code into a dictionary of distinct
+        directories and a file name, the flags as the raw bitsets.
+        """
+        directories = {}
+        codes = array("I")
+        names = []
+        for image_path in self.images_path:
+            split = image_path.rfind("/") + 1
+            directory = image_path[:split]
+            codes.append(directories.setdefault(directory, len(directories)))
+            names.append(image_path[split:])
+        if sys.byteorder != "little":
+            codes.byteswap()
+
+        # Paths are repetitive and compress well, the bitsets are read as is
+        sections = {
+            "directories": zlib.compress("\0".join(directories).encode(), 1),
+            "codes": zlib.compress(codes.tobytes(), 1),
+            "names": zlib.compress("\0".join(names).encode(), 1),
+            "rejected": bytes(self.rejected_images.data),
+            "reviewed": bytes(self.reviewed_images.data),
+        }
+        header = json.dumps(
+            {
+                "timestamp": self.timestamp,
+                "input_dir": self.input_dir,
+                "current_index": self.current_index,
+                "size": len(self.images_path),
+                "sections": [[name, len(data)] for name, data in sections.items()],
+                "compressed": ["directories", "codes", "names"],
+            }
+        ).encode()
+        prefix = BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION, len(header))
+        return b"".join([prefix, header, *sections.values()])
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        """Decode a binary checkpoint, from bytes or a memory map"""
+        magic, version, header_size = BINARY_PREFIX.unpack_from(buffer)
+        if magic != BINARY_MAGIC:
+            raise ValueError("Not a binary checkpoint")
+        if version != BINARY_VERSION:
+            raise ValueError(f"Unsupported binary checkpoint version {version}")
+
+        view = memoryview(buffer)
+        sections = {}
+        try:
+            offset = BINARY_PREFIX.size
+            header = json.loads(bytes(view[offset : offset + header_size]))
+            offset += header_size
+            for name, length in header["sections"]:
+                sections[name] = view[offset : offset + length]
+                offset += length
+            if offset > len(view):
+                raise ValueError("Truncated binary checkpoint")
+
+            for name in header["compressed"]:
+                sections[name] = zlib.decompress(sections[name])
+
+            size = header["size"]
+            codes = array("I")
+            codes.frombytes(sections["codes"])
+            if sys.byteorder != "little":
+                codes.byteswap()
+            directories = sections["directories"].decode().split("\0")
+            names = sections["names"].decode().split("\0") if size else []
+            images_path = [directories[code] + name for code, name in zip(codes, names)]
+
+            return cls(
+                timestamp=header["timestamp"],
+                input_dir=header["input_dir"],
+                images_path=images_path,
+                current_index=header["current_index"],
+                rejected_images=Bitset(size, sections["rejected"]),
+                reviewed_images=Bitset(size, sections["reviewed"]),
+            )
+        finally:
+            # Bitsets copy their bytes, the memory map can be closed, also
+            # when decoding failed so that the decoding error is raised
+            for section in sections.values():
+                if isinstance(section, memoryview):
+                    section.release()
+            view.release()
+
+    def as_handle(self):
+        """Small handle of the session, exchanged with the browser"""
+        return {
+            "id": self.id,
+            "size": len(self.images_path),
+            "timestamp": self.timestamp,
+        }
+
     def __repr__(self):
         return f"Session(input_dir={self.input_dir}, images_path={self.images_path}, current_index={self.current_index}, rejected_images={self.rejected_images}, timestamp={self.timestamp})"
 
@@ -52,27 +296,319 @@ class Session:
         return _str
 
 
-def save_session(filename, session):
-    with open(filename, "w") as f:
+def save_session(filename, session, binary=False):
+    # A crash during the write leaves the previous checkpoint intact
+    if binary:
+        data = session.as_bytes()
+        write_atomic(filename, lambda f: f.write(data), mode="wb")
+    else:
         data = session.as_dict()
-        timestamp = data.get("timestamp")
-        json.dump(data, f, indent=2)
-    return f"Checkpoint saved [{timestamp}]"
+        write_atomic(filename, lambda f: json.dump(data, f, indent=2))
+    return f"Checkpoint saved [{session.timestamp}]"
 
 
 def load_session(filename):
-    with open(filename, "r") as f:
+    with open(filename, "rb") as f:
+        # Binary checkpoints are decoded straight from the page cache
+        if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return Session.from_bytes(buffer)
+        f.seek(0)
         data = json.load(f)
-    return Session.from_dict(data)
+    session = Session.from_dict(data)
+    if "journal" in data:
+        journal_path = os.path.join(os.path.dirname(filename), data["journal"])
+        replay_journal(journal_path, data["generation"], session)
+    return session
+
+
+# Checkpoint files are written whole as JSON ("full") or in the binary format
+# ("binary"), or written once and followed by a journal of the changes of
+# each save ("journal")
+CHECKPOINT_MODES = ("full", "binary", "journal")
+checkpoint_mode = os.getenv("BQC_CHECKPOINT_MODE", "full")
+
+# Number of saves appended to a journal before it is folded into the manifest
+JOURNAL_COMPACT_EVERY = 500
+
+
+def set_checkpoint_mode(mode):
+    """Set how checkpoints are written, one of CHECKPOINT_MODES"""
+    global checkpoint_mode
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+    checkpoint_mode = mode
+
+
+def replay_journal(journal_path, generation, session):
+    """
+    Apply the events of a checkpoint journal to its manifest session, and
+    return the number of events applied.
+    """
+    try:
+        with open(journal_path, "r") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        logger.warning(f"Checkpoint journal {journal_path} not found")
+        return 0
+
+    applied = 0
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # Last line cut short by a crash during the append
+            logger.warning(f"Ignoring truncated event in {journal_path}")
+            break
+        # Events of a previous manifest, left by a crash during compaction
+        if event["generation"] != generation:
+            continue
+        for index in event["rejected"]:
+            session.rejected_images.set(index)
+        for index in event["accepted"]:
+            session.rejected_images.set(index, False)
+        for index in event["reviewed"]:
+            session.reviewed_images.set(index)
+        session.current_index = event["current_index"]
+        session.timestamp = event["timestamp"]
+        applied += 1
+    logger.debug(f"{applied} journal events replayed from {journal_path}")
+    return applied
+
+
+def get_journal_database():
+    """Get the session database sharing the journal states, if any"""
+    # Imported here, the session store depends on this module
+    from bqc_dash.session.server import get_session_database
+
+    return get_session_database()
+
+
+def get_dataset_id(images_path):
+    """Identity of image paths saved without their session"""
+    digest = hashlib.sha1()
+    for path in images_path:
+        digest.update(path.encode("utf-8", "surrogateescape") + b"\0")
+    return digest.hexdigest()
+
+
+class CheckpointJournal:
+    """
+    Checkpoint written as a manifest and an append-only journal.
+
+    The manifest holds the whole session and is written once. Each save
+    then appends the rejections, acceptances and reviews since the previous
+    save, as one line of JSON, so that a save costs O(changes) instead of a
+    rewrite of every image path.
+
+    Saves hold a lock on the journal file, so that the workers of a server
+    can save the same checkpoint. A worker finding the files changed since
+    its own last save reloads the saved state before appending: from the
+    session database if there is one, where each save stores it, or from
+    the files otherwise.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal_path = f"{filename}.journal"
+        self.generation = None
+        self.dataset_id = None
+        self.events = 0
+        # State of the last save, the next event holds the differences
+        self._rejected = None
+        self._reviewed = None
+        self._current_index = None
+        # Files as this process left them after its last save
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Open the journal for appending, locked against the other workers"""
+        with self._lock, open(self.journal_path, "a") as journal:
+            if fcntl is not None:
+                fcntl.flock(journal, fcntl.LOCK_EX)
+            yield journal
+
+    def _get_stamp(self, journal):
+        try:
+            manifest = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (
+            manifest.st_ino,
+            manifest.st_mtime_ns,
+            manifest.st_size,
+            os.fstat(journal.fileno()).st_size,
+        )
 
+    def save(self, session, dataset_id):
+        with self._locked() as journal:
+            stamp = self._get_stamp(journal)
+            if stamp is not None and stamp != self._stamp:
+                self.reload(stamp)
+            if (
+                stamp is None
+                or self.dataset_id != dataset_id
+                or self._rejected.size != len(session.images_path)
+                or self.events >= JOURNAL_COMPACT_EVERY
+            ):
+                self.compact(session, dataset_id, journal)
+            else:
+                self.append(session, journal)
+            previous, self._stamp = self._stamp, self._get_stamp(journal)
+            if self._stamp != previous:
+                self.share()
+        return f"Checkpoint saved [{session.timestamp}]"
+
+    def share(self):
+        """Store the state of the last save in the session database, if any"""
+        database = get_journal_database()
+        if database is None:
+            return
+        database.put_journal_state(
+            os.path.abspath(self.filename),
+            {
+                "stamp": self._stamp,
+                "generation": self.generation,
+                "dataset_id": self.dataset_id,
+                "events": self.events,
+                "current_index": self._current_index,
+                "rejected": self._rejected,
+                "reviewed": self._reviewed,
+            },
+        )
 
-def save_checkpoint(filename, images_path, rejected_images, current_index, input_dir):
+    def reload(self, stamp):
+        """Read the last saved state, written by another worker"""
+        database = get_journal_database()
+        if database is not None:
+            state = database.get_journal_state(os.path.abspath(self.filename), stamp)
+            if state is not None:
+                self.generation = state["generation"]
+                self.dataset_id = state["dataset_id"]
+                self.events = state["events"]
+                self._rejected = state["rejected"]
+                self._reviewed = state["reviewed"]
+                self._current_index = state["current_index"]
+                return
+
+        self.generation = self.dataset_id = None
+        try:
+            with open(self.filename, "rb") as f:
+                if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                    return
+                f.seek(0)
+                data = json.load(f)
+            if "generation" not in data:
+                return
+            saved = Session.from_dict(data)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Rewriting unreadable checkpoint {self.filename}: {e}")
+            return
+        self.events = replay_journal(self.journal_path, data["generation"], saved)
+        self.generation = data["generation"]
+        self.dataset_id = data.get("dataset_id")
+        self._rejected = saved.rejected_images
+        self._reviewed = saved.reviewed_images
+        self._current_index = saved.current_index
+        logger.debug(f"Checkpoint journal {self.journal_path} reloaded")
+
+    def compact(self, session, dataset_id, journal):
+        """Write the whole session as the new manifest and empty the journal"""
+        # The new generation tells the events of the old manifest apart, if
+        # the process dies between the rename and the truncation
+        self.generation = uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        data = session.as_dict()
+        data["journal"] = os.path.basename(self.journal_path)
+        data["generation"] = self.generation
+        data["dataset_id"] = dataset_id
+        write_atomic(self.filename, lambda f: json.dump(data, f))
+        journal.truncate(0)
+
+        self.events = 0
+        self._rejected = session.rejected_images.copy()
+        self._reviewed = session.reviewed_images.copy()
+        self._current_index = session.current_index
+        logger.debug(f"Checkpoint manifest written to {self.filename}")
+
+    def append(self, session, journal):
+        """Append the changes since the last save to the journal"""
+        rejected = session.rejected_images
+        reviewed = session.reviewed_images
+        flipped = list((rejected ^ self._rejected).indices())
+        newly_reviewed = list((reviewed ^ self._reviewed).indices())
+        if (
+            not flipped
+            and not newly_reviewed
+            and session.current_index == self._current_index
+        ):
+            return
+
+        event = {
+            "generation": self.generation,
+            "timestamp": session.timestamp,
+            "current_index": session.current_index,
+            "rejected": [index for index in flipped if rejected.get(index)],
+            "accepted": [index for index in flipped if not rejected.get(index)],
+            "reviewed": newly_reviewed,
+        }
+        journal.write(json.dumps(event, separators=(",", ":")) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+        self.events += 1
+        self._rejected = rejected.copy()
+        self._reviewed = reviewed.copy()
+        self._current_index = session.current_index
+        logger.debug(f"{len(flipped)} changes appended to {self.journal_path}")
+
+
+# Journals by checkpoint file, they hold the state of the last save
+journals = {}
+journals_lock = threading.Lock()
+
+
+def get_journal(filename):
+    key = os.path.abspath(filename)
+    with journals_lock:
+        journal = journals.get(key)
+        if journal is None:
+            journal = journals[key] = CheckpointJournal(filename)
+        return journal
+
+
+def save_checkpoint(
+    filename,
+    images_path,
+    rejected_images,
+    current_index,
+    input_dir,
+    reviewed_images=None,
+    dataset_id=None,
+):
+    """
+    Save a checkpoint in the checkpoint mode. dataset_id identifies the image
+    paths, Session.dataset_id, so that a journal is only appended to while
+    they stay the same.
+    """
     if not images_path or len(images_path) == 0:
         logger.warning("No images to save in checkpoint")
         raise Warning("No images to save in checkpoint")
 
-    session = Session(input_dir, images_path, current_index, rejected_images)
-    return save_session(filename, session)
+    session = Session(
+        input_dir,
+        images_path,
+        current_index,
+        rejected_images,
+        reviewed_images=reviewed_images,
+    )
+    if checkpoint_mode == "journal":
+        if dataset_id is None:
+            dataset_id = get_dataset_id(images_path)
+        return get_journal(filename).save(session, dataset_id)
+    return save_session(filename, session, binary=checkpoint_mode == "binary")
 
 
 def checkpoint_load(filename):
@@ -84,6 +620,86 @@ def checkpoint_load(filename):
 # Function to save results
 
 
+class ResultsWriter:
+    """Write a results table chunk by chunk, as JSON lines, CSV or Parquet"""
+
+    def __init__(self, filename, results_format):
+        self.filename = filename
+        self.format = results_format
+        self.rows = 0
+        # The CSV header and the Parquet schema come with the first chunk
+        self.chunks = 0
+        self._parquet_writer = None
+        self._file = None
+        if results_format != "parquet":
+            self._file = open(filename, "w", newline="")
+
+    def write(self, frame):
+        if self.format == "json":
+            if len(frame):
+                text = frame.to_json(orient="records", lines=True, date_format="iso")
+                self._file.write(text if text.endswith("\n") else text + "\n")
+        elif self.format == "csv":
+            frame.to_csv(self._file, header=self.chunks == 0, index=False)
+        else:
+            # Every chunk has the same categories, and so the same schema
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.filename, table.schema)
+            self._parquet_writer.write_table(table)
+        self.rows += len(frame)
+        self.chunks += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_results_format(filename):
+    """Get the format of a results file from its extension, JSON by default"""
+    extension = os.path.splitext(filename)[1].lower()
+    for results_format, extensions in RESULTS_EXTENSIONS.items():
+        if extension in extensions:
+            return results_format, filename[: -len(extension)], extension
+    return "json", filename, ".json"
+
+
+def iter_results_chunks(input_dir, images_path, paths, rejected_images):
+    """
+    Build the results table in chunks of RESULTS_CHUNK_ROWS images.
+
+    Labels are categorical columns sliced from the codes of the path table,
+    and rejections are unpacked from the bitset, so a chunk is built without
+    any per-image Python loop.
+    """
+    columns = {
+        name: (categories, np.frombuffer(codes, dtype=np.dtype(codes.typecode)))
+        for name, (categories, codes) in paths.columns.items()
+    }
+    bits = np.frombuffer(bytes(rejected_images.data), dtype=np.uint8)
+    for start in range(0, len(images_path), RESULTS_CHUNK_ROWS):
+        stop = min(start + RESULTS_CHUNK_ROWS, len(images_path))
+        frame = {
+            name: pd.Categorical.from_codes(codes[start:stop], categories)
+            for name, (categories, codes) in columns.items()
+        }
+        frame["path"] = images_path[start:stop]
+        # Chunks start on a byte boundary of the bitset
+        frame["rejected_images"] = np.unpackbits(
+            bits[start >> 3 : (stop + 7) >> 3], count=stop - start, bitorder="little"
+        ).astype(bool)
+        frame["input_dir"] = input_dir
+        yield pd.DataFrame(frame)
+
+
 def save_results(filename, results):
     assert isinstance(results, dict), "Results should be a dictionary"
 
@@ -96,53 +712,46 @@ def save_results(filename, results):
         raise Warning("No images to save in results")
 
     # Generate 3 files
-    # 1. JSON file with the results
-    # 2. JSON file with the rejected images
-    # 3. JSON file with the description of the JSON files
+    # 1. Results of every image, as JSON lines, CSV or Parquet
+    # 2. Rejected images, in the same format
+    # 3. JSON file with the description of the two files
 
+    results_format, stem, extension = get_results_format(filename)
+    if results_format == "parquet" and pq is None:
+        logger.error("Pyarrow not installed. Install with: pip install pyarrow")
+        raise ImportError("Saving results as Parquet needs pyarrow")
+
+    filename = stem + extension
     if os.path.exists(filename):
         logger.warning(f"File {filename} already exists. Overwriting.")
 
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    full_results = []
-    rejected_images_results = []
-
-    for index, image in enumerate(images_path):
-        (subject, image_name, repetition) = get_information_from_path(input_dir, image)
-        rejected_image = str(index) in rejected_images
-        full_info = {
-            "subject": subject,
-            "image_name": image_name,
-            "repetition": repetition,
-            "path": image,
-            "rejected_images": rejected_image,
-            "input_dir": input_dir,
-        }
-
-        full_results.append(full_info)
+    if not isinstance(rejected_images, Bitset):
+        rejected_images = Bitset.from_dict(len(images_path), rejected_images)
 
-        if rejected_image:
-            rejected_images_results.append(full_info)
-
-    # Check fileanme extension
-    if not filename.endswith(".json"):
-        filename += ".json"
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    # Save the results
-    pd.DataFrame(full_results).to_json(
-        filename, orient="records", lines=True, date_format="iso"
-    )
+    logger.info(f"{rejected_images.count()} of {len(images_path)} images rejected")
+
+    # Labels are categorical columns of the path table parsed at scan time
+    paths = get_path_table(input_dir, images_path)
+
+    # Both files are streamed, so memory stays bounded by the chunk size
+    rejected_images_filename = f"{stem}_rejected{extension}"
+    chunks = iter_results_chunks(input_dir, images_path, paths, rejected_images)
+    with ResultsWriter(filename, results_format) as results_writer, ResultsWriter(
+        rejected_images_filename, results_format
+    ) as rejected_writer:
+        for frame in chunks:
+            results_writer.write(frame)
+            rejected = frame[frame["rejected_images"]]
+            # Parquet needs a first chunk to know the schema, even empty
+            if len(rejected) or rejected_writer.chunks == 0:
+                rejected_writer.write(rejected)
     logger.info(f"Results saved to {filename}")
-
-    # Save the rejected images
-    rejected_images_filename = filename.replace(".json", "_rejected.json")
-    pd.DataFrame(rejected_images_results).to_json(
-        rejected_images_filename, orient="records", lines=True, date_format="iso"
-    )
     logger.info(f"Rejected images saved to {rejected_images_filename}")
 
-    # Save the description of the JSON files
-    description_filename = filename.replace(".json", "_description.json")
+    # Save the description of the results files
+    description_filename = f"{stem}_description.json"
     description = {
         "timestamp": timestamp,
         "results": rejected_images_filename,
@@ -1,113 +1,257 @@
+import hashlib
+import mimetypes
 import os
-from dash import ctx, Input, Output, State
+from dash import ClientsideFunction, Input, Output, State
 from dash.exceptions import PreventUpdate
-from flask import send_from_directory, abort
+from flask import abort, make_response, request
+from werkzeug.exceptions import HTTPException
 import traceback
 import dash
 
 from bqc_dash.logger import logger
 from bqc_dash.app import app, server
 
-from bqc_dash.utils import get_information_from_path, get_gif_path
+from bqc_dash.image_display.server import (
+    RENDITION_VERSION,
+    DatasetTable,
+    get_dataset,
+    get_file_versions,
+    get_prefetch_window,
+    get_rendition,
+    get_rendition_options,
+    get_rendition_width,
+    image_cache,
+    register_dataset,
+)
+from bqc_dash.scan.server import (
+    ScanIndex,
+    get_file_version,
+    get_image_versions,
+    get_path_table,
+    get_subject_table,
+)
 from bqc_dash.exceptions.callbacks import exception_callback
+from bqc_dash.session.callbacks import get_current_session
 from bqc_dash.toaster.callbacks import send_notification, ToastException
 
+# Browser cache lifetime of files requested without version, so prefetched
+# images are reused without revalidation when the reviewer reaches them
+PREFETCH_MAX_AGE = 300
 
-# GIF route using session
-@server.route("/gifs/<session_id>/<tab_id>/<path:input_dir>/<path:gif_path>")
-def serve_gif(session_id, tab_id, input_dir, gif_path):
-    """Serve GIF file from filesystem using session input_dir"""
-    try:
-        logger.debug(
-            f"Serve GIF route /gifs/{session_id}/{tab_id}/{input_dir}/{gif_path}"
-        )
-        logger.debug(f"Session ID: {session_id}")
-        logger.debug(f"Tab ID: {tab_id}")
-        logger.debug(f"Input directory: {input_dir}")
-        logger.debug(f"Image path: {gif_path}")
-
-        abs_input_dir = os.path.abspath(input_dir)
+# Browser cache lifetime of versioned URLs, a new version gets a new URL
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
-        # Construct and serve GIF...
-        server_path = os.path.normpath(os.path.join(abs_input_dir, gif_path))
-        server_dir, server_name = os.path.split(server_path)
 
-        # Construct the host path
-        route_path = f"/gifs/{session_id}/{tab_id}/{input_dir}/{gif_path}"
-        host_path = os.path.normpath(route_path)
+def send_cached_file(path, version, url_version=None):
+    """
+    Send a file from the in-memory cache, reading it on a miss.
 
-        if not os.path.exists(server_path) or not os.path.isfile(server_path):
+    The ETag is derived from the path and version of the file, so
+    revalidations are answered with 304 Not Modified without touching the
+    filesystem. The response is cached for good by the browser only when the
+    URL carries url_version, the version of the file as the server sees it,
+    version by default.
+    """
+    etag = hashlib.sha1(f"{path}:{version}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        try:
+            data = image_cache.read(path, version)
+        except (FileNotFoundError, IsADirectoryError):
+            logger.error(f"File not found: {path}")
+            abort(404)
+        response = make_response(data)
+        response.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    # Only URLs carrying the current version change whenever the file does,
+    # an outdated or made up version must not pin the file in the browser
+    if url_version is None:
+        url_version = version
+    if request.args.get("v") == url_version:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = PREFETCH_MAX_AGE
+    return response
+
+
+def send_rendition(path, version, width, options):
+    """Send a rendition of an image, in WebP if the browser accepts it"""
+    width = get_rendition_width(width)
+    # The q parameter only keys the browser cache on the quality, renditions
+    # are always made at the configured one so that clients cannot fill the
+    # cache directory with renditions of every quality
+    quality = options["quality"]
+    accepts_webp = "image/webp" in request.accept_mimetypes.values()
+    image_format = "WEBP" if accepts_webp else "PNG"
+    try:
+        rendition_path = get_rendition(path, version, width, quality, image_format)
+        rendition_version = RENDITION_VERSION
+    except FileNotFoundError:
+        logger.error(f"File not found: {path}")
+        abort(404)
+    except Exception as e:
+        # Images Pillow cannot read are still served at full resolution
+        logger.warning(f"Cannot render {path}, serving it as is: {e}")
+        rendition_path, rendition_version = path, version
+
+    logger.debug(f"Serving image: {rendition_path}")
+    # The URL carries the version of the image the rendition is made from
+    response = send_cached_file(rendition_path, rendition_version, version)
+    response.vary.add("Accept")
+    return response
+
+
+def get_dataset_or_abort(dataset_key):
+    """Get the table of a dataset, aborting if it is not served"""
+    table = get_dataset(dataset_key)
+    if table is None:
+        logger.error(f"Unknown dataset: {dataset_key}")
+        abort(404)
+    return table
+
+
+# Files are requested by id in the dataset table built from the scan, so a
+# request resolves its path and version without any filesystem lookup. URLs do not
+# depend on the session or the tab, so that the browser cache is shared by
+# every tab reviewing the same dataset
+@server.route("/gifs/<dataset_key>/<int:subject_id>")
+def serve_gif(dataset_key, subject_id):
+    """Serve the GIF of a subject of a dataset"""
+    try:
+        logger.debug(f"Serve GIF route /gifs/{dataset_key}/{subject_id}")
+        server_path, version = get_dataset_or_abort(dataset_key).get_gif(subject_id)
+        if server_path is None:
             abort(404)
-
         logger.debug(f"Serving GIF: {server_path}")
-        logger.debug(f"Host GIF {host_path}")
-
-        return send_from_directory(server_dir, server_name), host_path
+        return send_cached_file(server_path, version)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error serving GIF: {str(e)}")
         logger.error("\n" + traceback.format_exc())
         abort(500)
 
 
-# Get image from cache or load it
-@server.route("/images/<session_id>/<tab_id>/<path:input_dir>/<path:img_path>")
-def serve_image(session_id, tab_id, input_dir, img_path):
-    """Serve image file from filesystem"""
-    logger.debug(
-        f"Serve image route /images/{session_id}/{tab_id}/{input_dir}/{img_path}"
-    )
-    logger.debug(f"Session ID: {session_id}")
-    logger.debug(f"Tab ID: {tab_id}")
-    logger.debug(f"Image path: {img_path}")
-    logger.debug(f"Input directory: {input_dir}")
-
+@server.route("/images/<dataset_key>/<int:image_id>")
+def serve_image(dataset_key, image_id):
+    """Serve an image of a dataset"""
     try:
-        base_dir = os.path.abspath(input_dir)
-
-        # get relative if absolute path
-        if os.path.isabs(img_path):
-            img_path = "." + img_path
-
-        # Construct the full path and normalize it
-        full_path = os.path.normpath(os.path.join(base_dir, img_path))
-        server_dir, server_name = os.path.split(full_path)
-
-        # Security check: ensure the requested file is within the base directory
-        if not os.path.commonpath([base_dir, full_path]) == base_dir:
-            logger.error("Directory traversal attempt detected")
-            abort(403)  # Forbidden - prevent directory traversal
-
-        # Verify file exists
-        if not os.path.exists(full_path) or not os.path.isfile(full_path):
-            logger.error(f"File not found: {full_path}")
-            abort(404)  # Not found
+        logger.debug(f"Serve image route /images/{dataset_key}/{image_id}")
+        full_path, version = get_dataset_or_abort(dataset_key).get_image(image_id)
+        if full_path is None:
+            abort(404)
 
-        route_path = f"/images/{session_id}/{tab_id}/{input_dir}/{img_path}"
-        host_path = os.path.normpath(route_path)
+        # Downscaled rendition of the width shown in the viewer, if asked for
+        width = request.args.get("w", type=int)
+        options = get_rendition_options()
+        if width and options:
+            return send_rendition(full_path, version, width, options)
 
         logger.debug(f"Serving image: {full_path}")
-        logger.debug(f"Host image {host_path}")
 
-        # Return the image with proper content type
-        return send_from_directory(server_dir, server_name), host_path
+        # Return the image with proper content type, from memory if cached
+        return send_cached_file(full_path, version)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error serving image: {str(e)}")
         logger.error("\n" + traceback.format_exc())
         abort(500)  # Internal server error
 
 
+def encode_labels(values):
+    """Encode labels as their distinct values and one code per image"""
+    categories = {}
+    codes = [categories.setdefault(value, len(categories)) for value in values]
+    return {"categories": list(categories), "codes": codes}
+
+
+def build_manifest(session):
+    """
+    Build the navigation manifest of a session, sent once to the browser.
+
+    It holds everything needed to navigate without the server: the image
+    URLs, the subject GIF of each image, the labels and the rejected images.
+    """
+    input_dir = session.input_dir
+
+    # Labels, subjects and their GIFs come from the tables of the scan
+    index = ScanIndex.load(input_dir)
+    paths = get_path_table(input_dir, session.images_path, index)
+    subject_table = get_subject_table(input_dir, session.images_path, index, paths)
+    subject_ids = {}
+    subject_codes = []
+    gif_paths = []
+    gif_versions = []
+    for row in subject_table:
+        subject_id = subject_ids.get(row["subject"])
+        if subject_id is None:
+            subject_id = subject_ids[row["subject"]] = len(subject_ids)
+            gif_paths.append(row["gif"])
+            gif_versions.append(
+                get_file_version(row["gif_size"], row["gif_mtime"])
+                if row["gif"]
+                else "0"
+            )
+        subject_codes.extend([subject_id] * row["image_count"])
+    subjects = {"categories": list(subject_ids), "codes": subject_codes}
+
+    # URLs carry the version of their file, so they can be cached for good
+    # and still change when the file is replaced. Versions come from the
+    # listings of the scan, the images are only stat'ed if it did not find
+    # the same ones, as for a checkpoint of an older scan
+    images_path = [path.lstrip(os.sep) for path in session.images_path]
+    image_versions = get_image_versions(index, session.images_path)
+    if image_versions is None:
+        image_versions = get_file_versions(
+            [os.path.join(input_dir, path) for path in images_path]
+        )
+
+    # Only the files of the table can be requested, by their index
+    table = DatasetTable(
+        input_dir, images_path, image_versions, gif_paths, gif_versions
+    )
+    dataset_key = register_dataset(table)
+
+    # Subjects without GIF get an empty source instead of a broken image
+    gifs = [
+        (
+            f"/gifs/{dataset_key}/{subject_id}?v={gif_versions[subject_id]}"
+            if gif_path
+            else ""
+        )
+        for subject_id, gif_path in enumerate(gif_paths)
+    ]
+
+    return {
+        "session": session.id,
+        "size": len(session.images_path),
+        "current_index": session.current_index,
+        "image_prefix": f"/images/{dataset_key}",
+        "image_version": encode_labels(image_versions),
+        "gifs": gifs,
+        "subject": subjects,
+        "image_name": paths.encode("image_name"),
+        "repetition": paths.encode("repetition"),
+        "prefetch": get_prefetch_window(),
+        "renditions": get_rendition_options(),
+    }
+
+
 @app.callback(
     [
-        Output("image-display", "src"),
-        Output("gif-display", "src"),
+        Output("navigation-manifest-store", "data"),
+        Output("rejected-view-store", "data"),
         Output("toast-store", "data", allow_duplicate=True),
     ],
-    [Input("current-index-store", "data")],
+    [Input("dataset-store", "data")],
     [
-        State("images-path-store", "data"),
-        State("input-dir-store", "data"),
         State("session-id-store", "data"),
         State("tab-id-store", "data"),
         State("toast-store", "data"),
@@ -115,49 +259,15 @@ def serve_image(session_id, tab_id, input_dir, img_path):
     prevent_initial_call=True,
     on_error=exception_callback,
 )
-def load_images(current_index, images_path, input_dir, session_id, tab_id, toast_data):
-    """Load image and GIF sources based on current index"""
-    logger.debug("Start load_images")
-    # Skip if no images are loaded
-    if (
-        images_path is None
-        or len(images_path) == 0
-        or current_index >= len(images_path)
-        or current_index is None
-        or not input_dir
-    ):
-        logger.warning("No images to load")
+def update_navigation_manifest(dataset, session_id, tab_id, toast_data):
+    """Send the navigation manifest of a new dataset to the browser"""
+    logger.debug("Update navigation manifest")
+    if not dataset:
         raise PreventUpdate
-    try:
-        # Get current image info
-        image_path = images_path[current_index]
-
-        logger.debug("Loading images")
-        logger.debug(f"Current index: {current_index}")
-        logger.debug(f"Input directory: {input_dir}")
-        logger.debug(f"Image path: {image_path}")
-
-        # Get session ID
-        session_id = session_id.get("session-id")
-        tab_id = tab_id.get("tab-id")
-        (subject, image_name, repetition) = get_information_from_path(
-            input_dir, image_path
-        )
-
-        # Get image sources (from cache or load if needed)
-        response_img, img_src = serve_image(session_id, tab_id, input_dir, image_path)
-        if response_img.status_code != 200:
-            logger.error(f"Error loading image: {response_img.status_code}")
-            img_src = ""
 
-        gif_path = get_gif_path(input_dir, image_path)
-        response_gif, gif_src = serve_gif(session_id, tab_id, input_dir, gif_path)
-        if response_gif.status_code != 200:
-            logger.error(f"Error loading GIF: {response_gif.status_code}")
-            gif_src = ""
-
-        logger.debug(f"Host image: {img_src}")
-        logger.debug(f"Host gif: {gif_src}")
+    session = get_current_session(session_id, tab_id, toast_data)
+    try:
+        manifest = build_manifest(session)
     except Exception as e:
         toast = send_notification(
             str(e),
@@ -166,137 +276,55 @@ def load_images(current_index, images_path, input_dir, session_id, tab_id, toast
         )(toast_data)
         raise ToastException(toast) from e
 
-    return img_src, gif_src, dash.no_update
+    # Sparse view of the rejections, patched by the toggle callback
+    rejected_view = {str(index): True for index in session.rejected_images.indices()}
 
+    logger.debug(f"Navigation manifest of {manifest['size']} images")
+    return manifest, rejected_view, dash.no_update
 
-@app.callback(
-    Output("images-path-len-store", "data"),
-    [Input("images-path-store", "data")],
+
+# Navigation runs in the browser, against the manifest: a keypress changes
+# the displayed image without any request to the server
+app.clientside_callback(
+    ClientsideFunction(namespace="bqc", function_name="navigate"),
+    Output("current-index-store", "data"),
+    [
+        Input("prev-img-btn", "n_clicks"),
+        Input("next-img-btn", "n_clicks"),
+        Input("prev-btn-key", "n_keydowns"),
+        Input("next-btn-key", "n_keydowns"),
+        Input("navigation-manifest-store", "data"),
+    ],
+    [State("current-index-store", "data")],
     prevent_initial_call=True,
 )
-def update_images_path_len(images_path):
-    """Update the length of the images path store"""
-    logger.debug("Update images path length component")
-    if images_path:
-        logger.debug(f"Images path length: {len(images_path)}")
-        return len(images_path)
 
-    logger.warning("No images path found")
-    return None
-
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="bqc", function_name="render"),
     [
+        Output("image-display", "src"),
+        Output("gif-display", "src"),
         Output("subject-label", "children"),
         Output("image-name-label", "children"),
         Output("repetition-label", "children"),
         Output("progress-label", "children"),
+        Output("status-label", "children"),
+        Output("status-label", "color"),
+        Output("toggle-reject-btn", "children"),
+        Output("reviewed-queue-store", "data"),
     ],
-    [Input("current-index-store", "data")],
-    [State("images-path-store", "data"), State("input-dir-store", "data")],
-    prevent_initial_call=True,
-)
-def update_image_info_ui(current_index, images_path, input_dir):
-    """Update image information based on current index"""
-    logger.debug("Update image information UI")
-    # Skip if no images are loaded
-    if (
-        images_path is None
-        or current_index is None
-        or len(images_path) == 0
-        or current_index >= len(images_path)
-    ):
-        return "No subject", "No image", "No repetition", "0/0"
-
-    # Get current image info
-    image_path = images_path[current_index]
-    (subject, image_name, repetition) = get_information_from_path(input_dir, image_path)
-
-    return subject, image_name, repetition, f"{current_index + 1}/{len(images_path)}"
-
-
-@app.callback(
-    Output("next-img-btn", "n_clicks"),
-    [Input("next-btn-key", "n_keydowns")],
-    [State("next-img-btn", "n_clicks")],
-    prevent_initial_call=True,
-)
-def next_img_btn_listener(event, current_clicks):
-    """Handle keydown event for next image button"""
-    logger.debug("Next image event triggered")
-
-    # Initialize clicks if None
-    if current_clicks is None:
-        current_clicks = 0
-
-    if event:
-        return current_clicks + 1
-
-    # Return unchanged if no event
-    return current_clicks
-
-
-@app.callback(
-    Output("prev-img-btn", "n_clicks"),
-    [Input("prev-btn-key", "n_keydowns")],
-    [State("prev-img-btn", "n_clicks")],
-    prevent_initial_call=True,
-)
-def prev_img_btn_listener(event, current_clicks):
-    """Handle keydown event for previous image button"""
-    logger.debug("Prev image event triggered")
-
-    # Initialize clicks if None
-    if current_clicks is None:
-        current_clicks = 0
-
-    if event:
-        return current_clicks + 1
-
-    # Return unchanged if no event
-    return current_clicks
-
-
-@app.callback(
-    Output("current-index-store", "data"),
     [
-        Input("prev-img-btn", "n_clicks"),
-        Input("next-img-btn", "n_clicks"),
-        Input("images-path-len-store", "data"),
+        Input("current-index-store", "data"),
+        Input("rejected-view-store", "data"),
+        # The zoom changes the viewer width, and so the rendition to request
+        Input("image-display-viewer", "style"),
+    ],
+    [
+        State("navigation-manifest-store", "data"),
+        State("reviewed-queue-store", "data"),
     ],
-    [State("current-index-store", "data")],
     prevent_initial_call=True,
 )
-def update_navigation(prev_clicks, next_clicks, images_path_len, current_index):
-    """Handle navigation between images"""
-    logger.debug("Update navigation")
-    # Skip if no images are loaded
-    if images_path_len == 0:
-        raise PreventUpdate
-
-    # Determine which button was clicked
-    trigger = ctx.triggered_id
-    if trigger is None:
-        raise PreventUpdate
-
-    # Calculate new index
-    if current_index is None and images_path_len is None:
-        logger.warning("No current index found")
-        raise PreventUpdate
-    elif trigger == "next-img-btn":
-        logger.debug("Next image button clicked")
-        return (current_index + 1) % images_path_len
-    elif trigger == "prev-img-btn":
-        logger.debug("Previous image button clicked")
-        return (current_index - 1) % images_path_len
-    elif images_path_len > 0 and current_index is None:
-        # Trigger to reload images at the end of the scan
-        logger.debug("Trigger to reload images at the end of the scan")
-        # Set current index to 0
-        return 0
-    else:
-        # Index didn't change (at beginning or end)
-        raise PreventUpdate
 
 
 @app.callback(
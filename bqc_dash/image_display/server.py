@@ -0,0 +1,534 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from bqc_dash.logger import logger
+from bqc_dash.performance import performance
+from bqc_dash.scan import server as scan_server
+from bqc_dash.session.server import get_session_database
+from bqc_dash.utils import (
+    get_cache_dir,
+    get_thread_pool,
+    run_in_thread,
+    write_atomic,
+)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Number of images prefetched by the browser after and before the current one
+prefetch_ahead = int(os.getenv("BQC_PREFETCH_AHEAD", "5"))
+prefetch_behind = int(os.getenv("BQC_PREFETCH_BEHIND", "2"))
+
+
+def set_prefetch_window(ahead=None, behind=None):
+    """Set the number of images prefetched around the current one"""
+    global prefetch_ahead, prefetch_behind
+    if ahead is not None:
+        prefetch_ahead = max(0, ahead)
+    if behind is not None:
+        prefetch_behind = max(0, behind)
+
+
+def get_prefetch_window():
+    """Get the prefetch window sent to the browser with the manifest"""
+    return {"ahead": prefetch_ahead, "behind": prefetch_behind}
+
+
+# Memory budget of the cache of served files, per worker process (in MB)
+image_cache_mb = int(os.getenv("BQC_IMAGE_CACHE_MB", "256"))
+
+
+class ByteLRUCache:
+    """
+    Thread-safe LRU cache of file contents, bounded in bytes.
+
+    Entries are keyed by path and version of the file, so a file rewritten
+    on disk is read again once its version changes.
+    """
+
+    def __init__(self, max_bytes, name="images"):
+        self.max_bytes = max_bytes
+        # Name of the cache in the metrics shared by the workers
+        self.name = name
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the cached content of key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        performance.increment(
+            "cache_misses" if data is None else "cache_hits", self.name
+        )
+        return data
+
+    def put(self, key, data):
+        """Cache data under key, evicting the least recently used entries"""
+        # Files larger than the whole budget would only flush the cache
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= len(previous)
+            self._entries[key] = data
+            self.size_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes and self._entries:
+            _, data = self._entries.popitem(last=False)
+            self.size_bytes -= len(data)
+            self.evictions += 1
+
+    def read(self, path, version):
+        """
+        Read a file through the cache.
+
+        version identifies the content of the file, a new version is read
+        from disk again, so hits do not touch the filesystem.
+        """
+        key = (path, version)
+        data = self.get(key)
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            self.put(key, data)
+        return data
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def discard(self, key):
+        """Remove the entry of key, if cached"""
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self.size_bytes -= len(data)
+
+    def resize(self, max_bytes):
+        """Change the memory budget, evicting entries that no longer fit"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        """Get the counters of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+image_cache = ByteLRUCache(image_cache_mb * 1024 * 1024)
+
+
+def set_image_cache_size(megabytes):
+    """Set the memory budget of the cache of served files, in MB"""
+    global image_cache_mb
+    image_cache_mb = max(0, megabytes)
+    image_cache.resize(image_cache_mb * 1024 * 1024)
+
+
+def get_file_versions(paths):
+    """
+    Get the version of each file, "0" for missing files, stat concurrently.
+    Only for images the scan index does not know the versions of.
+    """
+
+    def get_version(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return "0"
+        return scan_server.get_file_version(stat.st_size, stat.st_mtime_ns)
+
+    # Metadata latency bounds this on network filesystems, as for the scan
+    with get_thread_pool(scan_server.scan_workers) as executor:
+        return list(executor.map(get_version, paths))
+
+
+class DatasetTable:
+    """
+    Allowlist of the files served for a dataset, built from its scan.
+
+    Routes look files up by id in the table, so serving a file never probes
+    the filesystem to resolve its path, and no path outside the input
+    directory can be requested.
+    """
+
+    def __init__(self, input_dir, images_path, image_versions, gifs, gif_versions):
+        self.input_dir = os.path.abspath(input_dir)
+        # Image paths relative to input_dir, the image id is the index
+        self.images_path = images_path
+        # Version of each image and of each GIF when the table was built
+        self.image_versions = image_versions
+        # GIF path relative to input_dir of each subject, or None
+        self.gifs = gifs
+        self.gif_versions = gif_versions
+        self.key = self.get_key(self.as_dict())
+
+        self._images = [self._resolve(path) for path in images_path]
+        self._gifs = [self._resolve(path) if path else None for path in gifs]
+
+    @staticmethod
+    def get_key(data):
+        """
+        Get the key of a dataset table, the same for every session and tab.
+
+        Any change of the files or of their versions gives a new key, so a
+        worker never serves a stale table.
+        """
+        encoded = json.dumps(data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(encoded.encode()).hexdigest()[:16]
+
+    def _resolve(self, rel_path):
+        """Get the absolute path of a file, None if outside input_dir"""
+        path = os.path.normpath(os.path.join(self.input_dir, rel_path.lstrip(os.sep)))
+        if os.path.commonpath([self.input_dir, path]) != self.input_dir:
+            logger.warning(f"Not serving {rel_path}, outside of {self.input_dir}")
+            return None
+        return path
+
+    def get_image(self, image_id):
+        """Get the path and version of an image, or (None, None) if unknown"""
+        if not 0 <= image_id < len(self._images):
+            return None, None
+        return self._images[image_id], self.image_versions[image_id]
+
+    def get_gif(self, subject_id):
+        """Get the path and version of a subject GIF, or (None, None) if unknown"""
+        if not 0 <= subject_id < len(self._gifs):
+            return None, None
+        return self._gifs[subject_id], self.gif_versions[subject_id]
+
+    def as_dict(self):
+        return {
+            "input_dir": self.input_dir,
+            "images_path": self.images_path,
+            "image_versions": self.image_versions,
+            "gifs": self.gifs,
+            "gif_versions": self.gif_versions,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            input_dir=data["input_dir"],
+            images_path=data["images_path"],
+            image_versions=data["image_versions"],
+            gifs=data["gifs"],
+            gif_versions=data["gif_versions"],
+        )
+
+    @staticmethod
+    def get_table_path(key):
+        return os.path.join(get_cache_dir("datasets"), f"{key}.json")
+
+    def save(self):
+        """
+        Write the table atomically to the session database or cache
+        directory, dropping the least recently used tables past
+        MAX_DATASET_TABLES
+        """
+        database = get_session_database()
+        if database is not None:
+            database.put_dataset(
+                self.key, json.dumps(self.as_dict()), keep=MAX_DATASET_TABLES
+            )
+            logger.debug(f"Dataset table {self.key} saved to {database.path}")
+            return
+        table_path = self.get_table_path(self.key)
+        write_atomic(table_path, lambda f: json.dump(self.as_dict(), f), fsync=False)
+        logger.debug(f"Dataset table {self.key} saved to {table_path}")
+        drop_dataset_tables(MAX_DATASET_TABLES)
+
+    def touch(self):
+        """Mark the stored table as used, False if it was dropped"""
+        database = get_session_database()
+        if database is not None:
+            return database.touch_dataset(self.key)
+        try:
+            os.utime(self.get_table_path(self.key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls, key):
+        """Load the table of a dataset key, or None if there is none"""
+        database = get_session_database()
+        try:
+            if database is not None:
+                data = database.get_dataset(key)
+                if data is None:
+                    return None
+                table = cls.from_dict(json.loads(data))
+            else:
+                with open(cls.get_table_path(key), "r") as f:
+                    table = cls.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        # A table written for another key is never served
+        return table if table.key == key else None
+
+
+def drop_dataset_tables(keep):
+    """Remove the table files of the cache directory but the keep last used"""
+    entries = []
+    with os.scandir(get_cache_dir("datasets")) as scan:
+        for entry in scan:
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+    entries.sort(reverse=True)
+    for _, path in entries[keep:]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+# Dataset tables held in memory by each worker, and stored for all of them,
+# the least recently used ones are dropped first
+MAX_DATASETS = 16
+MAX_DATASET_TABLES = 256
+
+# Dataset tables by key, the key is what image URLs refer to
+datasets = OrderedDict()
+datasets_lock = threading.Lock()
+
+
+def keep_dataset(table):
+    """Hold a table in memory, dropping the least recently used ones"""
+    with datasets_lock:
+        table = datasets.setdefault(table.key, table)
+        datasets.move_to_end(table.key)
+        while len(datasets) > MAX_DATASETS:
+            datasets.popitem(last=False)
+    return table
+
+
+def register_dataset(table):
+    """
+    Allow the files of a dataset table to be served.
+
+    The table is also written to the session database or cache directory, so
+    that every worker process can serve the dataset, whichever one built the
+    manifest.
+    """
+    with datasets_lock:
+        known = table.key in datasets
+    if not known or not table.touch():
+        table.save()
+    keep_dataset(table)
+    return table.key
+
+
+def get_dataset(key):
+    """Get the table of a dataset key, or None if unknown"""
+    with datasets_lock:
+        table = datasets.get(key)
+        if table is not None:
+            datasets.move_to_end(key)
+            return table
+
+    # Registered by another worker process
+    if not key.isalnum():
+        return None
+    table = DatasetTable.load(key)
+    if table is not None:
+        table = keep_dataset(table)
+    return table
+
+
+# Widths of the renditions served in place of full resolution images, the
+# viewer asks for the smallest one covering its width on screen
+RENDITION_WIDTHS = (320, 480, 640, 800, 1024, 1280, 1600, 1920, 2560)
+
+# Version of every rendition file, its name already identifies its content
+RENDITION_VERSION = "rendition"
+
+# Quality of the WebP renditions, 0 disables the renditions
+rendition_quality = int(os.getenv("BQC_RENDITION_QUALITY", "80"))
+
+
+# Disk budget of the renditions, shared by the workers (in MB)
+rendition_cache_mb = int(os.getenv("BQC_RENDITION_CACHE_MB", "2048"))
+
+# Fraction of the disk budget left once the oldest renditions are removed, so
+# that the cache directory is not listed again on every new rendition
+RENDITION_CACHE_LOW_WATER = 0.9
+
+
+def set_rendition_quality(quality):
+    """Set the quality of the WebP renditions, 0 disables the renditions"""
+    global rendition_quality
+    rendition_quality = min(100, max(0, quality))
+
+
+def set_rendition_cache_size(megabytes):
+    """Set the disk budget of the renditions, in MB"""
+    global rendition_cache_mb
+    rendition_cache_mb = max(0, megabytes)
+
+
+class RenditionCache:
+    """
+    Disk budget of the rendition files, the oldest are removed first.
+
+    The size of the directory is counted once per worker, then increased by
+    the renditions the worker writes. Over budget, the directory is listed
+    again, so that the renditions of the other workers are accounted for,
+    and the oldest renditions are removed down to RENDITION_CACHE_LOW_WATER
+    of the budget.
+    """
+
+    def __init__(self):
+        self.size_bytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _list():
+        """List the rendition files as (mtime, size, path)"""
+        files = []
+        with os.scandir(get_cache_dir("renditions")) as directories:
+            for directory in directories:
+                if not directory.is_dir():
+                    continue
+                with os.scandir(directory.path) as entries:
+                    for entry in entries:
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return files
+
+    def add(self, new_path, size):
+        """Account for a new rendition, removing the oldest ones over budget"""
+        max_bytes = rendition_cache_mb * 1024 * 1024
+        with self._lock:
+            if self.size_bytes is None:
+                self.size_bytes = sum(size for _, size, _ in self._list())
+            self.size_bytes += size
+            if self.size_bytes <= max_bytes:
+                return
+            files = sorted(self._list())
+            self.size_bytes = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in files:
+                if self.size_bytes <= max_bytes * RENDITION_CACHE_LOW_WATER:
+                    break
+                # The new rendition is about to be served
+                if path == new_path:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                image_cache.discard((path, RENDITION_VERSION))
+                self.size_bytes -= size
+                removed += 1
+        logger.info(f"Removed the {removed} oldest renditions over the disk budget")
+
+
+rendition_cache = RenditionCache()
+
+
+def get_rendition_options():
+    """Get the rendition options sent to the browser, or None if disabled"""
+    if Image is None:
+        logger.debug("Pillow not installed, renditions are disabled")
+        return None
+    if rendition_quality == 0:
+        return None
+    return {"widths": RENDITION_WIDTHS, "quality": rendition_quality}
+
+
+def get_rendition_width(width):
+    """Round a requested width up to the closest rendition width"""
+    for rendition_width in RENDITION_WIDTHS:
+        if width <= rendition_width:
+            return rendition_width
+    return RENDITION_WIDTHS[-1]
+
+
+def render(path, rendition_path, width, quality, image_format):
+    """Write a rendition of an image, returns its size in bytes"""
+    with Image.open(path) as image:
+        image.thumbnail((width, image.height))
+        if image_format == "WEBP" and image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        def write(f):
+            if image_format == "WEBP":
+                image.save(f, "WEBP", quality=quality, method=4)
+            else:
+                image.save(f, "PNG", optimize=True)
+            return f.tell()
+
+        # Written atomically, concurrent requests may render the same image
+        return write_atomic(rendition_path, write, mode="wb", fsync=False)
+
+
+def get_rendition(path, version, width, quality, image_format):
+    """
+    Get a rendition of an image at most width pixels wide, in image_format.
+
+    Renditions are generated on first request and kept in the cache
+    directory, keyed by the image path and version and the rendition
+    parameters. Returns the rendition path.
+    """
+    key = f"{path}:{version}:{width}:{quality}:{image_format}"
+    name = hashlib.sha1(key.encode()).hexdigest()
+    extension = "webp" if image_format == "WEBP" else "png"
+    rendition_path = os.path.join(
+        get_cache_dir("renditions", name[:2]), f"{name}.{extension}"
+    )
+    # Renditions never change, the ones in memory are not looked up on disk
+    if (rendition_path, RENDITION_VERSION) in image_cache or os.path.exists(
+        rendition_path
+    ):
+        performance.increment("cache_hits", "renditions")
+        return rendition_path
+    performance.increment("cache_misses", "renditions")
+
+    # Decoding and encoding release the GIL, under gevent they run on a thread
+    # of the hub so that the other requests of the worker are still served
+    size = run_in_thread(render, path, rendition_path, width, quality, image_format)
+    rendition_cache.add(rendition_path, size)
+    logger.debug(f"Rendition {width}px {extension} of {path} saved to {rendition_path}")
+    return rendition_path
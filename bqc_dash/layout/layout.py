@@ -206,6 +206,10 @@ class ScanInputDir:
                                 dbc.Col(scan_dir_loading),
                             ],
                         ),
+                        html.Div(
+                            id="scan-progress-label",
+                            className="small text-muted mt-1",
+                        ),
                     ],
                 ),
             ],
@@ -688,15 +692,19 @@ layout = dbc.Container(
         dcc.Store(id="tab-id-store", data=None, storage_type="session"),
         dcc.Store(id="log-store", data=None, storage_type="memory"),
         dcc.Store(id="exception-store", data=None, storage_type="memory"),
-        dcc.Store(id="images-path-store", data=None, storage_type="memory"),
-        dcc.Store(id="images-path-len-store", data=None, storage_type="memory"),
-        dcc.Store(id="rejected-images-store", data=None, storage_type="memory"),
-        dcc.Store(id="current-rejected-status-store", data=None, storage_type="memory"),
+        dcc.Store(id="dataset-store", data=None, storage_type="memory"),
+        dcc.Store(id="navigation-manifest-store", data=None, storage_type="memory"),
+        dcc.Store(id="rejected-view-store", data=None, storage_type="memory"),
+        dcc.Store(id="reviewed-queue-store", data=[], storage_type="memory"),
         dcc.Store(id="current-index-store", data=None, storage_type="memory"),
         dcc.Store(id="zoom-level-store", data=100, storage_type="memory"),
         dcc.Store(id="launch-scan", data=False, storage_type="memory"),
         dcc.Store(id="image-on-right", data=False, storage_type="session"),
         dcc.Store(id="load-checkpoint", data=False, storage_type="memory"),
+        # Interval for polling the background scan
+        dcc.Interval(
+            id="scan-progress-interval", interval=500, n_intervals=0, disabled=True
+        ),
         # Interval for updating performance metrics
         dcc.Interval(
             id="metrics-interval", interval=2000, n_intervals=0, disabled=True
@@ -1,5 +1,6 @@
 # main.py
 import os
+import re
 import argparse
 import multiprocessing
 
@@ -11,7 +12,20 @@ from dash import (
 )
 
 from bqc_dash.app import app
+from bqc_dash.autosave.server import set_autosave
+from bqc_dash.checkpoint.server import CHECKPOINT_MODES, set_checkpoint_mode
 from bqc_dash.logger import logger, set_logger_level
+from bqc_dash.performance import performance, profiler
+from bqc_dash.performance.server import parse_profile_request, set_profile_remote
+from bqc_dash.image_display.server import (
+    set_image_cache_size,
+    set_prefetch_window,
+    set_rendition_cache_size,
+    set_rendition_quality,
+)
+from bqc_dash.scan.server import set_naming_pattern, set_scan_workers
+from bqc_dash.session import server as session_server
+from bqc_dash.session.server import SESSION_STORES, set_session_store
 
 # Import callbacks
 # Must be imported after app.layout
@@ -23,6 +37,7 @@ import bqc_dash.checkpoint.callbacks  # noqa: E402, F401
 import bqc_dash.help.callbacks  # noqa: E402, F401
 import bqc_dash.zoom.callbacks  # noqa: E402, F401
 import bqc_dash.toaster.callbacks  # noqa: E402, F401
+import bqc_dash.autosave.callbacks  # noqa: E402, F401
 
 # Debug keyboard event handling (existing code)
 debug_keyboard_event = False
@@ -62,6 +77,12 @@ def run_dev_server(debug=False, host="0.0.0.0", port=8050, clear_session=False):
     app.run(debug=debug, host=host, port=port)
 
 
+def get_gunicorn_workers():
+    """Get the default number of Gunicorn workers"""
+    # Default to number of CPU cores + 1, which is a common best practice
+    return (multiprocessing.cpu_count() * 2) + 1
+
+
 def run_gunicorn_server(host="0.0.0.0", port=8050, workers=None, clear_session=False):
     """Run the Gunicorn production server"""
     try:
@@ -71,8 +92,7 @@ def run_gunicorn_server(host="0.0.0.0", port=8050, workers=None, clear_session=F
         return
 
     if workers is None:
-        # Default to number of CPU cores + 1, which is a common best practice
-        workers = (multiprocessing.cpu_count() * 2) + 1
+        workers = get_gunicorn_workers()
 
     logger.info(f"Starting Gunicorn server on {host}:{port} with {workers} workers")
 
@@ -98,11 +118,17 @@ def run_gunicorn_server(host="0.0.0.0", port=8050, workers=None, clear_session=F
         "workers": workers,
         "worker_class": "gevent",
         "timeout": 120,
+        "worker_exit": on_worker_exit,
     }
 
     StandaloneApplication(server, options).run()
 
 
+def on_worker_exit(server, worker):
+    """Remove the metrics of a Gunicorn worker, from the worker that exits"""
+    performance.remove_segment()
+
+
 def run_waitress_server(host="0.0.0.0", port=8050, threads=None, clear_session=False):
     """Run the Waitress production server (Windows compatible)"""
     try:
@@ -141,6 +167,92 @@ def main():
     )
     parser.add_argument("--workers", type=int, help="Number of workers (gunicorn only)")
     parser.add_argument("--threads", type=int, help="Number of threads (waitress only)")
+    parser.add_argument(
+        "--scan-workers",
+        type=int,
+        help="Number of threads listing subject directories during a scan "
+        "(default: BQC_SCAN_WORKERS or 16)",
+    )
+    parser.add_argument(
+        "--naming-pattern",
+        help="Regular expression matching the image paths, relative to the input "
+        "directory, with the named groups subject, image_name and repetition "
+        "(default: BQC_NAMING_PATTERN or <subject>/<image_name>_<repetition>.png)",
+    )
+
+    parser.add_argument(
+        "--session-store",
+        choices=SESSION_STORES,
+        help="Keep the sessions in the memory of the server process, or in a "
+        "SQLite database shared by the workers, always used by more than one "
+        "Gunicorn worker (default: BQC_SESSION_STORE or memory)",
+    )
+    parser.add_argument(
+        "--session-db",
+        help="Path of the SQLite session database "
+        "(default: BQC_SESSION_DB or ~/.cache/bqc_dash/sessions.sqlite3)",
+    )
+    parser.add_argument(
+        "--checkpoint-mode",
+        choices=CHECKPOINT_MODES,
+        help="Write checkpoints whole as JSON or binary, or once followed by a "
+        "journal of the changes of each save (default: BQC_CHECKPOINT_MODE or full)",
+    )
+    parser.add_argument(
+        "--autosave-delay",
+        type=float,
+        help="Seconds without change before a session is autosaved "
+        "(default: BQC_AUTOSAVE_DELAY or 5)",
+    )
+    parser.add_argument(
+        "--no-autosave",
+        action="store_true",
+        help="Disable the autosave of the sessions",
+    )
+    parser.add_argument(
+        "--prefetch-ahead",
+        type=int,
+        help="Number of next images prefetched by the browser "
+        "(default: BQC_PREFETCH_AHEAD or 5)",
+    )
+    parser.add_argument(
+        "--prefetch-behind",
+        type=int,
+        help="Number of previous images prefetched by the browser "
+        "(default: BQC_PREFETCH_BEHIND or 2)",
+    )
+    parser.add_argument(
+        "--image-cache-mb",
+        type=int,
+        help="Memory budget of the cache of served images, per worker, in MB "
+        "(default: BQC_IMAGE_CACHE_MB or 256)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        metavar="NAME[:N]",
+        help="Profile the next N invocations (default: 1) of a callback or route, "
+        "for example scan_directory_data:3, may be repeated "
+        "(default: BQC_PROFILE, comma-separated)",
+    )
+    parser.add_argument(
+        "--profile-remote",
+        action="store_true",
+        help="Serve the /profile route to any address, not only the local host "
+        "(default: BQC_PROFILE_REMOTE or false)",
+    )
+    parser.add_argument(
+        "--rendition-quality",
+        type=int,
+        help="Quality of the downscaled WebP images sent to the browser, "
+        "0 to send full resolution images (default: BQC_RENDITION_QUALITY or 80)",
+    )
+    parser.add_argument(
+        "--rendition-cache-mb",
+        type=int,
+        help="Disk budget of the downscaled images, shared by the workers, in MB "
+        "(default: BQC_RENDITION_CACHE_MB or 2048)",
+    )
 
     args = parser.parse_args()
 
@@ -148,6 +260,47 @@ def main():
     if args.debug is False:  # Only use env var if not explicitly set by args
         args.debug = os.environ.get("BQC_DEBUG", "False").lower() == "true"
 
+    if args.scan_workers is not None:
+        set_scan_workers(args.scan_workers)
+    if args.naming_pattern is not None:
+        try:
+            set_naming_pattern(args.naming_pattern)
+        except (re.error, ValueError) as e:
+            parser.error(f"invalid --naming-pattern: {e}")
+    # Gunicorn spreads the requests of a tab over its workers, which must then
+    # share the sessions
+    if args.server == "gunicorn":
+        if args.workers is None:
+            args.workers = get_gunicorn_workers()
+        if args.workers > 1:
+            if args.session_store == "memory":
+                parser.error(
+                    "--session-store memory needs --workers 1 with gunicorn, "
+                    "the sessions of one worker are not seen by the others"
+                )
+            if args.session_store is None and session_server.session_store != "sqlite":
+                logger.info(
+                    f"Sharing the sessions of the {args.workers} Gunicorn workers "
+                    "in the SQLite session store"
+                )
+            args.session_store = "sqlite"
+    set_session_store(args.session_store, args.session_db)
+    if args.checkpoint_mode is not None:
+        set_checkpoint_mode(args.checkpoint_mode)
+    set_autosave(False if args.no_autosave else None, args.autosave_delay)
+    set_prefetch_window(args.prefetch_ahead, args.prefetch_behind)
+    if args.image_cache_mb is not None:
+        set_image_cache_size(args.image_cache_mb)
+    if args.rendition_quality is not None:
+        set_rendition_quality(args.rendition_quality)
+    if args.rendition_cache_mb is not None:
+        set_rendition_cache_size(args.rendition_cache_mb)
+    if args.profile_remote:
+        set_profile_remote(True)
+    profile_specs = args.profile or os.getenv("BQC_PROFILE", "").split(",")
+    for spec in filter(None, (spec.strip() for spec in profile_specs)):
+        profiler.request(*parse_profile_request(spec))
+
     if args.server == "dev":
         run_dev_server(args.debug, args.host, args.port)
     elif args.server == "gunicorn":
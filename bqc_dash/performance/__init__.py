@@ -1,3 +1,4 @@
-from .server import PerformanceMonitor
+from .server import PerformanceMonitor, Profiler
 
 performance = PerformanceMonitor()
+profiler = Profiler()
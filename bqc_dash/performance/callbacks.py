@@ -1,9 +1,114 @@
+import time
+
 from dash import html, Input, Output
 import dash_bootstrap_components as dbc
+from flask import g, jsonify, make_response, request
 
-from bqc_dash.app import app
+from bqc_dash.app import app, server
 from bqc_dash.logger import logger
-from bqc_dash.performance import performance
+from bqc_dash.performance import performance, profiler
+from bqc_dash.performance.server import format_prometheus, is_profile_allowed
+
+# Samples accepted in one batch of browser timings
+MAX_CLIENT_SAMPLES = 100
+
+# Number of last profiles listed in the panel
+PANEL_PROFILES = 5
+
+# Route of the Dash callbacks, timed under the name of each callback instead
+CALLBACK_ROUTE = app.config.routes_pathname_prefix + "_dash-update-component"
+
+
+def get_timer_name():
+    """Get the name a request is timed under, its callback or route"""
+    rule = request.url_rule.rule if request.url_rule else None
+    if rule == CALLBACK_ROUTE:
+        output = (request.get_json(silent=True) or {}).get("output")
+        callback = app.callback_map.get(output, {}).get("callback")
+        if callback is not None:
+            return callback.__name__
+    return rule
+
+
+# Every route and callback is timed here, so none of them has to time itself
+@server.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Profiled only when requested, see the /profile route
+    if profiler.get_requests():
+        name = get_timer_name()
+        try:
+            profile = profiler.start(name) if name else None
+        except OSError as e:
+            logger.warning(f"Cannot profile {name}: {e}")
+            profile = None
+        if profile is not None:
+            g.profile = (name, profile, time.perf_counter())
+
+
+@server.after_request
+def end_request_timer(response):
+    start = g.pop("request_start", None)
+    name = get_timer_name()
+    if start is not None and name is not None:
+        performance.record(name, time.perf_counter() - start)
+    if request.url_rule and response.content_length:
+        performance.increment(
+            "served_bytes", request.url_rule.rule, response.content_length
+        )
+    return response
+
+
+@server.teardown_request
+def stop_request_profile(exception=None):
+    profiled = g.pop("profile", None)
+    if profiled is not None:
+        name, profile, start = profiled
+        profiler.stop(name, profile, time.perf_counter() - start)
+
+
+@server.route("/profile", methods=["GET", "POST"])
+def serve_profile_requests():
+    """
+    List the pending profile requests and the last profiles, and with POST,
+    profile the next count invocations of a callback or route name.
+    Only served to the local host, unless remote profiling is enabled.
+    """
+    if not is_profile_allowed(request.remote_addr):
+        return make_response("Profiles are only served to the local host\n", 403)
+    if request.method == "POST":
+        name = request.values.get("name")
+        if not name:
+            return make_response("A callback or route name is required\n", 400)
+        count = request.values.get("count", 1, type=int)
+        profiler.request(name, max(0, count))
+    return jsonify(requests=profiler.get_requests(), profiles=profiler.list_profiles())
+
+
+# Navigation timings measured in the browser, posted in batches with
+# navigator.sendBeacon by navigation.js
+@server.route("/client-metrics", methods=["POST"])
+def receive_client_metrics():
+    """Record a batch of navigation timings of a browser"""
+    data = request.get_json(force=True, silent=True)
+    samples = data.get("samples") if isinstance(data, dict) else None
+    if not isinstance(samples, list):
+        return make_response("", 400)
+    recorded = performance.record_client_samples(samples[:MAX_CLIENT_SAMPLES])
+    logger.debug(f"Recorded {recorded} browser timings")
+    return make_response("", 204)
+
+
+@server.route("/metrics")
+def serve_metrics():
+    """Serve the metrics of all the workers in the Prometheus text format"""
+    server_histograms = performance.read_server_histograms()
+    if server_histograms is None:
+        return make_response("Metrics are not shared between workers\n", 503)
+    response = make_response(format_prometheus(*server_histograms))
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 
 # Performance metrics display
@@ -15,7 +120,8 @@ from bqc_dash.performance import performance
 def update_performance_metrics(n):
     """Update the performance metrics display"""
     logger.debug("Start update_performance_metrics")
-    metrics = performance.get_metrics()
+    # Aggregated over all the worker processes, whichever one answers
+    metrics, workers = performance.get_server_metrics()
 
     if not metrics:
         return "No performance data available yet."
@@ -28,8 +134,10 @@ def update_performance_metrics(n):
                 [
                     html.Td(name),
                     html.Td(f"{data['avg']*1000:.2f} ms"),
+                    html.Td(f"{data['p50']*1000:.2f} ms"),
+                    html.Td(f"{data['p95']*1000:.2f} ms"),
+                    html.Td(f"{data['p99']*1000:.2f} ms"),
                     html.Td(f"{data['max']*1000:.2f} ms"),
-                    html.Td(f"{data['last']*1000:.2f} ms"),
                     html.Td(f"{data['count']}"),
                 ]
             )
@@ -40,10 +148,12 @@ def update_performance_metrics(n):
             html.Thead(
                 html.Tr(
                     [
-                        html.Th("Callback"),
+                        html.Th("Callback / Route"),
                         html.Th("Avg Time"),
+                        html.Th("P50"),
+                        html.Th("P95"),
+                        html.Th("P99"),
                         html.Th("Max Time"),
-                        html.Th("Last Time"),
                         html.Th("Count"),
                     ]
                 )
@@ -56,7 +166,24 @@ def update_performance_metrics(n):
         size="sm",
     )
 
-    return table
+    processes = "process" if workers == 1 else "processes"
+    children = [table, html.Small(f"Aggregated over {workers} worker {processes}.")]
+
+    # Profiles requested through the /profile route or --profile
+    profiles = profiler.list_profiles(limit=PANEL_PROFILES)
+    if profiles:
+        children.append(html.H6("Profiles", className="mt-3"))
+        children.append(
+            html.Ul(
+                [
+                    html.Li(
+                        html.Code(f"{profile['file']} ({profile['size'] // 1024} KB)")
+                    )
+                    for profile in profiles
+                ]
+            )
+        )
+    return children
 
 
 # Toggle performance metrics visibility
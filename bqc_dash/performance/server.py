@@ -1,4 +1,275 @@
+import cProfile
+import json
+import math
+import mmap
+import os
+import re
+import threading
 import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+
+from bqc_dash.logger import logger
+from bqc_dash.utils import get_cache_dir, is_gevent_patched, write_atomic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Number of last durations kept for each callback or route
+perf_window = int(os.getenv("BQC_PERF_WINDOW", "1024"))
+
+QUANTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99}
+
+# Phases of a navigation measured in the browser, from the key press to the
+# callbacks updating the sources, the new image loaded and decoded, and the
+# GIF loaded, in milliseconds
+CLIENT_PHASES = (
+    "keypress_to_paint",
+    "callback_chain",
+    "image_load",
+    "image_decode",
+    "gif_load",
+)
+MAX_CLIENT_DURATION = 600000
+
+# Durations are also counted in histograms shared by the worker processes,
+# with buckets growing by 2^(1/4) from 10 us, so about 20% wide, up to 35 s
+BUCKET_MIN = 1e-5
+BUCKET_GROWTH = 2**0.25
+BUCKETS = 88
+BUCKET_BOUNDS = [BUCKET_MIN * BUCKET_GROWTH**i for i in range(BUCKETS)]
+# Count, sum and max of the durations, then the buckets and the overflow
+SLOT_FIELDS = 3 + BUCKETS + 1
+MAX_METRICS = 256
+
+# Directory of the histogram segments of the server, one per worker process.
+# Workers are forked after this module is imported, so they share the pid of
+# the server process
+metrics_dir = os.getenv("BQC_METRICS_DIR")
+server_pid = os.getpid()
+
+
+def get_metrics_dir():
+    """Get the segment directory of this server run"""
+    base_dir = metrics_dir or get_cache_dir("metrics")
+    path = os.path.join(base_dir, str(server_pid))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def is_process_alive(pid):
+    """Check whether a process of this host is running, True if unknown"""
+    # Probing a process with signal 0 is POSIX only, it kills it on Windows
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def remove_stale_segments():
+    """Remove the segment directories of servers no longer running"""
+    base_dir = metrics_dir or get_cache_dir("metrics")
+    for name in os.listdir(base_dir):
+        if not name.isdigit() or int(name) == server_pid:
+            continue
+        if is_process_alive(int(name)):
+            continue
+        stale_dir = os.path.join(base_dir, name)
+        for file_name in os.listdir(stale_dir):
+            os.unlink(os.path.join(stale_dir, file_name))
+        os.rmdir(stale_dir)
+
+
+def get_bucket(duration):
+    """Get the histogram bucket of a duration, BUCKETS for the overflow"""
+    if duration <= BUCKET_MIN:
+        return 0
+    bucket = math.ceil(math.log(duration / BUCKET_MIN, BUCKET_GROWTH) - 1e-9)
+    return min(bucket, BUCKETS)
+
+
+class HistogramSegment:
+    """
+    Histograms of the durations recorded by one worker process.
+
+    The histograms are a memory-mapped file of SLOT_FIELDS doubles per
+    metric and name, so recording a duration is a few in-place additions,
+    without system call. Counters use the count and sum of a slot only.
+    Metrics and names are listed in a JSON file next to it, rewritten only
+    when one is added. Any process reads and sums the segments of the server.
+    """
+
+    def __init__(self, directory):
+        pid = os.getpid()
+        self.path = os.path.join(directory, f"{pid}.seg")
+        self.names_path = os.path.join(directory, f"{pid}.json")
+        size = MAX_METRICS * SLOT_FIELDS * 8
+        with open(self.path, "wb+") as f:
+            f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), size)
+        self.values = memoryview(self._mmap).cast("d")
+        self.slots = {}
+        self._write_names()
+
+    def _write_names(self):
+        names = [list(key) for key in self.slots]
+        write_atomic(self.names_path, lambda f: json.dump(names, f), fsync=False)
+
+    def _get_base(self, metric, name):
+        """Get the offset of the slot of a metric and name, None if full"""
+        key = (metric, name)
+        slot = self.slots.get(key)
+        if slot is None:
+            if len(self.slots) >= MAX_METRICS:
+                return None
+            slot = self.slots[key] = len(self.slots)
+            self._write_names()
+        return slot * SLOT_FIELDS
+
+    def add(self, metric, name, value):
+        base = self._get_base(metric, name)
+        if base is not None:
+            self.values[base] += 1
+            self.values[base + 1] += value
+
+    def remove(self):
+        """Remove the files of the segment, when its worker exits"""
+        for path in (self.names_path, self.path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def record(self, metric, name, duration):
+        base = self._get_base(metric, name)
+        if base is None:
+            return
+        values = self.values
+        values[base] += 1
+        values[base + 1] += duration
+        if duration > values[base + 2]:
+            values[base + 2] = duration
+        values[base + 3 + get_bucket(duration)] += 1
+
+
+def read_segments(directory):
+    """
+    Sum the histograms of the segments of the running workers of a directory,
+    by metric and name. Segments of workers that exited are removed, so that
+    a worker replaced by Gunicorn is not counted along with its successor.
+    """
+    histograms = {}
+    workers = 0
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(".json"):
+            continue
+        pid = file_name[:-5]
+        if pid.isdigit() and not is_process_alive(int(pid)):
+            for stale_name in (file_name, pid + ".seg"):
+                try:
+                    os.unlink(os.path.join(directory, stale_name))
+                except FileNotFoundError:
+                    pass
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                names = json.load(f)
+            with open(os.path.join(directory, file_name[:-5] + ".seg"), "rb") as f:
+                values = array("d", f.read())
+        except (OSError, ValueError):
+            continue
+        workers += 1
+        for slot, (metric, name) in enumerate(names):
+            fields = values[slot * SLOT_FIELDS : (slot + 1) * SLOT_FIELDS]
+            histogram = histograms.get((metric, name))
+            if histogram is None:
+                histograms[metric, name] = fields
+                continue
+            max_duration = max(histogram[2], fields[2])
+            for i, value in enumerate(fields):
+                histogram[i] += value
+            histogram[2] = max_duration
+    return histograms, workers
+
+
+def summarize_histogram(fields):
+    """Get the count, average, maximum and quantiles of a histogram"""
+    count, total, max_duration = fields[0], fields[1], fields[2]
+    if not count:
+        return None
+    summary = {"avg": total / count, "max": max_duration, "count": int(count)}
+    buckets = fields[3:]
+    for name, quantile in QUANTILES.items():
+        rank = quantile * count
+        cumulative = 0
+        for bucket, bucket_count in enumerate(buckets):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                break
+        # Upper bound of the bucket, the maximum is a closer bound at the top
+        bound = BUCKET_BOUNDS[bucket] if bucket < BUCKETS else max_duration
+        summary[name] = min(bound, max_duration)
+    return summary
+
+
+class LatencyWindow:
+    """
+    Fixed-size ring buffer of the last durations of an operation.
+
+    Adding a duration is constant time: it overwrites the oldest one and
+    updates the running sum. The window is only sorted when its summary is
+    read, once for the maximum and all the quantiles.
+    """
+
+    def __init__(self, size):
+        self.samples = array("d", bytes(8 * size))
+        self.size = size
+        # Number of durations ever added, the next slot is count % size
+        self.count = 0
+        self.window_sum = 0.0
+        self.last = 0.0
+
+    def add(self, duration):
+        slot = self.count % self.size
+        if self.count >= self.size:
+            self.window_sum -= self.samples[slot]
+        self.samples[slot] = duration
+        self.window_sum += duration
+        self.count += 1
+        self.last = duration
+
+    def copy(self):
+        window = LatencyWindow(0)
+        window.samples = array("d", self.samples)
+        window.size = self.size
+        window.count = self.count
+        window.window_sum = self.window_sum
+        window.last = self.last
+        return window
+
+    def summary(self):
+        """Get the average, maximum and quantiles of the window"""
+        samples = sorted(self.samples[: min(self.count, self.size)])
+        if not samples:
+            return None
+        summary = {
+            "avg": self.window_sum / len(samples),
+            "max": samples[-1],
+            "last": self.last,
+            "count": self.count,
+        }
+        for name, quantile in QUANTILES.items():
+            rank = max(0, math.ceil(quantile * len(samples)) - 1)
+            summary[name] = samples[rank]
+        return summary
 
 
 # Performance tracking
@@ -6,43 +277,393 @@ class PerformanceMonitor:
     def __init__(self):
         self.metrics = {}
         self.callback_times = {}
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_pid = None
 
     def start_timer(self, name):
         """Start timing a callback or operation"""
-        return time.time()
+        return time.perf_counter()
 
     def end_timer(self, name, start_time):
         """End timing and record the result"""
-        duration = time.time() - start_time
-        if name not in self.callback_times:
-            self.callback_times[name] = []
-        self.callback_times[name].append(duration)
-        # Keep only last 100 measurements
-        if len(self.callback_times[name]) > 100:
-            self.callback_times[name].pop(0)
+        duration = time.perf_counter() - start_time
+        self.record(name, duration)
         return duration
 
+    def record(self, name, duration, metric="latency"):
+        """
+        Record the duration of a callback or operation, in seconds.
+
+        Latencies of callbacks and routes are also kept in the window of the
+        name, other metrics are only shared with the other workers.
+        """
+        with self._lock:
+            if metric == "latency":
+                window = self.callback_times.get(name)
+                if window is None:
+                    window = self.callback_times[name] = LatencyWindow(perf_window)
+                window.add(duration)
+            segment = self._get_segment()
+            if segment is not None:
+                segment.record(metric, name, duration)
+
+    def increment(self, metric, name, value=1):
+        """Add value to a counter shared with the other workers"""
+        with self._lock:
+            segment = self._get_segment()
+            if segment is not None:
+                segment.add(metric, name, value)
+
+    def _get_segment(self):
+        """Get the histogram segment of this process, created on first use"""
+        if self._segment_pid != os.getpid():
+            # A forked worker gets its own segment
+            self._segment_pid = os.getpid()
+            try:
+                directory = get_metrics_dir()
+                remove_stale_segments()
+                self._segment = HistogramSegment(directory)
+            except OSError as e:
+                logger.warning(f"Metrics are not shared between workers: {e}")
+                self._segment = None
+        return self._segment
+
+    def remove_segment(self):
+        """Stop sharing the metrics of this process, when its worker exits"""
+        with self._lock:
+            if self._segment is not None and self._segment_pid == os.getpid():
+                self._segment.remove()
+                self._segment = None
+
+    def get_summary(self, name):
+        """Get the summary of a callback, copied so it is sorted unlocked"""
+        with self._lock:
+            window = self.callback_times.get(name)
+            window = window.copy() if window is not None else None
+        return window.summary() if window is not None else None
+
     def get_avg_time(self, name):
         """Get average execution time for a callback"""
-        if name in self.callback_times and self.callback_times[name]:
-            return sum(self.callback_times[name]) / len(self.callback_times[name])
-        return 0
+        summary = self.get_summary(name)
+        return summary["avg"] if summary else 0
 
     def get_max_time(self, name):
         """Get maximum execution time for a callback"""
-        if name in self.callback_times and self.callback_times[name]:
-            return max(self.callback_times[name])
-        return 0
+        summary = self.get_summary(name)
+        return summary["max"] if summary else 0
 
     def get_metrics(self):
         """Get all metrics as a dictionary"""
+        with self._lock:
+            names = sorted(self.callback_times)
         metrics = {}
-        for name in self.callback_times:
-            if self.callback_times[name]:
-                metrics[name] = {
-                    "avg": self.get_avg_time(name),
-                    "max": self.get_max_time(name),
-                    "last": self.callback_times[name][-1],
-                    "count": len(self.callback_times[name]),
-                }
+        for name in names:
+            summary = self.get_summary(name)
+            if summary:
+                metrics[name] = summary
         return metrics
+
+    def read_server_histograms(self):
+        """
+        Get the histograms and counters of all the worker processes.
+
+        Returns them by metric and name with the number of workers they come
+        from, or None if they are not shared.
+        """
+        with self._lock:
+            segment = self._get_segment()
+        if segment is None:
+            return None
+        return read_segments(os.path.dirname(segment.path))
+
+    def get_server_metrics(self):
+        """
+        Get the latency metrics of all the worker processes of the server.
+
+        Returns the metrics by name and the number of workers they come from,
+        or the metrics of this process only if they are not shared.
+        """
+        server_histograms = self.read_server_histograms()
+        if server_histograms is None:
+            return self.get_metrics(), 1
+        histograms, workers = server_histograms
+        metrics = {}
+        for metric, name in sorted(histograms):
+            if metric not in ("latency", "client"):
+                continue
+            summary = summarize_histogram(histograms[metric, name])
+            if summary:
+                # Browser timings are listed next to the server ones
+                metrics[f"browser {name}" if metric == "client" else name] = summary
+        return metrics, workers
+
+    def record_client_samples(self, samples):
+        """Record the navigation timings sent by a browser, in milliseconds"""
+        recorded = 0
+        for sample in samples:
+            if not isinstance(sample, dict):
+                continue
+            for phase in CLIENT_PHASES:
+                duration = sample.get(phase)
+                if (
+                    isinstance(duration, (int, float))
+                    and not isinstance(duration, bool)
+                    and 0 <= duration < MAX_CLIENT_DURATION
+                ):
+                    self.record(phase, duration / 1000, metric="client")
+                    recorded += 1
+        return recorded
+
+
+# Prometheus name, help and label of the metrics, the request latencies are
+# labelled by kind and name
+PROMETHEUS_HISTOGRAMS = {
+    "latency": (
+        "bqc_request_duration_seconds",
+        "Duration of the requests, by route or Dash callback",
+        "name",
+    ),
+    "client": (
+        "bqc_client_duration_seconds",
+        "Duration of the phases of a navigation, measured in the browser",
+        "phase",
+    ),
+    "scan": ("bqc_scan_duration_seconds", "Duration of the directory scans", None),
+}
+PROMETHEUS_COUNTERS = {
+    "served_bytes": ("bqc_served_bytes", "Bytes of the responses", "route"),
+    "cache_hits": ("bqc_cache_hits", "Cache hits", "cache"),
+    "cache_misses": ("bqc_cache_misses", "Cache misses", "cache"),
+}
+
+
+def format_labels(**labels):
+    escaped = {
+        name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for name, value in labels.items()
+    }
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+def format_prometheus(histograms, workers):
+    """
+    Format the histograms and counters of the server in the Prometheus text
+    exposition format.
+
+    Histograms are exported every 4 buckets, at the powers of 2 of
+    BUCKET_MIN, where their cumulative counts are exact.
+    """
+    lines = [
+        "# HELP bqc_worker_processes Worker processes the metrics come from",
+        "# TYPE bqc_worker_processes gauge",
+        f"bqc_worker_processes {workers}",
+    ]
+    for metric, (prometheus_name, description, label) in PROMETHEUS_HISTOGRAMS.items():
+        lines.append(f"# HELP {prometheus_name} {description}")
+        lines.append(f"# TYPE {prometheus_name} histogram")
+        for key in sorted(key for key in histograms if key[0] == metric):
+            name = key[1]
+            fields = histograms[key]
+            if metric == "latency":
+                kind = "route" if name.startswith("/") else "callback"
+                labels = {"kind": kind, "name": name}
+            else:
+                labels = {label: name} if label else {}
+            cumulative = 0
+            for bucket, bucket_count in enumerate(fields[3:]):
+                cumulative += bucket_count
+                if bucket < BUCKETS and bucket % 4 == 0:
+                    le = f"{BUCKET_BOUNDS[bucket]:.6g}"
+                    bucket_labels = format_labels(**labels, le=le)
+                    lines.append(
+                        f"{prometheus_name}_bucket{bucket_labels} {cumulative:.0f}"
+                    )
+            bucket_labels = format_labels(**labels, le="+Inf")
+            lines.append(f"{prometheus_name}_bucket{bucket_labels} {fields[0]:.0f}")
+            suffix = format_labels(**labels) if labels else ""
+            lines.append(f"{prometheus_name}_sum{suffix} {fields[1]!r}")
+            lines.append(f"{prometheus_name}_count{suffix} {fields[0]:.0f}")
+
+    for metric, (prometheus_name, description, label) in PROMETHEUS_COUNTERS.items():
+        lines.append(f"# HELP {prometheus_name}_total {description}")
+        lines.append(f"# TYPE {prometheus_name}_total counter")
+        for key in sorted(key for key in histograms if key[0] == metric):
+            labels = format_labels(**{label: key[1]})
+            lines.append(f"{prometheus_name}_total{labels} {histograms[key][1]:.0f}")
+
+    # Hit ratio of each cache since the start of the server
+    lines.append("# HELP bqc_cache_hit_ratio Ratio of the cache lookups that hit")
+    lines.append("# TYPE bqc_cache_hit_ratio gauge")
+    caches = sorted(
+        {
+            name
+            for metric, name in histograms
+            if metric in ("cache_hits", "cache_misses")
+        }
+    )
+    for cache in caches:
+        hits = histograms.get(("cache_hits", cache), [0, 0])[1]
+        misses = histograms.get(("cache_misses", cache), [0, 0])[1]
+        ratio = hits / (hits + misses) if hits + misses else 0.0
+        lines.append(f"bqc_cache_hit_ratio{format_labels(cache=cache)} {ratio!r}")
+    return "\n".join(lines) + "\n"
+
+
+# Directory of the profiles, and seconds between two reads of the profile
+# requests shared by the workers
+profile_dir = os.getenv("BQC_PROFILE_DIR")
+PROFILE_REFRESH = 1.0
+
+
+# Addresses allowed to request and list profiles, unless remote profiling
+# is enabled
+profile_remote = os.getenv("BQC_PROFILE_REMOTE", "false").lower() == "true"
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+
+def get_profile_dir():
+    return profile_dir or get_cache_dir("profiles")
+
+
+def set_profile_remote(enabled):
+    """Allow profile requests from any address, not only the local host"""
+    global profile_remote
+    profile_remote = enabled
+
+
+def is_profile_allowed(address):
+    return profile_remote or address in LOCAL_ADDRESSES
+
+
+def parse_profile_request(spec):
+    """Parse a NAME[:COUNT] profile request, the count defaults to 1"""
+    # Route rules contain colons, only a trailing number is a count
+    name, _, count = spec.rpartition(":")
+    if name and count.isdigit():
+        return name, int(count)
+    return spec, 1
+
+
+class Profiler:
+    """
+    Profiles the next invocations of named callbacks or routes with cProfile.
+
+    Requests are counts of invocations to profile by name, kept in a file of
+    the server run so that they are shared by all the workers, whichever one
+    received them. Each profile is written to a timestamped file of
+    get_profile_dir(), readable with pstats or snakeviz.
+    """
+
+    def __init__(self):
+        self._requests = {}
+        self._requests_mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # cProfile profiles one thread at a time
+        self._active = False
+
+    @staticmethod
+    def _get_requests_path():
+        return os.path.join(get_metrics_dir(), "profile_requests.json")
+
+    @contextmanager
+    def _locked_requests(self):
+        """Read, then write back, the profile requests under a file lock"""
+        path = self._get_requests_path()
+        with open(path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    requests = json.load(f)
+            except (OSError, ValueError):
+                requests = {}
+            yield requests
+            requests = {name: count for name, count in requests.items() if count > 0}
+            write_atomic(path, lambda f: json.dump(requests, f), fsync=False)
+        self._checked_at = 0.0
+
+    def request(self, name, count=1):
+        """Profile the next count invocations of name, 0 to cancel"""
+        with self._locked_requests() as requests:
+            requests[name] = count
+        logger.info(f"Profiling the next {count} invocations of {name}")
+
+    def get_requests(self):
+        """Get the pending profile requests, read again once per second"""
+        now = time.monotonic()
+        if now - self._checked_at < PROFILE_REFRESH:
+            return self._requests
+        self._checked_at = now
+        path = self._get_requests_path()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime != self._requests_mtime:
+                with open(path) as f:
+                    self._requests = json.load(f)
+                self._requests_mtime = mtime
+        except (OSError, ValueError):
+            self._requests = {}
+            self._requests_mtime = None
+        return self._requests
+
+    def start(self, name):
+        """Start profiling an invocation of name if requested, or get None"""
+        if name not in self.get_requests():
+            return None
+        with self._lock:
+            if self._active:
+                return None
+            self._active = True
+        try:
+            with self._locked_requests() as requests:
+                claimed = requests.get(name, 0) > 0
+                if claimed:
+                    requests[name] -= 1
+        except BaseException:
+            self._active = False
+            raise
+        if not claimed:
+            self._active = False
+            return None
+        if is_gevent_patched():
+            # Greenlets share the thread, their calls are profiled as well
+            logger.warning(
+                f"Profiling {name} under gevent, the profile includes the "
+                "greenlets of the other requests served meanwhile"
+            )
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, name, profile, duration):
+        """Stop a profile and write it, returns its path"""
+        profile.disable()
+        self._active = False
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")
+        file_name = (
+            f"{timestamp}_{safe_name}_{duration * 1000:.0f}ms_{os.getpid()}.prof"
+        )
+        path = os.path.join(get_profile_dir(), file_name)
+        profile.dump_stats(path)
+        logger.info(f"Profile of {name} written to {path}")
+        return path
+
+    @staticmethod
+    def list_profiles(limit=20):
+        """Get the most recent profiles, newest first"""
+        directory = get_profile_dir()
+        profiles = []
+        for file_name in os.listdir(directory):
+            if not file_name.endswith(".prof"):
+                continue
+            try:
+                size = os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
+                continue
+            profiles.append({"file": file_name, "size": size})
+        # Timestamped file names sort in time order
+        profiles.sort(key=lambda profile: profile["file"], reverse=True)
+        return profiles[:limit]
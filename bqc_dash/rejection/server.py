@@ -0,0 +1,127 @@
+import base64
+import re
+
+# Number of bits set in each byte value
+POPCOUNT = bytes(bin(i).count("1") for i in range(256))
+
+NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+class Bitset:
+    """
+    Packed set of image indices, one bit per image.
+
+    Bit i is stored in byte i // 8, least significant bit first, so that the
+    memory and serialized size of a set of N images is N/8 bytes.
+    """
+
+    def __init__(self, size, data=None):
+        nbytes = (size + 7) // 8
+        if data is None:
+            data = bytearray(nbytes)
+        elif len(data) != nbytes:
+            raise ValueError(f"Bitset of {size} bits needs {nbytes} bytes")
+        self.size = size
+        self.data = bytearray(data)
+
+    @classmethod
+    def from_indices(cls, size, indices):
+        bitset = cls(size)
+        for index in indices:
+            bitset.set(index)
+        return bitset
+
+    @classmethod
+    def from_dict(cls, size, flags):
+        """Build a bitset from the legacy {"<index>": bool} rejection dict"""
+        return cls.from_indices(
+            size, (int(index) for index, flag in (flags or {}).items() if flag)
+        )
+
+    @classmethod
+    def from_base64(cls, size, encoded):
+        return cls(size, base64.b64decode(encoded))
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode("ascii")
+
+    def _check(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(f"Index {index} out of range for {self.size} images")
+
+    def get(self, index):
+        """Check whether index is in the set"""
+        self._check(index)
+        return bool(self.data[index >> 3] & (1 << (index & 7)))
+
+    __contains__ = get
+
+    def set(self, index, value=True):
+        self._check(index)
+        if value:
+            self.data[index >> 3] |= 1 << (index & 7)
+        else:
+            self.data[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def toggle(self, index):
+        """Flip index in or out of the set and return its new value"""
+        self._check(index)
+        self.data[index >> 3] ^= 1 << (index & 7)
+        return self.get(index)
+
+    def count(self):
+        """Count the indices in the set"""
+        return sum(self.data.translate(POPCOUNT))
+
+    def indices(self):
+        """Iterate over the indices in the set, in increasing order"""
+        # Only the non-zero bytes are decoded, which keeps sparse sets cheap
+        for match in NONZERO_BYTE.finditer(self.data):
+            offset = match.start()
+            byte = self.data[offset]
+            for bit in range(8):
+                if byte & (1 << bit):
+                    yield (offset << 3) | bit
+
+    def to_bools(self):
+        """Get one boolean per image"""
+        bools = [False] * self.size
+        for index in self.indices():
+            bools[index] = True
+        return bools
+
+    def resize(self, size):
+        """Grow or shrink the set to size images, keeping the common indices"""
+        nbytes = (size + 7) // 8
+        if nbytes > len(self.data):
+            self.data.extend(bytes(nbytes - len(self.data)))
+        else:
+            del self.data[nbytes:]
+        # Clear the padding bits past the last image
+        if size & 7:
+            self.data[-1] &= (1 << (size & 7)) - 1
+        self.size = size
+
+    def copy(self):
+        return Bitset(self.size, self.data)
+
+    def __xor__(self, other):
+        """Get the set of the indices in only one of the two sets"""
+        if self.size != other.size:
+            raise ValueError(f"Bitsets of {self.size} and {other.size} bits")
+        nbytes = len(self.data)
+        xor = int.from_bytes(self.data, "little") ^ int.from_bytes(other.data, "little")
+        return Bitset(self.size, xor.to_bytes(nbytes, "little"))
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Bitset)
+            and self.size == other.size
+            and self.data == other.data
+        )
+
+    def __repr__(self):
+        return f"Bitset(size={self.size}, count={self.count()})"
@@ -1,7 +1,4 @@
-import glob
 import os
-import traceback
-from natsort import natsorted
 
 import dash
 from dash import Input, Output, State
@@ -10,7 +7,11 @@ from dash.exceptions import PreventUpdate
 from bqc_dash.app import app
 from bqc_dash.logger import logger
 from bqc_dash.exceptions.callbacks import exception_callback
-from bqc_dash.toaster.callbacks import send_notification, ToastException
+from bqc_dash.checkpoint.server import Session
+from bqc_dash.scan.server import get_scan_job, start_scan_job
+from bqc_dash.session import sessions
+from bqc_dash.session.server import get_session_key
+from bqc_dash.toaster.callbacks import send_notification
 
 
 @app.callback(
@@ -48,23 +49,26 @@ def set_scan_ready(input_dir):
 
 @app.callback(
     [
-        Output("images-path-store", "data", allow_duplicate=True),
+        Output("scan-progress-interval", "disabled", allow_duplicate=True),
+        Output("scan-btn", "disabled", allow_duplicate=True),
+        Output("scan-progress-label", "children", allow_duplicate=True),
         Output("toast-store", "data", allow_duplicate=True),
     ],
     [Input("launch-scan", "data")],
     [
         State("input-dir-store", "data"),
         State("load-checkpoint", "data"),
+        State("session-id-store", "data"),
+        State("tab-id-store", "data"),
         State("toast-store", "data"),
     ],
     prevent_initial_call=True,
-    running=[
-        (Output("scan-btn", "disabled"), True, False),
-        (Output("loading-scan", "display"), "show", "hide"),
-    ],
     on_error=exception_callback,
 )
-def scan_directory_data(launch_scan, input_dir, is_loading_checkpoint, toast_data):
+def scan_directory_data(
+    launch_scan, input_dir, is_loading_checkpoint, session_id, tab_id, toast_data
+):
+    """Start scanning the input directory in the background"""
     logger.debug(f"Scan directory data: {input_dir}")
 
     if not launch_scan:
@@ -73,55 +77,98 @@ def scan_directory_data(launch_scan, input_dir, is_loading_checkpoint, toast_dat
 
     if not os.path.exists(input_dir):
         logger.error("Input directory does not exist")
-        return dash.no_update, "Input directory does not exist", True, "danger"
+        notification = send_notification(
+            "Input directory does not exist",
+            "danger",
+            duration=5,
+        )(toast_data)
+        return dash.no_update, dash.no_update, dash.no_update, notification
 
     if is_loading_checkpoint:
         logger.debug("Loading checkpoint, skipping scan")
         raise PreventUpdate
 
-    try:
-        # Empty caches
-        subject_gifs = {}
-        images_path = []
-
-        # Find all GIF files in the root directory
-        gif_files = glob.glob(os.path.join(input_dir, "*.gif"))
-        subjects = [os.path.splitext(os.path.basename(f))[0] for f in gif_files]
-
-        # Pre-populate subject_gifs dictionary for faster lookups
-        for gif_file in gif_files:
-            subject = os.path.splitext(os.path.basename(gif_file))[0]
-            subject_gifs[subject] = gif_file
-
-        # For each subject, find all PNG files
-        image_re = os.path.join(input_dir, "png", "**", "*.png")
-        images_path = [
-            path.replace(input_dir, "") for path in glob.glob(image_re, recursive=True)
-        ]
-
-        if not images_path:
-            return (
-                dash.no_update,
-                "No images found in the input directory",
-                True,
-                "warning",
-            )
-
-        # Sort images by subject, then image name, then repetition
-        number_images = len(images_path)
-        number_subjects = len(subjects)
-        status = f"Found {number_images} images across {number_subjects} subjects."
+    start_scan_job(get_session_key(session_id, tab_id), input_dir)
+    return False, True, "Scanning...", dash.no_update
+
+
+@app.callback(
+    [
+        Output("dataset-store", "data", allow_duplicate=True),
+        Output("scan-progress-interval", "disabled", allow_duplicate=True),
+        Output("scan-btn", "disabled", allow_duplicate=True),
+        Output("scan-progress-label", "children", allow_duplicate=True),
+        Output("toast-store", "data", allow_duplicate=True),
+    ],
+    [Input("scan-progress-interval", "n_intervals")],
+    [
+        State("session-id-store", "data"),
+        State("tab-id-store", "data"),
+        State("toast-store", "data"),
+    ],
+    prevent_initial_call=True,
+    on_error=exception_callback,
+)
+def poll_scan_progress(n_intervals, session_id, tab_id, toast_data):
+    """Report the progress of the background scan and publish its images"""
+    job = get_scan_job(get_session_key(session_id, tab_id))
+    if job is None:
+        logger.warning("No scan job found")
         notification = send_notification(
-            status,
-            "success",
+            "The scan was lost by the server, scan the input directory again",
+            "warning",
             duration=5,
-        )
+        )(toast_data)
+        return dash.no_update, True, False, "", notification
+
+    progress = job.progress()
+    logger.debug(f"Scan progress: {progress}")
 
-        images_path = natsorted(images_path)
+    if not job.done:
+        # Publish the first subject once, so it can be reviewed during the scan
+        if job.first_images_path and job.publish_first():
+            session = Session(job.input_dir, job.first_images_path, None, {})
+            sessions.put(session_id, tab_id, session)
+            return session.as_handle(), False, True, progress, dash.no_update
+        return dash.no_update, False, True, progress, dash.no_update
 
-        return images_path, notification(toast_data)
+    if job.error is not None:
+        notification = send_notification(
+            f"Error scanning directory: {job.error}",
+            "danger",
+            duration=5,
+        )(toast_data)
+        return dash.no_update, True, False, "", notification
+
+    images_path = job.images_path
+    if not images_path:
+        notification = send_notification(
+            "No images found in the input directory",
+            "warning",
+            duration=5,
+        )(toast_data)
+        return dash.no_update, True, False, "", notification
+
+    number_images = len(images_path)
+    number_subjects = len(job.subjects)
+    status = f"Found {number_images} images across {number_subjects} subjects."
+    # Subjects without GIF are reported once here, and shown without GIF
+    missing_gifs = sum(1 for row in job.subjects if row["gif"] is None)
+    if missing_gifs:
+        status += f" {missing_gifs} subjects have no GIF."
+    notification = send_notification(
+        status,
+        "success",
+        duration=5,
+    )(toast_data)
+    progress = f"{status} ({job.duration:.1f} s)"
+
+    # Extend the session of the first subject, keeping its rejections
+    session = sessions.get(session_id, tab_id) if job.first_published else None
+    if session is None or session.input_dir != job.input_dir:
+        session = sessions.put(
+            session_id, tab_id, Session(job.input_dir, images_path, None, {})
+        )
+    session.set_images_path(images_path)
 
-    except Exception as e:
-        logger.critical(f"Error scanning directory: {input_dir}")
-        logger.critical(traceback.format_exc())
-        raise ToastException(toast_data) from e
+    return session.as_handle(), True, False, progress, notification
@@ -0,0 +1,998 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import traceback
+import uuid
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+from natsort import natsorted
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from bqc_dash.logger import logger
+from bqc_dash.performance import performance
+from bqc_dash.utils import (
+    get_cache_dir,
+    get_thread_lock,
+    get_thread_pool,
+    start_thread,
+    write_atomic,
+)
+
+# Bump when the layout of the index file changes, older indexes are discarded
+SCAN_INDEX_VERSION = 4
+
+# A directory modified this close to a scan may change again within the same
+# mtime tick, so its listing is not trusted on the next scan (in nanoseconds)
+RACY_MTIME_WINDOW = 2 * 10**9
+
+# Number of subject directories listed concurrently. Metadata latency, not
+# CPU, bounds the scan on network filesystems, so this can exceed cpu_count
+scan_workers = max(1, int(os.getenv("BQC_SCAN_WORKERS", "16")))
+
+
+def set_scan_workers(workers):
+    """Set the number of threads used to scan subject directories"""
+    global scan_workers
+    scan_workers = max(1, workers)
+
+
+# Regular expression searched in the image paths, relative to the input
+# directory, with the named groups subject, image_name and repetition.
+# The default reads <subject>/<image_name>_<repetition>.png
+DEFAULT_NAMING_PATTERN = (
+    r"(?P<subject>[^/]+)/(?P<image_name>[^/]+)_(?P<repetition>[^/_]+)\.[^/.]+$"
+)
+naming_pattern = os.getenv("BQC_NAMING_PATTERN", DEFAULT_NAMING_PATTERN)
+
+
+def set_naming_pattern(pattern):
+    """Set the pattern of the image paths, see DEFAULT_NAMING_PATTERN"""
+    global naming_pattern
+    compiled = re.compile(pattern)
+    missing = set(PathTable.COLUMNS) - set(compiled.groupindex)
+    if missing:
+        raise ValueError(f"Naming pattern has no group {', '.join(sorted(missing))}")
+    naming_pattern = pattern
+
+
+class PathTable:
+    """
+    Columnar table of the labels parsed from image paths.
+
+    Each column holds the distinct values of a label and the code of the
+    value of each image, so paths are parsed once, at scan time.
+    """
+
+    COLUMNS = ("subject", "image_name", "repetition")
+
+    def __init__(self, pattern, columns):
+        self.pattern = pattern
+        # Column name -> (distinct values, array of one code per image)
+        self.columns = columns
+
+    @classmethod
+    def parse(cls, images_path, pattern=None):
+        """Parse image paths relative to the input directory"""
+        pattern = pattern or naming_pattern
+        regex = re.compile(pattern)
+        categories = {name: {} for name in cls.COLUMNS}
+        codes = {name: array("I") for name in cls.COLUMNS}
+        unmatched = 0
+        for image_path in images_path:
+            path = image_path.replace(os.sep, "/")
+            match = regex.search(path)
+            if match:
+                values = match.group(*cls.COLUMNS)
+            else:
+                # Labelled by directory and file name, rather than dropped
+                unmatched += 1
+                parent, _, name = path.rpartition("/")
+                values = (parent.rpartition("/")[2], os.path.splitext(name)[0], "")
+            for name, value in zip(cls.COLUMNS, values):
+                column = categories[name]
+                codes[name].append(column.setdefault(value, len(column)))
+
+        if unmatched:
+            logger.warning(
+                f"{unmatched} of {len(images_path)} image paths do not match "
+                f"the naming pattern {pattern}"
+            )
+        return cls(
+            pattern,
+            {name: (list(categories[name]), codes[name]) for name in cls.COLUMNS},
+        )
+
+    def __len__(self):
+        return len(self.columns[self.COLUMNS[0]][1])
+
+    def label(self, name, index):
+        """Get the label name of an image"""
+        values, codes = self.columns[name]
+        return values[codes[index]]
+
+    def labels(self, name):
+        """Get the label name of every image"""
+        values, codes = self.columns[name]
+        return [values[code] for code in codes]
+
+    def encode(self, name):
+        """Get a column as {"categories", "codes"}, as sent to the browser"""
+        values, codes = self.columns[name]
+        return {"categories": values, "codes": codes.tolist()}
+
+    def as_dict(self):
+        return {
+            "pattern": self.pattern,
+            "columns": {name: self.encode(name) for name in self.COLUMNS},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["pattern"],
+            {
+                name: (column["categories"], array("I", column["codes"]))
+                for name, column in data["columns"].items()
+            },
+        )
+
+
+def get_file_version(size, mtime):
+    """
+    Get the version of a file from its size and mtime (in nanoseconds), it
+    changes whenever the file is rewritten
+    """
+    return f"{mtime:x}-{size:x}"
+
+
+def build_subject_table(paths, gifs):
+    """
+    Build the table of the subjects of the path table of sorted images.
+
+    Each row holds a subject, the index range [start, stop) of its images
+    and its GIF, with the size and mtime of the GIF, or None if the subject
+    has none. gifs maps the name of each GIF found in input_dir to its size
+    and mtime.
+    """
+    values, codes = paths.columns["subject"]
+    subjects = []
+    previous = None
+    for index, code in enumerate(codes):
+        if code == previous:
+            subjects[-1]["stop"] = index + 1
+            subjects[-1]["image_count"] += 1
+            continue
+        previous = code
+
+        subject = values[code]
+        row = {
+            "subject": subject,
+            "start": index,
+            "stop": index + 1,
+            "image_count": 1,
+            "gif": None,
+            "gif_size": None,
+            "gif_mtime": None,
+        }
+        gif_name = f"{subject}.gif"
+        if gif_name in gifs:
+            gif_size, gif_mtime = gifs[gif_name]
+            row.update(gif=gif_name, gif_size=gif_size, gif_mtime=gif_mtime)
+        subjects.append(row)
+    return subjects
+
+
+# Path tables parsed for images the scan index was not built for, as for a
+# checkpoint of an older scan, by input directory
+parsed_tables = OrderedDict()
+parsed_tables_lock = threading.Lock()
+MAX_PARSED_TABLES = 4
+
+
+def get_path_table(input_dir, images_path, index=None):
+    """
+    Get the path table of images_path, from the scan index if it was
+    built for the same images and naming pattern, or parsed otherwise.
+    index is the scan index of input_dir, loaded if not given.
+    """
+    index = index or ScanIndex.load(input_dir)
+    if (
+        index.paths is not None
+        and index.paths.pattern == naming_pattern
+        and index.images_path == images_path
+    ):
+        return index.paths
+
+    with parsed_tables_lock:
+        cached = parsed_tables.get(input_dir)
+        if cached is not None:
+            parsed_tables.move_to_end(input_dir)
+    if cached is not None:
+        cached_images_path, paths = cached
+        if paths.pattern == naming_pattern and cached_images_path == images_path:
+            return paths
+
+    logger.debug(f"Parsing the paths of {len(images_path)} images")
+    paths = PathTable.parse(images_path)
+    with parsed_tables_lock:
+        parsed_tables[input_dir] = (list(images_path), paths)
+        parsed_tables.move_to_end(input_dir)
+        while len(parsed_tables) > MAX_PARSED_TABLES:
+            parsed_tables.popitem(last=False)
+    return paths
+
+
+def get_subject_table(input_dir, images_path, index=None, paths=None):
+    """
+    Get the subject table of images_path, from the scan index if it was
+    built for the same images, or built from a listing of input_dir.
+    index is the scan index of input_dir and paths the path table of
+    images_path, both looked up if not given.
+    """
+    index = index or ScanIndex.load(input_dir)
+    paths = paths or get_path_table(input_dir, images_path, index)
+    if index.subjects is not None and paths is index.paths:
+        return index.subjects
+
+    logger.debug(f"Building the subject table of {len(images_path)} images")
+    gifs = {}
+    try:
+        with os.scandir(input_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".gif"):
+                    stat = entry.stat()
+                    gifs[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return build_subject_table(paths, gifs)
+
+
+def get_image_versions(index, images_path):
+    """
+    Get the version of each image of images_path from the scan index, or
+    None if the index was not built for the same images
+    """
+    if index.image_versions is None or index.images_path != images_path:
+        return None
+    return index.image_versions
+
+
+# Scan indexes loaded or saved by this worker, by input directory, with the
+# stamp of their file
+loaded_indexes = OrderedDict()
+loaded_indexes_lock = threading.Lock()
+MAX_LOADED_INDEXES = 4
+
+
+class ScanIndex:
+    """
+    Persistent index of the images found under an input directory.
+
+    Each directory listing is stored with the directory mtime, so a rescan
+    only lists the directories that changed since the previous scan.
+    Loaded indexes are kept in memory until their file changes, a scan
+    replaces the listings and tables of its index rather than updating them,
+    so that they can be shared.
+    """
+
+    def __init__(
+        self,
+        input_dir,
+        root=None,
+        directories=None,
+        images_path=None,
+        image_versions=None,
+        paths=None,
+        subjects=None,
+    ):
+        self.input_dir = input_dir
+        # Listing of the input directory itself, holding the subject GIFs
+        self.root = root
+        # Relative directory path -> {"mtime", "racy", "files", "sizes",
+        # "mtimes", "subdirs"}, with the size and mtime of each file
+        self.directories = directories or {}
+        # Naturally sorted relative image paths of the last scan
+        self.images_path = images_path
+        # Version of each image when its directory was listed
+        self.image_versions = image_versions
+        # Path table and subject table of images_path
+        self.paths = paths
+        self.subjects = subjects
+        self.walked = 0
+        self.reused = 0
+        self.dirty = False
+
+    @staticmethod
+    def get_index_path(input_dir):
+        """Get the index file of an input directory"""
+        key = hashlib.sha1(os.path.abspath(input_dir).encode()).hexdigest()
+        return os.path.join(get_cache_dir("scan"), f"{key}.json")
+
+    def as_dict(self):
+        return {
+            "version": SCAN_INDEX_VERSION,
+            "input_dir": self.input_dir,
+            "root": self.root,
+            "directories": self.directories,
+            "images_path": self.images_path,
+            "image_versions": self.image_versions,
+            "paths": self.paths and self.paths.as_dict(),
+            "subjects": self.subjects,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            input_dir=data["input_dir"],
+            root=data["root"],
+            directories=data["directories"],
+            images_path=data["images_path"],
+            image_versions=data["image_versions"],
+            paths=data["paths"] and PathTable.from_dict(data["paths"]),
+            subjects=data["subjects"],
+        )
+
+    def copy(self):
+        """Get an index sharing the listings and tables of this one"""
+        return ScanIndex(
+            self.input_dir,
+            root=self.root,
+            directories=self.directories,
+            images_path=self.images_path,
+            image_versions=self.image_versions,
+            paths=self.paths,
+            subjects=self.subjects,
+        )
+
+    @staticmethod
+    def _get_stamp(index_path):
+        """Get the stamp of an index file, changed by each save"""
+        stat = os.stat(index_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def _remember(cls, index, stamp):
+        with loaded_indexes_lock:
+            loaded_indexes[index.input_dir] = (stamp, index.copy())
+            loaded_indexes.move_to_end(index.input_dir)
+            while len(loaded_indexes) > MAX_LOADED_INDEXES:
+                loaded_indexes.popitem(last=False)
+
+    @classmethod
+    def load(cls, input_dir):
+        """
+        Load the index of input_dir, or an empty index if there is none. The
+        file is only parsed again when it changed since it was last loaded.
+        """
+        index_path = cls.get_index_path(input_dir)
+        try:
+            stamp = cls._get_stamp(index_path)
+        except FileNotFoundError:
+            logger.debug(f"No scan index for {input_dir}")
+            return cls(input_dir)
+
+        with loaded_indexes_lock:
+            cached = loaded_indexes.get(input_dir)
+            if cached is not None and cached[0] == stamp:
+                loaded_indexes.move_to_end(input_dir)
+                return cached[1].copy()
+
+        try:
+            with open(index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable scan index {index_path}: {e}")
+            return cls(input_dir)
+
+        if (
+            data.get("version") != SCAN_INDEX_VERSION
+            or data.get("input_dir") != input_dir
+        ):
+            logger.debug(f"Ignoring outdated scan index {index_path}")
+            return cls(input_dir)
+
+        index = cls.from_dict(data)
+        cls._remember(index, stamp)
+        return index
+
+    def save(self):
+        """Write the index atomically, if the last scan changed it"""
+        if not self.dirty:
+            return
+
+        def write(f):
+            json.dump(self.as_dict(), f)
+            f.flush()
+            # The stamp of the written file, another worker may replace it
+            return os.fstat(f.fileno())
+
+        index_path = self.get_index_path(self.input_dir)
+        stat = write_atomic(index_path, write, fsync=False)
+        self.dirty = False
+        self._remember(self, (stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        logger.debug(f"Scan index saved to {index_path}")
+
+    def _list_directory(self, rel_dir, suffix, previous, scan_time):
+        """
+        List a directory, reusing the previous listing if its mtime is unchanged.
+
+        The size and mtime of the files are kept with the listing, so that
+        their versions are known without a stat per file. A file rewritten
+        in place leaves the directory mtime as is: its version changes once
+        its directory is listed again.
+
+        Returns the listing, or None if the directory does not exist.
+        """
+        full_dir = os.path.join(self.input_dir, rel_dir)
+        try:
+            mtime = os.stat(full_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if previous and previous["mtime"] == mtime and not previous["racy"]:
+            return previous
+
+        files = []
+        sizes = []
+        mtimes = []
+        subdirs = []
+        with os.scandir(full_dir) as entries:
+            for entry in entries:
+                # Hidden entries are skipped, as glob does
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith(suffix):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append(entry.name)
+                    sizes.append(stat.st_size)
+                    mtimes.append(stat.st_mtime_ns)
+
+        return {
+            "mtime": mtime,
+            "racy": scan_time - mtime < RACY_MTIME_WINDOW,
+            "files": files,
+            "sizes": sizes,
+            "mtimes": mtimes,
+            "subdirs": subdirs,
+        }
+
+    @staticmethod
+    def _has_changed(entry, previous):
+        """Check whether a new listing differs from the previous one"""
+        return (
+            previous is None
+            or entry["files"] != previous["files"]
+            or entry["subdirs"] != previous["subdirs"]
+        )
+
+    def _relative_paths(self, directories):
+        """Get the image paths of directory listings, relative to input_dir"""
+        return [
+            os.path.join(self.input_dir, rel_dir, name).replace(self.input_dir, "")
+            for rel_dir, entry in directories.items()
+            for name in entry["files"]
+        ]
+
+    def _file_versions(self, directories):
+        """Get the version of each image of directory listings, by path"""
+        return {
+            os.path.join(self.input_dir, rel_dir, name).replace(
+                self.input_dir, ""
+            ): get_file_version(size, mtime)
+            for rel_dir, entry in directories.items()
+            for name, size, mtime in zip(
+                entry["files"], entry["sizes"], entry["mtimes"]
+            )
+        }
+
+    def _walk(self, top, scan_time, on_directory=None):
+        """
+        Walk the directory tree under top, one directory at a time.
+        on_directory(entry) is called for each directory visited.
+
+        Returns the listings found, whether any of them changed and the
+        number of directories listed and reused.
+        """
+        directories = {}
+        changed = False
+        walked = 0
+        reused = 0
+        stack = [top]
+        while stack:
+            rel_dir = stack.pop()
+            previous = self.directories.get(rel_dir)
+            entry = self._list_directory(rel_dir, ".png", previous, scan_time)
+            if entry is None:
+                continue
+            if entry is previous:
+                reused += 1
+            else:
+                walked += 1
+                changed = changed or self._has_changed(entry, previous)
+            directories[rel_dir] = entry
+            if on_directory:
+                on_directory(entry)
+            stack.extend(os.path.join(rel_dir, name) for name in entry["subdirs"])
+        return directories, changed, walked, reused
+
+    def scan(self, workers=None, on_directory=None, on_first_subject=None):
+        """
+        Scan the input directory, listing only the directories that changed.
+
+        Subject directories under png/ are walked concurrently by up to
+        workers OS threads (scan_workers by default), in natural order, also
+        in the gevent workers of Gunicorn.
+        on_directory(entry) is called for each directory visited, and
+        on_first_subject(images_path) with the sorted images of the first
+        subject, as soon as it is walked.
+
+        Returns the naturally sorted image paths, relative to input_dir,
+        and the GIF files found in input_dir. The path table and the subject
+        table of the images are kept in self.paths and self.subjects.
+        """
+        workers = workers or scan_workers
+        scan_time = time.time_ns()
+
+        root = self._list_directory("", ".gif", self.root, scan_time)
+        if root is None:
+            raise FileNotFoundError(f"Input directory not found: {self.input_dir}")
+        self.walked = 0 if root is self.root else 1
+        self.reused = 1 - self.walked
+
+        # List png/ itself first, then fan out over its subject directories
+        directories = {}
+        changed = False
+        previous = self.directories.get("png")
+        png = self._list_directory("png", ".png", previous, scan_time)
+        if png is not None:
+            directories["png"] = png
+            if png is previous:
+                self.reused += 1
+            else:
+                self.walked += 1
+                changed = self._has_changed(png, previous)
+            if on_directory:
+                on_directory(png)
+
+            # Sort subjects as their paths sort, so that the first subject
+            # walked is the first one of the sorted image paths
+            subject_dirs = natsorted(
+                (os.path.join("png", name) for name in png["subdirs"]),
+                key=lambda rel_dir: rel_dir + os.sep,
+            )
+            walk = partial(self._walk, scan_time=scan_time, on_directory=on_directory)
+            with get_thread_pool(workers) as executor:
+                results = executor.map(walk, subject_dirs)
+                for subject_directories, subject_changed, walked, reused in results:
+                    first_images = on_first_subject and self._relative_paths(
+                        subject_directories
+                    )
+                    if first_images:
+                        on_first_subject(natsorted(first_images))
+                        on_first_subject = None
+                    directories.update(subject_directories)
+                    changed = changed or subject_changed
+                    self.walked += walked
+                    self.reused += reused
+
+        changed = changed or directories.keys() != self.directories.keys()
+        if changed or self.images_path is None:
+            self.images_path = natsorted(self._relative_paths(directories))
+
+        # Any directory listed again may hold files rewritten since
+        if changed or self.walked > 0 or self.image_versions is None:
+            versions = self._file_versions(directories)
+            self.image_versions = [versions[path] for path in self.images_path]
+
+        # Paths are parsed again only when the images or the pattern changed
+        if changed or self.paths is None or self.paths.pattern != naming_pattern:
+            self.paths = PathTable.parse(self.images_path)
+            self.subjects = None
+
+        # GIFs are only looked up again when the images or the GIFs changed
+        if self.subjects is None or root is not self.root:
+            self.subjects = build_subject_table(
+                self.paths,
+                {
+                    name: (size, mtime)
+                    for name, size, mtime in zip(
+                        root["files"], root["sizes"], root["mtimes"]
+                    )
+                },
+            )
+            changed = True
+            missing = [row["subject"] for row in self.subjects if row["gif"] is None]
+            if missing:
+                logger.warning(
+                    f"{len(missing)} subjects without GIF in {self.input_dir}: "
+                    f"{', '.join(missing[:10])}{'...' if len(missing) > 10 else ''}"
+                )
+
+        self.dirty = self.dirty or changed or self.walked > 0
+        self.root = root
+        self.directories = directories
+
+        logger.info(
+            f"Scanned {self.input_dir}: {self.walked} directories listed, "
+            f"{self.reused} reused"
+        )
+
+        gif_files = [os.path.join(self.input_dir, name) for name in root["files"]]
+        return self.images_path, gif_files
+
+
+def scan_directory(input_dir):
+    """Scan input_dir for images and GIFs, reusing its persistent scan index"""
+    index = ScanIndex.load(input_dir)
+    images_path, gif_files = index.scan()
+    index.save()
+    return images_path, gif_files
+
+
+# Seconds a finished scan job is kept, after which its tab has to scan again
+SCAN_JOB_TTL = 3600
+
+# Seconds between two writes of the progress of a running scan
+SCAN_STATE_INTERVAL = 0.5
+
+
+def get_scan_database():
+    """Get the session database sharing the scan jobs, None to share files"""
+    # Imported here, the session store depends on this module
+    from bqc_dash.session.server import get_session_database
+
+    return get_session_database()
+
+
+def get_scan_state_path(key, suffix=".json"):
+    """Get the file holding the state of the scan job of a session key"""
+    name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(get_cache_dir("scan_jobs"), name + suffix)
+
+
+@contextmanager
+def locked_scan_state(key):
+    """Lock the state files of a session key against the other workers"""
+    path = get_scan_state_path(key, ".lock")
+    with open(path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # Keep the lock from expiring with the other files of a running job
+        os.utime(path)
+        yield
+
+
+def write_scan_state(key, state, start=False):
+    """
+    Write the state of a scan job atomically, for the other workers. Unless
+    the job starts, and replaces the previous job of the key, the state is
+    only written while the job is the last one of the key: returns False
+    when another job replaced it.
+    """
+    database = get_scan_database()
+    if database is not None:
+        return database.put_scan_state(json.dumps(key), state, start)
+    path = get_scan_state_path(key)
+    with locked_scan_state(key):
+        if not start:
+            current = read_scan_state(key)
+            if current is None or current["id"] != state["id"]:
+                return False
+        write_atomic(path, lambda f: json.dump(state, f), fsync=False)
+    return True
+
+
+def read_scan_state(key):
+    """Read the state of the scan job of a session key, None if there is none"""
+    database = get_scan_database()
+    if database is not None:
+        return database.get_scan_state(json.dumps(key))
+    try:
+        with open(get_scan_state_path(key), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable scan job state: {e}")
+        return None
+
+
+def claim_scan_publish(key, job_id):
+    """
+    Claim the publication of the first subject of a scan job. Only the first
+    caller, in any worker, gets True, and only while the job is the last one
+    of the key.
+    """
+    database = get_scan_database()
+    if database is not None:
+        return database.claim_scan_publish(json.dumps(key), job_id)
+    path = get_scan_state_path(key, ".published")
+    with locked_scan_state(key):
+        current = read_scan_state(key)
+        if current is None or current["id"] != job_id:
+            return False
+        if read_scan_publish(key) == job_id:
+            return False
+        # A marker of a previous job of the key is replaced
+        write_atomic(path, lambda f: f.write(job_id), fsync=False)
+    return True
+
+
+def read_scan_publish(key):
+    """Get the id of the scan job whose first subject was published"""
+    database = get_scan_database()
+    if database is not None:
+        return database.get_scan_publish(json.dumps(key))
+    try:
+        with open(get_scan_state_path(key, ".published"), "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def drop_expired_scan_states(now=None):
+    """Remove the scan job states not updated for SCAN_JOB_TTL seconds"""
+    expiry = (now or time.time()) - SCAN_JOB_TTL
+    database = get_scan_database()
+    if database is not None:
+        database.drop_scan_states(expiry)
+        return
+    with os.scandir(get_cache_dir("scan_jobs")) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expiry:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class ScanCancelled(Exception):
+    """Raised in a scan job replaced by a new scan of its session key"""
+
+
+class ScanJob:
+    """
+    Scan of an input directory running in a background OS thread.
+
+    The progress and outcome of the scan are written to the session database,
+    or to a state file of the session key, so that any worker can report
+    them. The images of a finished scan are read back from the scan index.
+    A job stops, and no longer writes its state, once a new job of its
+    session key started, in this worker or in another one.
+    """
+
+    def __init__(self, input_dir, key=None, workers=None):
+        self.input_dir = input_dir
+        self.key = key
+        self.workers = workers
+        self.id = uuid.uuid4().hex
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.directories_visited = 0
+        self.images_found = 0
+        # Images of the first subject, navigable before the scan completes
+        self.first_images_path = None
+        self.images_path = None
+        self.gif_files = None
+        self.subjects = None
+        self.error = None
+        self.done = False
+        self.start_time = None
+        self.duration = None
+        self.finished_at = None
+        self.cancelled = False
+        self._state_time = 0
+        # Shared with the threads walking the directories
+        self._lock = get_thread_lock()
+
+    def as_state(self):
+        return {
+            "id": self.id,
+            "input_dir": self.input_dir,
+            "host": self.host,
+            "pid": self.pid,
+            "directories_visited": self.directories_visited,
+            "images_found": self.images_found,
+            "first_images_path": self.first_images_path,
+            "error": None if self.error is None else str(self.error),
+            "done": self.finished_at is not None,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "finished_at": self.finished_at,
+        }
+
+    @classmethod
+    def from_state(cls, key, state):
+        """Get the scan job another worker runs or ran from its state"""
+        job = cls(state["input_dir"], key)
+        for name in (
+            "id",
+            "host",
+            "pid",
+            "directories_visited",
+            "images_found",
+            "first_images_path",
+            "error",
+            "done",
+            "start_time",
+            "duration",
+            "finished_at",
+        ):
+            setattr(job, name, state[name])
+
+        if not job.done and not job._is_running():
+            job.error = "the server process scanning the directory stopped"
+            job.done = True
+        elif job.done and job.error is None:
+            index = ScanIndex.load(job.input_dir)
+            if index.images_path is None:
+                job.error = "the scan index of the directory was removed"
+            else:
+                job.images_path = index.images_path
+                job.subjects = index.subjects
+        return job
+
+    def _is_running(self):
+        """Check whether the process running the scan is still alive"""
+        if self.host != socket.gethostname() or self.pid == os.getpid():
+            return True
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def save_state(self, force=False, start=False):
+        """
+        Write the state of the job, at most every SCAN_STATE_INTERVAL, and
+        cancel the job if another job of its session key replaced it
+        """
+        if self.key is None or self.cancelled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._state_time < SCAN_STATE_INTERVAL:
+                return
+            self._state_time = now
+            state = self.as_state()
+        try:
+            written = write_scan_state(self.key, state, start)
+        except OSError as e:
+            logger.warning(f"Cannot write the scan job state: {e}")
+            return
+        if not written:
+            self.cancel()
+
+    @property
+    def first_published(self):
+        """Check whether the first subject of the scan was published"""
+        return self.key is not None and read_scan_publish(self.key) == self.id
+
+    def publish_first(self):
+        """Claim the publication of the first subject, True only once"""
+        return self.key is not None and claim_scan_publish(self.key, self.id)
+
+    def start(self):
+        """Start the scan in the background"""
+        self.start_time = time.time()
+        self.save_state(force=True, start=True)
+        # An OS thread, a greenlet would block the other requests of the worker
+        start_thread(self._run, f"scan-{self.input_dir}")
+        return self
+
+    def cancel(self):
+        """Stop the scan at the next directory, leaving the index as it was"""
+        if not self.cancelled:
+            logger.info(f"Scan job of {self.input_dir} replaced, cancelling it")
+        self.cancelled = True
+
+    def _on_directory(self, entry):
+        if self.cancelled:
+            raise ScanCancelled()
+        with self._lock:
+            self.directories_visited += 1
+            self.images_found += len(entry["files"])
+        self.save_state()
+
+    def _on_first_subject(self, images_path):
+        self.first_images_path = images_path
+        self.save_state(force=True)
+
+    def _run(self):
+        try:
+            index = ScanIndex.load(self.input_dir)
+            images_path, gif_files = index.scan(
+                self.workers,
+                on_directory=self._on_directory,
+                on_first_subject=self._on_first_subject,
+            )
+            # The other workers read the images from the saved index
+            index.save()
+            self.images_path = images_path
+            self.gif_files = gif_files
+            self.subjects = index.subjects
+        except ScanCancelled as e:
+            self.error = e
+        except Exception as e:
+            logger.critical(f"Error scanning directory: {self.input_dir}")
+            logger.critical(traceback.format_exc())
+            self.error = e
+        finally:
+            self.finished_at = time.time()
+            self.duration = self.finished_at - self.start_time
+            if not self.cancelled:
+                performance.record("scan", self.duration, metric="scan")
+            # The final state is written before the job is seen done here,
+            # the worker may exit right after
+            self.save_state(force=True)
+            self.done = True
+
+    def progress(self):
+        """Get a summary of the scan progress"""
+        with self._lock:
+            return (
+                f"{self.directories_visited} directories visited, "
+                f"{self.images_found} images found"
+            )
+
+
+# Scan jobs started by this worker by session key, only the last scan of each
+# tab is kept, for SCAN_JOB_TTL seconds after it finishes
+scan_jobs = {}
+scan_jobs_lock = threading.Lock()
+
+
+def drop_expired_scan_jobs():
+    """Forget the scan jobs finished more than SCAN_JOB_TTL seconds ago"""
+    now = time.time()
+    with scan_jobs_lock:
+        for key, job in list(scan_jobs.items()):
+            if job.done and now - job.finished_at > SCAN_JOB_TTL:
+                del scan_jobs[key]
+    try:
+        drop_expired_scan_states(now)
+    except OSError as e:
+        logger.warning(f"Cannot remove expired scan job states: {e}")
+
+
+def start_scan_job(key, input_dir):
+    """Start scanning input_dir in the background for the session key"""
+    drop_expired_scan_jobs()
+    job = ScanJob(input_dir, key)
+    with scan_jobs_lock:
+        previous = scan_jobs.get(key)
+        if previous is not None:
+            previous.cancel()
+        scan_jobs[key] = job
+    return job.start()
+
+
+def get_scan_job(key):
+    """
+    Get the last scan job of the session key, started by this worker or
+    by another one
+    """
+    with scan_jobs_lock:
+        job = scan_jobs.get(key)
+    state = None if key is None else read_scan_state(key)
+    if state is None or (job is not None and state["id"] == job.id):
+        return job
+    return ScanJob.from_state(key, state)
@@ -0,0 +1,3 @@
+from .server import SessionStore
+
+sessions = SessionStore()
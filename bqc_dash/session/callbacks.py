@@ -0,0 +1,18 @@
+from bqc_dash.logger import logger
+from bqc_dash.session import sessions
+from bqc_dash.toaster.callbacks import send_notification, ToastException
+
+
+def get_current_session(session_id, tab_id, toast_data):
+    """Get the session of the tab, notifying the user if the server has none"""
+    session = sessions.get(session_id, tab_id)
+    if session is None:
+        logger.error("Session not found on the server")
+        notification = send_notification(
+            "Session not found on the server, scan the input directory "
+            "or load a checkpoint",
+            "warning",
+            duration=5,
+        )(toast_data)
+        raise ToastException(notification)
+    return session
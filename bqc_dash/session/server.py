@@ -0,0 +1,530 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from bqc_dash.checkpoint.server import Session
+from bqc_dash.logger import logger
+from bqc_dash.rejection.server import Bitset
+from bqc_dash.utils import get_cache_dir
+
+# Sessions not accessed for this many seconds are dropped
+session_ttl = float(os.getenv("BQC_SESSION_TTL", str(24 * 3600)))
+
+# Sessions are kept in the memory of each worker, or in a SQLite database
+# shared by all the workers of the server
+SESSION_STORES = ("memory", "sqlite")
+session_store = os.getenv("BQC_SESSION_STORE", "memory")
+session_db = os.getenv("BQC_SESSION_DB")
+
+# Seconds between two updates of the access time of a stored session
+ACCESS_RESOLUTION = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    key TEXT PRIMARY KEY,
+    id TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    revision INTEGER NOT NULL,
+    current_index INTEGER,
+    accessed_at REAL NOT NULL,
+    snapshot BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS decisions (
+    key TEXT NOT NULL,
+    image_index INTEGER NOT NULL,
+    rejected INTEGER NOT NULL,
+    reviewed INTEGER NOT NULL,
+    revision INTEGER NOT NULL,
+    PRIMARY KEY (key, image_index)
+);
+CREATE INDEX IF NOT EXISTS decisions_revision ON decisions (key, revision);
+CREATE TABLE IF NOT EXISTS datasets (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dataset_access (
+    key TEXT PRIMARY KEY,
+    accessed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scan_jobs (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    published TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journals (
+    path TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    generation TEXT NOT NULL,
+    dataset_id TEXT,
+    events INTEGER NOT NULL,
+    current_index INTEGER,
+    size INTEGER NOT NULL,
+    rejected BLOB NOT NULL,
+    reviewed BLOB NOT NULL
+);
+"""
+
+
+def get_session_key(session_id, tab_id):
+    """Get the store key from the session-id-store and tab-id-store data"""
+    if not session_id or not tab_id:
+        return None
+    return (session_id.get("session-id"), tab_id.get("tab-id"))
+
+
+def set_session_store(store=None, path=None):
+    """Keep the sessions in memory or in the SQLite database at path"""
+    global session_store, session_db
+    if store is not None:
+        if store not in SESSION_STORES:
+            raise ValueError(f"Unknown session store {store}")
+        session_store = store
+    if path is not None:
+        session_db = path
+
+
+class SessionDatabase:
+    """
+    SQLite database of the sessions, shared by the worker processes.
+
+    A session is stored as a binary checkpoint snapshot, rewritten only when
+    its image paths change, and one decision row per image flagged since.
+    Every change bumps the revision of the session, so that a worker brings
+    its copy up to date by reading only the decisions of newer revisions.
+    The database is in WAL mode: readers never wait for the writer, and
+    writers are serialized by immediate transactions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        """Get the connection of the thread, a forked worker opens its own"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def transaction(self, write=True):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _get_row(connection, key):
+        return connection.execute(
+            "SELECT id, generation, revision, current_index, accessed_at "
+            "FROM sessions WHERE key = ?",
+            (key,),
+        ).fetchone()
+
+    def _write_snapshot(self, connection, key, session):
+        """Store the whole session, replacing its decisions"""
+        row = self._get_row(connection, key)
+        generation = row[1] + 1 if row else 1
+        connection.execute("DELETE FROM decisions WHERE key = ?", (key,))
+        connection.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, 0, ?, ?, ?)",
+            (
+                key,
+                session.id,
+                generation,
+                session.current_index,
+                time.time(),
+                session.as_bytes(),
+            ),
+        )
+        session.database = self
+        session.database_key = key
+        session.generation = generation
+        session.revision = 0
+
+    def _load(self, connection, key, row):
+        """Load a session from its snapshot"""
+        (snapshot,) = connection.execute(
+            "SELECT snapshot FROM sessions WHERE key = ?", (key,)
+        ).fetchone()
+        session = Session.from_bytes(snapshot)
+        session.id = row[0]
+        session.database = self
+        session.database_key = key
+        session.generation = row[1]
+        return session
+
+    @staticmethod
+    def _refresh(connection, session, row):
+        """Apply the decisions written since the revision of the session"""
+        if row[2] != session.revision:
+            decisions = connection.execute(
+                "SELECT image_index, rejected, reviewed FROM decisions "
+                "WHERE key = ? AND revision > ?",
+                (session.database_key, session.revision),
+            )
+            size = len(session.images_path)
+            for index, rejected, reviewed in decisions:
+                if index < size:
+                    session.rejected_images.set(index, rejected)
+                    session.reviewed_images.set(index, reviewed)
+            session.revision = row[2]
+        session.current_index = row[3]
+
+    def put_session(self, key, session):
+        with session.lock, self.transaction() as connection:
+            self._write_snapshot(connection, key, session)
+            # Sessions expire with their decisions
+            expired = connection.execute(
+                "DELETE FROM sessions WHERE accessed_at < ?",
+                (time.time() - session_ttl,),
+            ).rowcount
+            if expired:
+                logger.info(f"Dropping {expired} expired sessions")
+                connection.execute(
+                    "DELETE FROM decisions WHERE key NOT IN (SELECT key FROM sessions)"
+                )
+        return session
+
+    def get_session(self, key, cached=None):
+        """Get the session of key up to date, reusing the cached copy if any"""
+        with self.transaction(write=False) as connection:
+            row = self._get_row(connection, key)
+            if row is None:
+                return None
+            if cached is None or (cached.id, cached.generation) != row[:2]:
+                session = self._load(connection, key, row)
+            else:
+                session = cached
+            with session.lock:
+                self._refresh(connection, session, row)
+        if time.time() - row[4] > ACCESS_RESOLUTION:
+            with self.transaction() as connection:
+                connection.execute(
+                    "UPDATE sessions SET accessed_at = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        return session
+
+    @contextmanager
+    def sync(self, session, snapshot=False):
+        """
+        Change a session in a write transaction, see Session.synced.
+
+        The changes are written as decisions of a new revision, or as a new
+        snapshot of the session.
+        """
+        key = session.database_key
+        with self.transaction() as connection:
+            row = self._get_row(connection, key)
+            if row is None:
+                # Expired or dropped meanwhile, the session is stored again
+                snapshot = True
+            elif (session.id, session.generation) != row[:2]:
+                # Replaced by another worker, the change applies to the new one
+                logger.warning(f"Session {key} replaced by another worker")
+                current = self._load(connection, key, row)
+                for name in ("id", "input_dir", "images_path", "timestamp"):
+                    setattr(session, name, getattr(current, name))
+                session.rejected_images = current.rejected_images
+                session.reviewed_images = current.reviewed_images
+                session.generation = current.generation
+                session.revision = 0
+            if row is not None:
+                self._refresh(connection, session, row)
+
+            changed = set()
+            yield changed
+
+            if snapshot:
+                self._write_snapshot(connection, key, session)
+                return
+            revision = session.revision + 1
+            connection.executemany(
+                "INSERT INTO decisions VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key, image_index) DO UPDATE SET "
+                "rejected = excluded.rejected, reviewed = excluded.reviewed, "
+                "revision = excluded.revision",
+                [
+                    (
+                        key,
+                        index,
+                        session.rejected_images.get(index),
+                        session.reviewed_images.get(index),
+                        revision,
+                    )
+                    for index in sorted(changed)
+                ],
+            )
+            connection.execute(
+                "UPDATE sessions SET revision = ?, current_index = ?, accessed_at = ? "
+                "WHERE key = ?",
+                (revision, session.current_index, time.time(), key),
+            )
+            session.revision = revision
+
+    def drop_session(self, key):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            connection.execute("DELETE FROM decisions WHERE key = ?", (key,))
+
+    def count_sessions(self):
+        with self.transaction(write=False) as connection:
+            return connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def put_dataset(self, key, data, keep=None):
+        """Store a dataset table, dropping all but the keep last used ones"""
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO datasets VALUES (?, ?)", (key, data)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO dataset_access VALUES (?, ?)",
+                (key, time.time()),
+            )
+            if keep is not None:
+                connection.execute(
+                    "DELETE FROM datasets WHERE key IN (SELECT key FROM "
+                    "dataset_access ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (keep,),
+                )
+                connection.execute(
+                    "DELETE FROM dataset_access "
+                    "WHERE key NOT IN (SELECT key FROM datasets)"
+                )
+
+    def touch_dataset(self, key):
+        """Mark a dataset table as used, False if it was dropped"""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE dataset_access SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return cursor.rowcount > 0
+
+    def get_dataset(self, key):
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                "SELECT data FROM datasets WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_scan_state(self, key, state, start=False):
+        """
+        Store the state of a scan job. Unless the job starts, and replaces
+        the previous job of the key, False if another job replaced it.
+        """
+        with self.transaction() as connection:
+            if start:
+                connection.execute(
+                    "INSERT INTO scan_jobs VALUES (?, ?, NULL, ?) ON CONFLICT (key) "
+                    "DO UPDATE SET state = excluded.state, "
+                    "updated_at = excluded.updated_at",
+                    (key, json.dumps(state), time.time()),
+                )
+                return True
+            cursor = connection.execute(
+                "UPDATE scan_jobs SET state = ?, updated_at = ? "
+                "WHERE key = ? AND json_extract(state, '$.id') = ?",
+                (json.dumps(state), time.time(), key, state["id"]),
+            )
+            return cursor.rowcount > 0
+
+    def get_scan_state(self, key):
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                "SELECT state FROM scan_jobs WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def claim_scan_publish(self, key, job_id):
+        """
+        Mark the first subject of a scan job published, False if it was or if
+        another job of the key replaced it
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE scan_jobs SET published = ? WHERE key = ? "
+                "AND json_extract(state, '$.id') = ? "
+                "AND (published IS NULL OR published != ?)",
+                (job_id, key, job_id, job_id),
+            )
+            return cursor.rowcount > 0
+
+    def get_scan_publish(self, key):
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                "SELECT published FROM scan_jobs WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def drop_scan_states(self, expiry):
+        """Remove the scan job states not updated since expiry"""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM scan_jobs WHERE updated_at < ?", (expiry,))
+
+    def put_journal_state(self, path, state):
+        """Store the state of the last save of a checkpoint journal"""
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO journals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    json.dumps(state["stamp"]),
+                    state["generation"],
+                    state["dataset_id"],
+                    state["events"],
+                    state["current_index"],
+                    state["rejected"].size,
+                    bytes(state["rejected"].data),
+                    bytes(state["reviewed"].data),
+                ),
+            )
+
+    def get_journal_state(self, path, stamp):
+        """Get the state of the last save of a journal, if its files match stamp"""
+        with self.transaction(write=False) as connection:
+            row = connection.execute(
+                "SELECT generation, dataset_id, events, current_index, size, "
+                "rejected, reviewed FROM journals WHERE path = ? AND stamp = ?",
+                (path, json.dumps(stamp)),
+            ).fetchone()
+        if row is None:
+            return None
+        generation, dataset_id, events, current_index, size, rejected, reviewed = row
+        return {
+            "stamp": stamp,
+            "generation": generation,
+            "dataset_id": dataset_id,
+            "events": events,
+            "current_index": current_index,
+            "rejected": Bitset(size, rejected),
+            "reviewed": Bitset(size, reviewed),
+        }
+
+
+session_databases = {}
+session_databases_lock = threading.Lock()
+
+
+def get_session_database():
+    """Get the session database, or None if sessions are kept in memory"""
+    if session_store != "sqlite":
+        return None
+    path = session_db or os.path.join(get_cache_dir(), "sessions.sqlite3")
+    with session_databases_lock:
+        database = session_databases.get(path)
+        if database is None:
+            logger.info(f"Storing sessions in {path}")
+            database = session_databases[path] = SessionDatabase(path)
+    return database
+
+
+def get_database_key(key):
+    return "\0".join(key)
+
+
+class SessionStore:
+    """
+    Server-side store of the review sessions, keyed by session and tab ids.
+
+    The browser only holds the ids and small handles, while the image paths
+    and rejections of each session stay on the server.
+    With the SQLite store, every worker keeps a copy of the sessions it
+    served, brought up to date from the session database on each access.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._last_access = {}
+        self._lock = threading.Lock()
+        # Called with the key of each session dropped, expired or replaced
+        self._drop_listeners = []
+
+    def on_drop(self, listener):
+        """Call listener(key) when the session of key leaves this worker"""
+        self._drop_listeners.append(listener)
+
+    def _notify_drop(self, keys):
+        for key in keys:
+            for listener in self._drop_listeners:
+                listener(key)
+
+    def get(self, session_id, tab_id):
+        """Get the session of a tab, or None if there is none"""
+        key = get_session_key(session_id, tab_id)
+        database = get_session_database()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._last_access[key] = time.time()
+        if database is not None and key is not None:
+            # The copy of this worker is brought up to date from the database
+            cached = session
+            session = database.get_session(get_database_key(key), cached)
+            with self._lock:
+                if session is None:
+                    self._sessions.pop(key, None)
+                    self._last_access.pop(key, None)
+                else:
+                    self._sessions[key] = session
+                    self._last_access[key] = time.time()
+            if cached is not None and session is not cached:
+                self._notify_drop([key])
+        if session is None:
+            logger.warning(f"No session found for {key}")
+        return session
+
+    def put(self, session_id, tab_id, session):
+        """Store the session of a tab, replacing the previous one"""
+        key = get_session_key(session_id, tab_id)
+        if key is None:
+            raise ValueError("Session and tab ids are required to store a session")
+        database = get_session_database()
+        if database is not None:
+            database.put_session(get_database_key(key), session)
+        now = time.time()
+        with self._lock:
+            previous = self._sessions.get(key)
+            self._sessions[key] = session
+            self._last_access[key] = now
+            # With the database, only the copies of this worker expire here
+            expired = [k for k, t in self._last_access.items() if now - t > session_ttl]
+            for k in expired:
+                logger.info(f"Dropping expired session {k}")
+                del self._sessions[k]
+                del self._last_access[k]
+        if previous is not None and previous is not session:
+            expired.append(key)
+        self._notify_drop(expired)
+        return session
+
+    def drop(self, session_id, tab_id):
+        """Remove the session of a tab"""
+        key = get_session_key(session_id, tab_id)
+        database = get_session_database()
+        if database is not None and key is not None:
+            database.drop_session(get_database_key(key))
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._last_access.pop(key, None)
+        self._notify_drop([key])
+
+    def __len__(self):
+        database = get_session_database()
+        if database is not None:
+            return database.count_sessions()
+        return len(self._sessions)
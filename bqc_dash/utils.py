@@ -1,19 +1,94 @@
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
-def get_information_from_path(input_dir, path):
-    """Extract information from the image path"""
-    # Example: Extract subject and repetition from the path
-    # Assuming the path is structured as: <input_dir>/png/<subject>/<image_name>_<repetition>.png
-    parts = path.split(os.sep)
-    subject = parts[-2]  # Assuming the subject is in the second last part of the path
-    image_name, repetition = os.path.splitext(parts[-1])[0].rsplit("_", 1)
-    return subject, image_name, repetition
+def get_cache_dir(*parts):
+    """
+    get cache directory, created on first use
+    Defaults to ~/.cache/bqc_dash and can be changed with BQC_CACHE_DIR
+    """
+    default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "bqc_dash")
+    cache_dir = os.path.join(os.getenv("BQC_CACHE_DIR", default_cache_dir), *parts)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def write_atomic(filename, write, mode="w", fsync=True):
+    """
+    Write a file with write(f) through a temporary file and a rename, and
+    return what write returns. Files that can be rebuilt, as the caches, are
+    written without fsync.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=f".{os.path.basename(filename)}.",
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            result = write(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return result
+
+
+def is_gevent_patched():
+    """Check whether gevent patched threading, as in the Gunicorn workers"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def get_thread_pool(max_workers):
+    """
+    Get a ThreadPoolExecutor running its tasks on OS threads. Under gevent,
+    the threads of the standard executor are greenlets, which would run
+    blocking file system calls one after the other on the event loop.
+    """
+    if is_gevent_patched():
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+
+        return GeventThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
 
 
-def get_gif_path(input_dir, image_path):
+def get_thread_lock():
     """
-    get git path from image path
+    Get a lock of OS threads. Under gevent, threading.Lock is a lock of
+    greenlets, which cannot be shared with the threads of get_thread_pool().
     """
-    (subject, image_name, repetition) = get_information_from_path(input_dir, image_path)
-    return f"{subject}.gif"
+    if is_gevent_patched():
+        from gevent import monkey
+
+        return monkey.get_original("_thread", "allocate_lock")()
+    return threading.Lock()
+
+
+def start_thread(target, name):
+    """Run target in a daemon OS thread, also when gevent patched threading"""
+    if is_gevent_patched():
+        from gevent import monkey
+
+        monkey.get_original("_thread", "start_new_thread")(target, ())
+        return
+    threading.Thread(target=target, name=name, daemon=True).start()
+
+
+def run_in_thread(func, *args):
+    """
+    Call func on a thread of the gevent hub when gevent patched threading, so
+    that CPU bound work releasing the GIL does not block the event loop
+    """
+    if is_gevent_patched():
+        import gevent
+
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from bqc_dash.autosave import server as autosave_server
+from bqc_dash.autosave.server import AutoSaver
+from bqc_dash.checkpoint.server import Session, load_session
+
+DELAY = 0.1
+
+
+@pytest.fixture
+def saves(monkeypatch):
+    """Paths of the checkpoints written by the autosave"""
+    monkeypatch.setattr(autosave_server, "autosave_delay", DELAY)
+    monkeypatch.setattr(autosave_server, "autosave_enabled", True)
+    saves = []
+    save_checkpoint = autosave_server.save_checkpoint
+
+    def counting_save_checkpoint(path, *args, **kwargs):
+        saves.append(path)
+        return save_checkpoint(path, *args, **kwargs)
+
+    monkeypatch.setattr(autosave_server, "save_checkpoint", counting_save_checkpoint)
+    return saves
+
+
+def wait_saved(autosaver, key, count, saves, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(saves) < count or autosaver.last_saved(key) is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # Nothing else is written once the session stops changing
+    time.sleep(3 * DELAY)
+
+
+def test_burst_saved_once(saves, tmp_path):
+    images_path = [f"/png/sub-1/sub-1_{i}.png" for i in range(20)]
+    session = Session("input", images_path, 0, {})
+    path = str(tmp_path / "auto_save.json")
+    autosaver = AutoSaver()
+    key = ("session", "tab")
+
+    # The burst lasts longer than the delay, but no pause reaches it
+    for index in range(10):
+        session.toggle_rejected(index)
+        autosaver.schedule(key, session, path)
+        time.sleep(DELAY / 4)
+    wait_saved(autosaver, key, 1, saves)
+    assert saves == [path]
+    assert load_session(path).rejected_images == session.rejected_images
+
+    session.toggle_rejected(0)
+    autosaver.schedule(key, session, path)
+    wait_saved(autosaver, key, 2, saves)
+    assert saves == [path, path]
+    assert not load_session(path).rejected_images.get(0)
+
+
+def test_unchanged_session_not_saved(saves, tmp_path):
+    session = Session("input", ["/png/sub-1/sub-1_1.png"], 0, {})
+    autosaver = AutoSaver()
+    autosaver.schedule(("session", "tab"), session, str(tmp_path / "auto_save.json"))
+    time.sleep(3 * DELAY)
+    assert saves == []
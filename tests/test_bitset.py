@@ -0,0 +1,67 @@
+import pytest
+
+from bqc_dash.rejection.server import Bitset
+
+# Sizes around and between byte boundaries
+SIZES = [0, 1, 7, 8, 9, 13, 63, 65, 1001]
+
+
+def get_indices(size):
+    return [index for index in range(size) if index % 3 == 0 or index == size - 1]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(size):
+    indices = get_indices(size)
+    bitset = Bitset.from_indices(size, indices)
+    assert len(bitset.data) == (size + 7) // 8
+    assert list(bitset.indices()) == indices
+    assert bitset.count() == len(indices)
+    assert bitset.to_bools() == [index in indices for index in range(size)]
+
+    decoded = Bitset.from_base64(size, bitset.to_base64())
+    assert decoded == bitset
+    assert list(decoded.indices()) == indices
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_from_dict(size):
+    indices = get_indices(size)
+    flags = {str(index): index in indices for index in range(size)}
+    assert Bitset.from_dict(size, flags) == Bitset.from_indices(size, indices)
+
+
+@pytest.mark.parametrize("size", [9, 13, 1001])
+def test_last_index(size):
+    bitset = Bitset(size)
+    assert bitset.toggle(size - 1)
+    assert list(bitset.indices()) == [size - 1]
+    with pytest.raises(IndexError):
+        bitset.get(size)
+    with pytest.raises(IndexError):
+        bitset.set(-1)
+
+
+def test_wrong_data_length():
+    with pytest.raises(ValueError):
+        Bitset(9, b"\x00")
+    with pytest.raises(ValueError):
+        Bitset(8, b"\x00\x00")
+
+
+@pytest.mark.parametrize("size,new_size", [(13, 9), (13, 3), (9, 13), (16, 21)])
+def test_resize(size, new_size):
+    bitset = Bitset.from_indices(size, range(size))
+    bitset.resize(new_size)
+    assert len(bitset.data) == (new_size + 7) // 8
+    assert list(bitset.indices()) == list(range(min(size, new_size)))
+    # The padding bits past the last image stay clear
+    assert Bitset(new_size, bitset.data) == bitset
+
+
+def test_xor():
+    first = Bitset.from_indices(13, [0, 5, 12])
+    second = Bitset.from_indices(13, [5, 7])
+    assert list((first ^ second).indices()) == [0, 7, 12]
+    with pytest.raises(ValueError):
+        first ^ Bitset(9)
@@ -0,0 +1,77 @@
+import struct
+
+import pytest
+
+from bqc_dash.checkpoint.server import (
+    BINARY_MAGIC,
+    BINARY_PREFIX,
+    Session,
+    load_session,
+    save_session,
+)
+
+
+@pytest.fixture
+def session():
+    images_path = [f"png/sub-{i % 4}/sub-{i % 4}_{i}.png" for i in range(29)]
+    session = Session("input", images_path, 5, {})
+    for index in (0, 9, 28):
+        session.toggle_rejected(index)
+    session.mark_reviewed(range(13))
+    return session
+
+
+def assert_same(loaded, session):
+    assert loaded.input_dir == session.input_dir
+    assert loaded.images_path == session.images_path
+    assert loaded.rejected_images == session.rejected_images
+    assert loaded.reviewed_images == session.reviewed_images
+    assert loaded.current_index == session.current_index
+    assert loaded.timestamp == session.timestamp
+
+
+def test_round_trip(session, tmp_path):
+    assert_same(Session.from_bytes(session.as_bytes()), session)
+
+    checkpoint = str(tmp_path / "checkpoint.bqck")
+    save_session(checkpoint, session, binary=True)
+    with open(checkpoint, "rb") as f:
+        assert f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    assert_same(load_session(checkpoint), session)
+
+
+def test_empty_session(tmp_path):
+    session = Session("input", [], 0, {})
+    checkpoint = str(tmp_path / "checkpoint.bqck")
+    save_session(checkpoint, session, binary=True)
+    assert_same(load_session(checkpoint), session)
+
+
+def test_truncated_file(session, tmp_path):
+    data = session.as_bytes()
+    checkpoint = tmp_path / "checkpoint.bqck"
+    # In the sections, the header, and the prefix
+    for length in (len(data) - 1, len(data) - 20, BINARY_PREFIX.size + 10, 6):
+        checkpoint.write_bytes(data[:length])
+        # The decoding error, not a BufferError of the memory map
+        with pytest.raises((ValueError, struct.error)):
+            load_session(str(checkpoint))
+
+
+def test_corrupt_section(session, tmp_path):
+    data = bytearray(session.as_bytes())
+    # The compressed directories follow the header
+    (header_size,) = struct.unpack_from("<I", data, 6)
+    data[BINARY_PREFIX.size + header_size] ^= 0xFF
+    checkpoint = tmp_path / "checkpoint.bqck"
+    checkpoint.write_bytes(bytes(data))
+    with pytest.raises(Exception) as error:
+        load_session(str(checkpoint))
+    assert not isinstance(error.value, BufferError)
+
+
+def test_unsupported_version(session):
+    data = bytearray(session.as_bytes())
+    struct.pack_into("<H", data, len(BINARY_MAGIC), 99)
+    with pytest.raises(ValueError, match="version 99"):
+        Session.from_bytes(bytes(data))
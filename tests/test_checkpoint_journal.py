@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from bqc_dash.checkpoint import server
+from bqc_dash.checkpoint.server import CheckpointJournal, Session, load_session
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    return str(tmp_path / "checkpoint.json")
+
+
+def make_session(size=21, prefix="sub"):
+    return Session("input", [f"{prefix}-{i}/image_1.png" for i in range(size)], 0, {})
+
+
+def assert_loaded(checkpoint, session):
+    loaded = load_session(checkpoint)
+    assert loaded.images_path == session.images_path
+    assert loaded.rejected_images == session.rejected_images
+    assert loaded.reviewed_images == session.reviewed_images
+    assert loaded.current_index == session.current_index
+
+
+def count_events(checkpoint):
+    with open(f"{checkpoint}.journal") as f:
+        return len(f.readlines())
+
+
+def test_replay(checkpoint):
+    session = make_session()
+    journal = CheckpointJournal(checkpoint)
+    journal.save(session, session.dataset_id)
+    for index in (3, 8, 3, 20):
+        session.toggle_rejected(index)
+        session.mark_reviewed([index])
+        session.set_current_index(index)
+        journal.save(session, session.dataset_id)
+    assert count_events(checkpoint) == 4
+    assert list(session.rejected_images.indices()) == [8, 20]
+    assert_loaded(checkpoint, session)
+
+
+def test_replay_across_compaction(checkpoint, monkeypatch):
+    monkeypatch.setattr(server, "JOURNAL_COMPACT_EVERY", 3)
+    session = make_session()
+    journal = CheckpointJournal(checkpoint)
+    journal.save(session, session.dataset_id)
+    for index in range(10):
+        session.toggle_rejected(index)
+        journal.save(session, session.dataset_id)
+        assert_loaded(checkpoint, session)
+    # Compacted instead of the 4th and 8th events
+    assert count_events(checkpoint) == 2
+
+
+def test_workers_sharing_a_checkpoint(checkpoint, monkeypatch):
+    """Each worker appends after the compactions of the other"""
+    monkeypatch.setattr(server, "JOURNAL_COMPACT_EVERY", 2)
+    session = make_session()
+    workers = [CheckpointJournal(checkpoint), CheckpointJournal(checkpoint)]
+    for index in range(12):
+        session.toggle_rejected(index)
+        workers[index % 3 % 2].save(session, session.dataset_id)
+        assert_loaded(checkpoint, session)
+
+
+def test_events_of_previous_manifest_ignored(checkpoint):
+    session = make_session()
+    journal = CheckpointJournal(checkpoint)
+    journal.save(session, session.dataset_id)
+    session.toggle_rejected(1)
+    journal.save(session, session.dataset_id)
+
+    # A crash between the manifest rename and the journal truncation
+    with open(f"{checkpoint}.journal") as f:
+        stale = f.read()
+    session.toggle_rejected(2)
+    with open(f"{checkpoint}.journal", "a") as f:
+        journal.compact(session, session.dataset_id, f)
+    with open(f"{checkpoint}.journal", "w") as f:
+        f.write(stale.replace("[1]", "[5]"))
+    assert_loaded(checkpoint, session)
+
+
+def test_truncated_event_ignored(checkpoint):
+    session = make_session()
+    journal = CheckpointJournal(checkpoint)
+    journal.save(session, session.dataset_id)
+    session.toggle_rejected(4)
+    journal.save(session, session.dataset_id)
+    with open(f"{checkpoint}.journal", "a") as f:
+        f.write('{"generation": "')
+    assert_loaded(checkpoint, session)
+
+
+def test_new_dataset_of_the_same_size_compacts(checkpoint):
+    first = make_session()
+    journal = CheckpointJournal(checkpoint)
+    first.toggle_rejected(2)
+    journal.save(first, first.dataset_id)
+
+    second = make_session(prefix="other")
+    second.toggle_rejected(6)
+    journal.save(second, second.dataset_id)
+    assert count_events(checkpoint) == 0
+    assert_loaded(checkpoint, second)
+
+    second.set_images_path([f"new-{i}/image_1.png" for i in range(21)])
+    journal.save(second, second.dataset_id)
+    assert_loaded(checkpoint, second)
+
+
+def test_save_checkpoint(checkpoint, monkeypatch):
+    monkeypatch.setattr(server, "checkpoint_mode", "journal")
+    session = make_session()
+    for index in (0, 7):
+        session.toggle_rejected(index)
+        server.save_checkpoint(
+            checkpoint,
+            session.images_path,
+            session.rejected_images,
+            index,
+            session.input_dir,
+        )
+    session.current_index = 7
+    assert count_events(checkpoint) == 1
+    with open(checkpoint) as f:
+        assert json.load(f)["dataset_id"] == server.get_dataset_id(session.images_path)
+    assert_loaded(checkpoint, session)
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from bqc_dash.checkpoint.server import (
+    JSON_VERSION,
+    Session,
+    load_session,
+    save_session,
+)
+
+
+@pytest.fixture
+def session():
+    images_path = [f"png/sub-{i % 4}/sub-{i % 4}_{i}.png" for i in range(29)]
+    session = Session("input", images_path, 5, {})
+    for index in (0, 9, 28):
+        session.toggle_rejected(index)
+    session.mark_reviewed(range(13))
+    return session
+
+
+def test_round_trip(session, tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.json")
+    save_session(checkpoint, session)
+    with open(checkpoint, "r") as f:
+        data = json.load(f)
+    assert data["version"] == JSON_VERSION
+    assert "rejected_images" not in data
+
+    loaded = load_session(checkpoint)
+    assert loaded.images_path == session.images_path
+    assert loaded.rejected_images == session.rejected_images
+    assert loaded.reviewed_images == session.reviewed_images
+    assert loaded.current_index == session.current_index
+
+
+def test_unversioned_checkpoint(session):
+    data = session.as_dict()
+    del data["version"], data["rejected_bits"], data["reviewed_bits"]
+    data["rejected_images"] = {"0": True, "9": True, "28": True, "3": False}
+    loaded = Session.from_dict(data)
+    assert loaded.rejected_images == session.rejected_images
+    assert loaded.as_dict()["version"] == JSON_VERSION
+
+
+def test_unsupported_version(session):
+    data = session.as_dict()
+    data["version"] = 99
+    with pytest.raises(ValueError, match="version 99"):
+        Session.from_dict(data)
@@ -0,0 +1,48 @@
+import multiprocessing
+import os
+
+from bqc_dash.performance import server as performance_server
+from bqc_dash.performance.server import (
+    HistogramSegment,
+    PerformanceMonitor,
+    read_segments,
+)
+
+
+def record(directory):
+    """Record a duration in the segment of a worker, then exit"""
+    HistogramSegment(directory).record("latency", "route", 0.5)
+
+
+def test_exited_worker_removed(tmp_path):
+    directory = str(tmp_path)
+    segment = HistogramSegment(directory)
+    segment.record("latency", "route", 0.1)
+    worker = multiprocessing.get_context("fork").Process(
+        target=record, args=(directory,)
+    )
+    worker.start()
+    worker.join()
+    assert os.path.exists(os.path.join(directory, f"{worker.pid}.seg"))
+
+    histograms, workers = read_segments(directory)
+    assert workers == 1
+    assert histograms["latency", "route"][0] == 1
+    assert sorted(os.listdir(directory)) == [
+        f"{os.getpid()}.json",
+        f"{os.getpid()}.seg",
+    ]
+
+
+def test_remove_segment(tmp_path, monkeypatch):
+    monkeypatch.setattr(performance_server, "metrics_dir", str(tmp_path))
+    performance = PerformanceMonitor()
+    performance.record("route", 0.1)
+    histograms, workers = performance.read_server_histograms()
+    assert workers == 1
+
+    performance.remove_segment()
+    directory = os.path.join(str(tmp_path), str(performance_server.server_pid))
+    assert os.listdir(directory) == []
+    # Durations recorded meanwhile are dropped
+    performance.record("route", 0.1)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from bqc_dash.image_display import server as image_server
+from bqc_dash.image_display.server import get_rendition
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch):
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(image_server, "rendition_cache", image_server.RenditionCache())
+    image_server.image_cache.clear()
+    paths = []
+    for index in range(8):
+        path = str(tmp_path / f"image_{index}.png")
+        Image.effect_noise((400, 300), 50 + index).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_rendition(images):
+    rendition_path = get_rendition(images[0], "v1", 320, 80, "WEBP")
+    with Image.open(rendition_path) as rendition:
+        assert rendition.format == "WEBP"
+        assert rendition.size == (320, 240)
+    assert get_rendition(images[0], "v1", 320, 80, "WEBP") == rendition_path
+
+
+def test_disk_budget(images, monkeypatch):
+    rendition_paths = []
+    for index, path in enumerate(images):
+        rendition_path = get_rendition(path, "v1", 320, 80, "PNG")
+        # One second apart, oldest first
+        os.utime(rendition_path, (index, index))
+        rendition_paths.append(rendition_path)
+    sizes = [os.path.getsize(path) for path in rendition_paths]
+
+    # Room for about three renditions, the oldest are removed first
+    budget = sum(sizes[-3:]) / 0.9
+    monkeypatch.setattr(image_server, "rendition_cache_mb", budget / 1024 / 1024)
+    monkeypatch.setattr(image_server, "rendition_cache", image_server.RenditionCache())
+    new_path = get_rendition(images[0], "v2", 320, 80, "PNG")
+
+    kept = [os.path.exists(path) for path in rendition_paths]
+    assert os.path.exists(new_path)
+    assert kept == sorted(kept)
+    assert not kept[0]
+    assert kept[-1]
+    total = sum(entry[1] for entry in image_server.RenditionCache._list())
+    assert total <= budget
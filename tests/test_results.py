@@ -0,0 +1,80 @@
+import json
+
+import pandas as pd
+import pytest
+
+from bqc_dash.checkpoint import server
+from bqc_dash.checkpoint.server import save_results
+from bqc_dash.rejection.server import Bitset
+from bqc_dash.scan.server import PathTable
+
+INPUT_DIR = "/data/input"
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(tmp_path, monkeypatch):
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(server, "RESULTS_CHUNK_ROWS", 8)
+
+
+def make_results(size, rejected):
+    images_path = [
+        f"{INPUT_DIR}/png/sub-{i // 3}/sub-{i // 3}_{i % 3 + 1}.png"
+        for i in range(size)
+    ]
+    return {
+        "input_dir": INPUT_DIR,
+        "images_path": images_path,
+        "rejected_images": Bitset.from_indices(size, rejected),
+    }
+
+
+def get_rows(results):
+    """Rows of the results, built one image at a time"""
+    paths = PathTable.parse(results["images_path"])
+    return [
+        {
+            "subject": paths.label("subject", index),
+            "image_name": paths.label("image_name", index),
+            "repetition": paths.label("repetition", index),
+            "path": image_path,
+            "rejected_images": results["rejected_images"].get(index),
+            "input_dir": INPUT_DIR,
+        }
+        for index, image_path in enumerate(results["images_path"])
+    ]
+
+
+# Rejections only after empty leading chunks, and none at all
+@pytest.mark.parametrize("size,rejected", [(29, [20, 27, 28]), (29, []), (5, [0])])
+def test_json_as_one_frame(tmp_path, size, rejected):
+    """Chunked JSON lines are the lines of the whole table written at once"""
+    results = make_results(size, rejected)
+    save_results(str(tmp_path / "results.json"), results)
+
+    rows = get_rows(results)
+    expected = pd.DataFrame(rows).to_json(
+        orient="records", lines=True, date_format="iso"
+    )
+    assert (tmp_path / "results.json").read_text().rstrip("\n") == expected.rstrip("\n")
+    lines = (tmp_path / "results_rejected.json").read_text().splitlines()
+    assert len(lines) == len(rejected)
+    assert [json.loads(line)["path"] for line in lines] == [
+        rows[index]["path"] for index in rejected
+    ]
+
+
+@pytest.mark.parametrize("size,rejected", [(29, [20, 27, 28]), (29, []), (5, [0])])
+def test_csv_header_once(tmp_path, size, rejected):
+    results = make_results(size, rejected)
+    save_results(str(tmp_path / "results.csv"), results)
+
+    columns = list(get_rows(results)[0])
+    for name, count in (("results.csv", size), ("results_rejected.csv", len(rejected))):
+        text = (tmp_path / name).read_text()
+        assert text.count("subject,image_name") == 1
+        frame = pd.read_csv(tmp_path / name)
+        assert list(frame.columns) == columns
+        assert len(frame) == count
+    frame = pd.read_csv(tmp_path / "results_rejected.csv")
+    assert list(frame["path"]) == [results["images_path"][i] for i in rejected]
@@ -0,0 +1,252 @@
+import glob
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from natsort import natsorted
+
+from bqc_dash.scan.server import (
+    ScanIndex,
+    get_file_version,
+    get_image_versions,
+    get_path_table,
+    scan_directory,
+)
+
+# Directory mtime older than the racy window, so that listings are trusted
+OLD_MTIME = time.time_ns() - 3600 * 10**9
+
+
+@pytest.fixture
+def input_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    input_dir = str(tmp_path / "input")
+    for subject in ("sub-1", "sub-2", "sub-10"):
+        for repetition in (1, 2, 11):
+            write(input_dir, f"png/{subject}/{subject}_{repetition}.png")
+        write(input_dir, f"{subject}.gif")
+    write(input_dir, "png/sub-2/.hidden.png")
+    write(input_dir, "png/sub-2/notes.txt")
+    age(input_dir)
+    return input_dir
+
+
+def write(input_dir, rel_path):
+    path = os.path.join(input_dir, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(rel_path.encode())
+
+
+def age(input_dir):
+    """Move the mtime of every directory out of the racy window"""
+    for directory, _, _ in os.walk(input_dir):
+        os.utime(directory, ns=(OLD_MTIME, OLD_MTIME))
+
+
+def get_reference(input_dir):
+    """Images and GIFs as the scan found them before the index, with glob"""
+    pattern = os.path.join(input_dir, "png", "**", "*.png")
+    images_path = natsorted(
+        path.replace(input_dir, "") for path in glob.glob(pattern, recursive=True)
+    )
+    return images_path, sorted(glob.glob(os.path.join(input_dir, "*.gif")))
+
+
+def assert_scan(input_dir):
+    """Scan with the index of the previous scan, and check the result"""
+    index = ScanIndex.load(input_dir)
+    images_path, gif_files = index.scan()
+    index.save()
+    assert images_path == get_reference(input_dir)[0]
+    assert sorted(gif_files) == get_reference(input_dir)[1]
+    return index
+
+
+def test_first_scan(input_dir):
+    index = assert_scan(input_dir)
+    assert index.walked == 5
+    assert index.reused == 0
+    assert [row["subject"] for row in index.subjects] == ["sub-1", "sub-2", "sub-10"]
+
+
+def test_unchanged_directories_reused(input_dir):
+    assert_scan(input_dir)
+    index = assert_scan(input_dir)
+    assert index.walked == 0
+    assert index.reused == 5
+    assert not index.dirty
+
+
+def test_add_file(input_dir):
+    assert_scan(input_dir)
+    write(input_dir, "png/sub-2/sub-2_3.png")
+    index = assert_scan(input_dir)
+    assert index.walked == 1
+    assert "/png/sub-2/sub-2_3.png" in index.images_path
+
+
+def test_add_subject(input_dir):
+    assert_scan(input_dir)
+    write(input_dir, "png/sub-3/sub-3_1.png")
+    write(input_dir, "sub-3.gif")
+    index = assert_scan(input_dir)
+    assert [row["subject"] for row in index.subjects][2] == "sub-3"
+    assert index.subjects[2]["gif"] == "sub-3.gif"
+
+
+def test_remove_directory(input_dir):
+    assert_scan(input_dir)
+    for name in os.listdir(os.path.join(input_dir, "png", "sub-10")):
+        os.unlink(os.path.join(input_dir, "png", "sub-10", name))
+    os.rmdir(os.path.join(input_dir, "png", "sub-10"))
+    index = assert_scan(input_dir)
+    assert not any("sub-10" in path for path in index.images_path)
+    assert os.path.join("png", "sub-10") not in index.directories
+
+
+def test_nested_subject(input_dir):
+    assert_scan(input_dir)
+    write(input_dir, "png/sub-1/ses-2/sub-1_ses-2_1.png")
+    index = assert_scan(input_dir)
+    assert "/png/sub-1/ses-2/sub-1_ses-2_1.png" in index.images_path
+
+    # A change deep in the tree leaves the subject directory mtime as is
+    age(input_dir)
+    assert_scan(input_dir)
+    write(input_dir, "png/sub-1/ses-2/sub-1_ses-2_2.png")
+    index = assert_scan(input_dir)
+    assert "/png/sub-1/ses-2/sub-1_ses-2_2.png" in index.images_path
+
+
+def test_same_tick_modification(input_dir):
+    """A directory changed again within its mtime tick is listed again"""
+    directory = os.path.join(input_dir, "png", "sub-1")
+    mtime = time.time_ns()
+    os.utime(directory, ns=(mtime, mtime))
+    index = assert_scan(input_dir)
+    assert index.directories[os.path.join("png", "sub-1")]["racy"]
+
+    # The new file leaves the directory with the mtime seen by the scan
+    write(input_dir, "png/sub-1/sub-1_3.png")
+    os.utime(directory, ns=(mtime, mtime))
+    index = assert_scan(input_dir)
+    assert "/png/sub-1/sub-1_3.png" in index.images_path
+
+
+def test_missing_input_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    with pytest.raises(FileNotFoundError):
+        scan_directory(str(tmp_path / "missing"))
+
+
+def test_unreadable_index_ignored(input_dir):
+    assert_scan(input_dir)
+    with open(ScanIndex.get_index_path(input_dir), "w") as f:
+        f.write("{")
+    index = assert_scan(input_dir)
+    assert index.walked == 5
+
+
+def test_concurrent_walk(input_dir):
+    for subject in range(20):
+        write(input_dir, f"png/sub-{subject}/ses-1/sub-{subject}_1.png")
+        write(input_dir, f"png/sub-{subject}/sub-{subject}_2.png")
+    sequential = ScanIndex(input_dir)
+    concurrent = ScanIndex(input_dir)
+    assert sequential.scan(workers=1) == concurrent.scan(workers=8)
+    assert sequential.directories == concurrent.directories
+    assert sequential.subjects == concurrent.subjects
+    assert concurrent.images_path == get_reference(input_dir)[0]
+
+
+def test_concurrent_walk_under_gevent(input_dir):
+    """The walk runs on OS threads in the gevent workers of Gunicorn"""
+    pytest.importorskip("gevent")
+    script = f"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from bqc_dash.scan.server import ScanIndex
+
+get_ident = monkey.get_original("_thread", "get_ident")
+threads = set()
+index = ScanIndex({input_dir!r})
+index.scan(workers=4, on_directory=lambda entry: threads.add(get_ident()))
+print(len(threads - {{get_ident()}}) > 0)
+print(len(index.images_path))
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(input_dir),
+    )
+    assert result.stdout.split()[-2:] == ["True", str(len(get_reference(input_dir)[0]))]
+
+
+def get_versions(input_dir, images_path):
+    versions = []
+    for path in images_path:
+        stat = os.stat(input_dir + path)
+        versions.append(get_file_version(stat.st_size, stat.st_mtime_ns))
+    return versions
+
+
+def rewrite(input_dir, rel_path):
+    """Replace a file with a longer one, as tools writing atomically do"""
+    path = os.path.join(input_dir, rel_path)
+    with open(path + ".tmp", "wb") as f:
+        f.write(rel_path.encode() + b"longer")
+    os.replace(path + ".tmp", path)
+
+
+def test_file_versions(input_dir):
+    index = assert_scan(input_dir)
+    assert index.image_versions == get_versions(input_dir, index.images_path)
+    assert get_image_versions(index, list(index.images_path)) == index.image_versions
+    assert get_image_versions(index, index.images_path[1:]) is None
+
+    gif = os.path.join(input_dir, "sub-1.gif")
+    stat = os.stat(gif)
+    assert index.subjects[0]["gif_size"] == stat.st_size
+    assert index.subjects[0]["gif_mtime"] == stat.st_mtime_ns
+
+    # Files regenerated by a rename get a new version on the next scan
+    rewrite(input_dir, "png/sub-2/sub-2_1.png")
+    rewrite(input_dir, "sub-1.gif")
+    index = assert_scan(input_dir)
+    assert index.image_versions == get_versions(input_dir, index.images_path)
+    assert index.subjects[0]["gif_size"] == stat.st_size + 6
+
+
+def test_loaded_index_reused(input_dir):
+    index = assert_scan(input_dir)
+    loaded = ScanIndex.load(input_dir)
+    assert loaded is not index
+    assert loaded.paths is index.paths
+    assert get_path_table(input_dir, list(index.images_path)) is index.paths
+
+    # Another worker saving the index is seen
+    write(input_dir, "png/sub-1/sub-1_3.png")
+    other = ScanIndex.load(input_dir).copy()
+    other.paths = None
+    other.scan()
+    other.save()
+    assert ScanIndex.load(input_dir).paths is other.paths
+    with open(ScanIndex.get_index_path(input_dir), "a") as f:
+        f.write(" ")
+    loaded = ScanIndex.load(input_dir)
+    assert loaded.images_path == get_reference(input_dir)[0]
+    assert loaded.paths is not other.paths
+
+
+def test_parsed_table_reused(input_dir):
+    images_path = assert_scan(input_dir).images_path[1:]
+    paths = get_path_table(input_dir, images_path)
+    assert get_path_table(input_dir, list(images_path)) is paths
+    assert get_path_table(input_dir, images_path[1:]) is not paths
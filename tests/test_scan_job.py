@@ -0,0 +1,119 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import bqc_dash.session.server as session_server
+from bqc_dash.scan.server import (
+    ScanJob,
+    get_scan_job,
+    read_scan_state,
+    start_scan_job,
+)
+
+KEY = ("session", "tab")
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def input_dir(request, tmp_path, monkeypatch):
+    """Input directory, with the scan jobs shared by files or by the database"""
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    if request.param == "sqlite":
+        monkeypatch.setattr(session_server, "session_store", "sqlite")
+        monkeypatch.setattr(session_server, "session_db", str(tmp_path / "db"))
+    input_dir = tmp_path / "input"
+    for subject in range(3):
+        os.makedirs(input_dir / "png" / f"sub-{subject}")
+        (input_dir / "png" / f"sub-{subject}" / f"sub-{subject}_1.png").touch()
+    return str(input_dir)
+
+
+def wait(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not job.done:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_job(input_dir):
+    job = start_scan_job(KEY, input_dir)
+    wait(job)
+    assert job.error is None
+    assert len(job.images_path) == 3
+    assert read_scan_state(KEY)["done"]
+
+    # As another worker sees it
+    other = ScanJob.from_state(KEY, read_scan_state(KEY))
+    assert other.id == job.id
+    assert other.images_path == job.images_path
+
+
+def test_replaced_job_stops_writing(input_dir):
+    """A job of a key started by another worker replaces the running one"""
+    job = ScanJob(input_dir, KEY)
+    job.save_state(start=True)
+    job.first_images_path = ["/png/sub-0/sub-0_1.png"]
+    new_job = ScanJob(input_dir, KEY)
+    new_job.save_state(start=True)
+
+    job.save_state(force=True)
+    assert job.cancelled
+    assert read_scan_state(KEY)["id"] == new_job.id
+    assert read_scan_state(KEY)["first_images_path"] is None
+    assert not job.publish_first()
+
+    assert new_job.publish_first()
+    assert not new_job.publish_first()
+    assert new_job.first_published
+
+
+def test_new_job_cancels_previous(input_dir):
+    job = start_scan_job(KEY, input_dir)
+    new_job = start_scan_job(KEY, input_dir)
+    assert job.cancelled
+    wait(job)
+    wait(new_job)
+    assert new_job.error is None
+    assert get_scan_job(KEY) is new_job
+    assert read_scan_state(KEY)["id"] == new_job.id
+
+
+def test_job_under_gevent(input_dir):
+    """The scan does not block the event loop of the gevent workers"""
+    pytest.importorskip("gevent")
+    script = f"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import gevent
+
+from bqc_dash.scan.server import ScanIndex, start_scan_job
+
+scan = ScanIndex.scan
+blocking_sleep = monkey.get_original("time", "sleep")
+
+
+def slow_scan(self, *args, **kwargs):
+    blocking_sleep(0.5)
+    return scan(self, *args, **kwargs)
+
+
+ScanIndex.scan = slow_scan
+job = start_scan_job(("session", "tab"), {input_dir!r})
+ticks = 0
+while not job.done:
+    gevent.sleep(0.01)
+    ticks += 1
+print(ticks > 10, len(job.images_path))
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(input_dir),
+    )
+    assert result.stdout.split()[-2:] == ["True", "3"]
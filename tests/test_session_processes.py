@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import bqc_dash.session.server as session_server
+from bqc_dash.checkpoint.server import Session
+from bqc_dash.scan.server import get_scan_job, start_scan_job
+from bqc_dash.session.server import (
+    SessionStore,
+    get_session_database,
+    set_session_store,
+)
+
+WORKERS = 4
+IMAGES = 200
+SESSION_ID = {"session-id": "session"}
+TAB_ID = {"tab-id": "tab"}
+
+# Worker processes are started afresh, as Gunicorn workers importing the app
+context = multiprocessing.get_context("spawn")
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setenv("BQC_CACHE_DIR", str(tmp_path / "cache"))
+    path = str(tmp_path / "sessions.sqlite3")
+    monkeypatch.setattr(session_server, "session_store", "sqlite")
+    monkeypatch.setattr(session_server, "session_db", path)
+    return path
+
+
+def review(path, worker):
+    """Toggle the images of one worker and put a session of its own tab"""
+    set_session_store("sqlite", path)
+    sessions = SessionStore()
+    images_path = [f"/png/sub-{worker}/sub-{worker}_{i}.png" for i in range(10)]
+    own_tab = {"tab-id": f"tab-{worker}"}
+    for index in range(worker, IMAGES, WORKERS):
+        sessions.get(SESSION_ID, TAB_ID).toggle_rejected(index)
+        sessions.put(SESSION_ID, own_tab, Session("input", images_path, 0, {}))
+        sessions.get(SESSION_ID, own_tab).toggle_rejected(index % 10)
+
+
+def run(target, *args):
+    processes = [
+        context.Process(target=target, args=(*args, worker))
+        for worker in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+
+def test_concurrent_toggles(database):
+    sessions = SessionStore()
+    images_path = [f"/png/sub-1/sub-1_{i}.png" for i in range(IMAGES)]
+    session = sessions.put(SESSION_ID, TAB_ID, Session("input", images_path, 0, {}))
+
+    run(review, database)
+
+    # Every toggle of every worker is kept, in the copy of this worker too
+    assert sessions.get(SESSION_ID, TAB_ID) is session
+    assert all(session.rejected_images.get(index) for index in range(IMAGES))
+    for worker in range(WORKERS):
+        own = SessionStore().get(SESSION_ID, {"tab-id": f"tab-{worker}"})
+        assert own.images_path[0] == f"/png/sub-{worker}/sub-{worker}_0.png"
+        assert sum(own.rejected_images.get(index) for index in range(10)) == 1
+    assert get_session_database().count_sessions() == WORKERS + 1
+
+
+def scan(path, input_dir, worker):
+    """Scan input_dir for the tab of the worker, then exit"""
+    set_session_store("sqlite", path)
+    job = start_scan_job(("session", f"tab-{worker}"), input_dir)
+    while not job.done:
+        time.sleep(0.01)
+    assert job.error is None
+
+
+def test_scan_job_shared(database, tmp_path):
+    input_dir = str(tmp_path / "input")
+    for subject in range(3):
+        os.makedirs(os.path.join(input_dir, "png", f"sub-{subject}"))
+        for repetition in range(2):
+            open(
+                os.path.join(
+                    input_dir,
+                    "png",
+                    f"sub-{subject}",
+                    f"sub-{subject}_{repetition}.png",
+                ),
+                "wb",
+            ).close()
+
+    run(scan, database, input_dir)
+
+    # The scans of the other processes, which exited, are reported here
+    for worker in range(WORKERS):
+        job = get_scan_job(("session", f"tab-{worker}"))
+        assert job.done
+        assert job.error is None
+        assert job.pid != os.getpid()
+        assert len(job.images_path) == 6
+    assert get_scan_job(("session", "other")) is None